@@ -32,12 +32,10 @@ class ScanOperator(LogicalOperator):
     def __init__(self, table_name):
         super().__init__('Scan')
         self.table_name = table_name
-        # todo:
-        # 如果这个columns是可以裁剪的，此处返回被裁减后的列数组
+        # 默认扫描全部的列，SelectTransformer.rewrite() 中进行列裁剪之后，
+        # 此处为被裁减后的列数组（仍然保持表中列的顺序）
         self.columns = catalog_table.select(
             lambda r: r.table_name == table_name)[0].columns
-        # 注意：关于扫描表，应该扫描哪些字段，是否需要提前进行
-        # 列裁剪，应该有对应的字段进行承载
         self.condition = None
 
 
@@ -10,8 +10,14 @@ from imoocdb.executor.operator.physical_operator import (
     NestedLoopJoin, PhysicalQuery,
     PhysicalInsert, PhysicalUpdate, LocationScan, PhysicalDelete, PhysicalDDL, CommandOperator)
 
+from imoocdb.storage.common import table_tuple_get_pages
+from imoocdb.storage.entry import table_tuple_estimate_count
 from imoocdb.sql.utils import table_exists, column_exists, function_exists
 
+# 还没有统计信息，先使用与 PostgreSQL 相同的默认选择率来估计谓词命中的行数
+DEFAULT_EQUAL_SELECTIVITY = 0.005
+DEFAULT_RANGE_SELECTIVITY = 1 / 3
+
 
 class SelectTransformer:
     @staticmethod
@@ -277,7 +283,37 @@ class SelectTransformer:
         if not query.join_operator:
             assert len(query.scan_operators) == 1
             building_node.add_child(query.scan_operators[0])
-        # todo: 现在可以做一些RBO的优化动作了，例如列裁剪
+
+        # 现在可以做一些RBO的优化动作了，例如列裁剪：
+        # 扫描算子只需要输出查询中真正用到的列
+        def see(column):
+            if isinstance(column, TableColumn):
+                all_seen_columns.setdefault(column.table_name, set()).add(column.column_name)
+            elif isinstance(column, FunctionColumn):
+                for arg in column.args:
+                    see(arg)
+
+        def see_condition(condition):
+            if condition is not None:
+                see(condition.left)
+                see(condition.right)
+
+        for column in query.project_columns:
+            see(column)
+        if query.where_condition:
+            see_condition(query.where_condition.condition)
+        if query.join_operator:
+            see_condition(query.join_operator.join_condition)
+            see_condition(getattr(query.join_operator, 'condition', None))
+        if query.sort_operator:
+            see(query.sort_operator.sort_column)
+        see(query.group_by_column)
+
+        for scan_operator in query.scan_operators:
+            seen_columns = all_seen_columns.get(scan_operator.table_name)
+            if seen_columns:
+                scan_operator.columns = [column for column in scan_operator.columns
+                                         if column in seen_columns]
 
     @staticmethod
     def transform(ast: Select):
@@ -451,10 +487,10 @@ class SelectImplementation:
             return TableScan(node.table_name, node.condition)
 
         # 接下来，从这里面挑选最合适的一个索引
-        # 如果，这个query中所涉及到的列，都涵盖在这个索引里面了，那么我们
+        # 如果，这个query中所涉及到的列，恰好就是这个索引的列，那么我们
         # 使用覆盖索引，否则，找在candidate_indexes索引列最短的那个使用。
         for candidate_index in candidate_indexes:
-            if len(node.columns) == len(candidate_index.columns):
+            if SelectImplementation.is_covered_by(node, candidate_index):
                 # 此时，应该使用覆盖索引
                 return CoveredIndexScan(
                     index_name=candidate_index.index_name,
@@ -469,7 +505,71 @@ class SelectImplementation:
             if len(candidate_index.columns) < len(shortest_index.columns):
                 shortest_index = candidate_index
 
-        return IndexScan(index_name=shortest_index.index_name, condition=node.condition)
+        index_scan = IndexScan(index_name=shortest_index.index_name, condition=node.condition)
+        # 预估命中的行数较多时，使用 bitmap heap scan, 即按页号排序之后再回表，
+        # 执行时为 index_tuple_get_range(..., bitmap=True)
+        index_scan.bitmap_heap_scan = SelectImplementation.prefer_bitmap_heap_scan(node)
+        return index_scan
+
+    @staticmethod
+    def is_covered_by(node, index):
+        """覆盖索引扫描按照索引列的顺序输出索引中全部的列，
+        因此，只有扫描需要的列（列裁剪之后）与索引列完全一致时，输出才与表扫描的一致
+        """
+        return list(node.columns) == list(index.columns)
+
+    @staticmethod
+    def prefer_bitmap_heap_scan(node):
+        if node.condition.sign == '=':
+            selectivity = DEFAULT_EQUAL_SELECTIVITY
+        else:
+            selectivity = DEFAULT_RANGE_SELECTIVITY
+        estimated_rows = table_tuple_estimate_count(node.table_name) * selectivity
+        # 命中的行数比表的页数还多时，按索引键的顺序回表，必然会多次访问同一个页
+        return estimated_rows > table_tuple_get_pages(node.table_name)
+
+    @staticmethod
+    def implement_ordered_scan(node) -> Union[IndexScan, CoveredIndexScan, None]:
+        """ORDER BY 的列是某个索引的第一列时，直接按照索引的顺序扫描（DESC 时沿着 prev_leaf 逆序扫描），
+        不再需要 Sort. 执行时为 index_tuple_get_range(..., reverse=physical_scan.reverse).
+        不能使用索引的顺序时返回 None.
+        """
+        if len(node.children) != 1 or not isinstance(node.children[0], ScanOperator):
+            return None
+        scan_node = node.children[0]
+        sort_column = node.sort_column
+        if sort_column.table_name != scan_node.table_name:
+            return None
+
+        physical_scan = SelectImplementation.implement_scan(scan_node)
+        if isinstance(physical_scan, (IndexScan, CoveredIndexScan)):
+            index = catalog_index.select(lambda r: r.index_name == physical_scan.index_name)[0]
+            if index.columns[0] != sort_column.column_name:
+                return None
+        elif scan_node.condition:
+            # 谓词没有用到索引，仍然是表扫描 + Sort
+            return None
+        else:
+            # 没有谓词时，通过索引扫描全部的数据，condition 为 None
+            indexes = catalog_index.select(
+                lambda r: r.table_name == scan_node.table_name and
+                          r.columns[0] == sort_column.column_name)
+            if not indexes:
+                return None
+            covered_indexes = [index for index in indexes
+                               if SelectImplementation.is_covered_by(scan_node, index)]
+            if covered_indexes:
+                physical_scan = CoveredIndexScan(index_name=covered_indexes[0].index_name,
+                                                 condition=None)
+            else:
+                shortest_index = min(indexes, key=lambda r: len(r.columns))
+                physical_scan = IndexScan(index_name=shortest_index.index_name, condition=None)
+
+        if isinstance(physical_scan, IndexScan):
+            # bitmap heap scan 按照页号回表，会打乱索引的顺序
+            physical_scan.bitmap_heap_scan = False
+        physical_scan.reverse = not node.asc
+        return physical_scan
 
     @staticmethod
     def implement_sort(node) -> Sort:
@@ -509,6 +609,10 @@ class SelectImplementation:
         if isinstance(node, ScanOperator):
             physical_node = SelectImplementation.implement_scan(node)
         elif isinstance(node, SortOperator):
+            physical_node = SelectImplementation.implement_ordered_scan(node)
+            if physical_node is not None:
+                # 索引扫描已经是 ORDER BY 的顺序了，替代 Sort 以及它下面的扫描算子
+                return physical_node
             physical_node = SelectImplementation.implement_sort(node)
         elif isinstance(node, GroupOperator):
             physical_node = SelectImplementation.implement_agg(node)
@@ -536,7 +640,12 @@ def get_physical_scan_from_predicate(table_name, condition):
     logical_scan.condition = condition
     # 此时，是一个trick, 相当于 把 update/delete 转换为 select 的部分功能
     # 再把 select 中的 scan 算子提取，复用
-    return SelectImplementation.implement_scan(logical_scan)
+    physical_scan = SelectImplementation.implement_scan(logical_scan)
+    if isinstance(physical_scan, IndexScan):
+        # 索引扫描是通过游标惰性返回的，update/delete 会修改同一个索引，
+        # 因此先收集全部的 location (bitmap heap scan), 避免扫描到自己修改之后的元素
+        physical_scan.bitmap_heap_scan = True
+    return physical_scan
 
 
 def query_physical_plan(logical_plan: LogicalOperator) -> "PhysicalOperator":
@@ -1,95 +1,192 @@
-import pickle
-import os
+import bisect
+import functools
 import math
+import struct
+import threading
+from contextlib import contextmanager
 
 from imoocdb.errors import BPlusTreeError
-from imoocdb.storage.slotted_page import Page, LITTLE_ORDER, PAGE_SIZE
-
-
+from imoocdb.storage.slotted_page import Page, PAGE_SIZE, PageHeader, Slot
+from imoocdb.storage.common import INDEX_HEADER, INDEX_HEADER_SIZE, get_index_filename, \
+    index_tuple_get_page, index_tuple_get_pages, index_tuple_put_page, index_tuple_flush, \
+    index_tuple_read_header, index_tuple_discard_doublewrite, index_relations
+from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.smgr import smgr
+
+
+# 索引键的编码：把（组合）键编码为保持顺序的字节串，
+# 使得字节串之间的比较结果与键之间的比较结果一致，
+# 这样，B+树中只需要原生的 bytes 比较，节点内也可以直接用 bisect 查找。
+# 每个值以 1 字节的类型标记开头，不同类型的值按照类型标记排序：
+#   NULL: 只有类型标记，比任何非 NULL 值都小
+#   数值: 整数与浮点数共用一个类型标记，按照数值的大小排序，2 与 2.0 的编码相同。
+#         先是 float(值) 的 IEEE 754 的 8 字节大端序（正数翻转符号位，负数翻转全部的位），
+#         再是 2 字节大端序的 值 - int(float(值)) + 0x8000: 超过 2^53 的整数转换为 float 时
+#         会被舍入，用这个差值区分它们（int64 范围内，差值的绝对值不超过 1024），浮点数的差值为 0
+#   字符串: utf-8 编码（与码点的顺序一致），其中的 0x00 转义为 0x00 0xff,
+#           并以 0x00 0x00 结尾，这样，前缀总是排在更长的字符串前面
+KEY_NULL = 0x01
+KEY_NUMBER = 0x02
+KEY_TEXT = 0x04
+KEY_BYTES = 0x05
+KEY_UINT64 = struct.Struct('>Q')
+KEY_DOUBLE = struct.Struct('>d')
+KEY_RESIDUAL = struct.Struct('>H')
+KEY_RESIDUAL_BIAS = 0x8000
+KEY_TERMINATOR = b'\x00\x00'
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+# 比任何编码之后的键都小（大），代替原来的 float('-inf') 与 float('inf')
+MIN_KEY = b''
+MAX_KEY = b'\xff'
+
+
+def _encode_string(tag, data):
+    return bytes((tag,)) + data.replace(b'\x00', b'\x00\xff') + KEY_TERMINATOR
+
+
+def _encode_number(value):
+    residual = 0
+    if isinstance(value, int):
+        if not INT64_MIN <= value <= INT64_MAX:
+            raise BPlusTreeError(f'the integer {value} is out of range.')
+        approximation = float(value)
+        residual = value - int(approximation)
+        value = approximation
+    elif math.isnan(value):
+        raise BPlusTreeError('NaN can not be used as a key.')
+    # -0.0 == 0.0, 编码之后也必须相等
+    bits = KEY_UINT64.unpack(KEY_DOUBLE.pack(value + 0.))[0]
+    bits = bits ^ 0xffffffffffffffff if bits >> 63 else bits | (1 << 63)
+    return (bytes((KEY_NUMBER,)) + KEY_UINT64.pack(bits) +
+            KEY_RESIDUAL.pack(residual + KEY_RESIDUAL_BIAS))
+
+
+def _decode_number(buff, position):
+    bits = KEY_UINT64.unpack_from(buff, position)[0]
+    bits = bits ^ (1 << 63) if bits >> 63 else bits ^ 0xffffffffffffffff
+    value = KEY_DOUBLE.unpack(KEY_UINT64.pack(bits))[0]
+    residual = KEY_RESIDUAL.unpack_from(buff, position + KEY_UINT64.size)[0] - KEY_RESIDUAL_BIAS
+    # 整数与数值相等的浮点数的编码相同，在 int64 范围内的整数值都还原为 int
+    if residual or (value.is_integer() and INT64_MIN <= int(value) <= INT64_MAX):
+        return int(value) + residual
+    return value
+
+
+def encode_key(tup) -> bytes:
+    parts = []
+    for value in tup:
+        if value is None:
+            parts.append(bytes((KEY_NULL,)))
+        elif isinstance(value, (int, float)):
+            parts.append(_encode_number(value))
+        elif isinstance(value, str):
+            parts.append(_encode_string(KEY_TEXT, value.encode('utf-8')))
+        elif isinstance(value, bytes):
+            parts.append(_encode_string(KEY_BYTES, value))
+        else:
+            raise BPlusTreeError(f'unsupported key type {type(value).__name__}.')
+    return b''.join(parts)
+
+
+def _decode_string(buff, position):
+    """返回 (字节串, 下一个值的位置)"""
+    chunks = []
+    while True:
+        end = buff.index(b'\x00', position)
+        chunks.append(buff[position: end])
+        if buff[end + 1] != 0xff:
+            return b'\x00'.join(chunks), end + len(KEY_TERMINATOR)
+        position = end + 2
+
+
+def decode_key(buff) -> tuple:
+    values = []
+    position = 0
+    while position < len(buff):
+        tag = buff[position]
+        position += 1
+        if tag == KEY_NULL:
+            values.append(None)
+        elif tag == KEY_NUMBER:
+            values.append(_decode_number(buff, position))
+            position += KEY_UINT64.size + KEY_RESIDUAL.size
+        elif tag == KEY_TEXT:
+            data, position = _decode_string(buff, position)
+            values.append(data.decode('utf-8'))
+        elif tag == KEY_BYTES:
+            data, position = _decode_string(buff, position)
+            values.append(bytes(data))
+        else:
+            raise BPlusTreeError(f'invalid key tag {tag}.')
+    return tuple(values)
+
+
+def normalize_key(key) -> bytes:
+    """把调用者传入的键统一为编码之后的字节串，
+    可以是 BPlusTreeTuple, tuple, 已经编码过的 bytes, 或者 float('-inf')/float('inf')
+    """
+    if isinstance(key, bytes):
+        return key
+    if isinstance(key, BPlusTreeTuple):
+        return key.key
+    if isinstance(key, tuple):
+        return encode_key(key)
+    if isinstance(key, float) and math.isinf(key):
+        return MAX_KEY if key > 0 else MIN_KEY
+    raise BPlusTreeError(f'invalid key {key!r}.')
+
+
+@functools.total_ordering
 class BPlusTreeTuple:
+    """索引键对外的表示形式，B+树内部只存储、比较编码之后的字节串"""
+
     def __init__(self, tup):
         assert isinstance(tup, tuple)
         self.tup = tup
-
-    @staticmethod
-    def _cmp(a, b):
-        # a - b
-        if a is None and b is None:
-            return 0
-        if a is None:
-            return -1
-        if b is None:
-            return 1
-
-        if a == b:
-            return 0
-        elif a < b:
-            return -1
-        else:
-            return 1
+        self.key = encode_key(tup)
 
     def __repr__(self):
         return str(self.tup)
 
     def __eq__(self, other):
-        if isinstance(other, BPlusTreeTuple):
-            tup = other.tup
-        elif isinstance(other, tuple):
-            tup = other
-        else:
+        if not isinstance(other, (BPlusTreeTuple, tuple, bytes)):
             return False
-        return self.tup == tup
+        return self.key == normalize_key(other)
 
     def __lt__(self, other):
-        # self < other, less than
-        if isinstance(other, BPlusTreeTuple):
-            tup = other.tup
-        elif isinstance(other, tuple):
-            tup = other
-        elif isinstance(other, float):
-            # 不能直接 float('inf') == float('inf')
-            if math.inf == other:
-                return True
-            elif - math.inf == other:
-                return False
-            else:
-                raise
-        else:
-            raise
-
-        assert len(self.tup) == len(tup)
-
-        for i in range(len(self.tup)):
-            r = self._cmp(self.tup[i], tup[i])
-            if r == 0:
-                continue
-            elif r < 0:
-                return True
-            elif r > 0:
-                return False
-
-        # 兜底的，但是不太可能会跑到着
-        return False
+        return self.key < normalize_key(other)
 
-    def __le__(self, other):
-        if self == other:
-            return True
-        return self < other
-
-    def __ge__(self, other):
-        # >=
-        # not <
-        if self == other:
-            return True
-        return not self < other
-
-    def __gt__(self, other):
-        # self > other
-        # >
-        # not <=
-        if self == other:
-            return False
-        return not self < other
+    def __hash__(self):
+        return hash(self.key)
+
+
+# 节点中的每个元素是 slotted page 中的一条记录：
+#   叶子节点: | location 的 pageno (8B) | sid (8B) | 编码之后的键 |
+#   内部节点: | child 的 pageno (8B) | 编码之后的键 |
+LEAF_RECORD = struct.Struct('<QQ')
+INTERNAL_RECORD = struct.Struct('<Q')
+# 节点序列化之后的大小超过页大小的 fill_factor 时分裂，
+# 这样，每个节点都能写进一个页里，内部节点也可以容纳数百个分隔符
+BPLUS_TREE_FILL_FACTOR = 0.9
+# 每个节点至少要能放下这么多个键，更长的键不能被索引
+MIN_KEYS_PER_NODE = 4
+# 打开的索引在内存中最多保留这么多个已经解码的节点，超出时释放叶子节点，
+# 内部节点数量很少且访问频繁，一直保留；被释放的节点下次访问时从 buffer pool 中重新解码
+BPLUS_TREE_CACHED_NODES = 128
+# 批量构建索引时，每攒够这么多个页写出一次
+BULK_LOAD_WRITE_PAGES = 64
+# 删除之后，节点序列化之后的大小低于 max_node_size 的这个比例时，
+# 与兄弟节点合并，或者从兄弟节点借用元素
+BPLUS_TREE_MERGE_FACTOR = 0.5
+# 页头中 flags 的取值
+LEAF_NODE_FLAG = 1
+INTERNAL_NODE_FLAG = 0
+# 被释放、等待复用的页，reserved 中是空闲链表中的下一个页号
+FREE_NODE_FLAG = 2
+INVALID_PAGENO = 0xffffffff
+# 叶子节点页头的 reserved 中，低 32 位是下一个叶子节点的页号，高 32 位是上一个叶子节点的页号
+LEAF_LINK_BITS = 32
 
 
 # todo: 把这个node可以序列化为slotted page的字节集 bytes
@@ -108,39 +205,62 @@ class BPlusTreeNode:
         self.pageno = 0xffffffff  # 给一个初始值，不合法的值
 
         self.next_leaf = None
+        self.prev_leaf = None
         self.lsn = 0
+        # 节点被释放之后，所在的页放到空闲链表中
+        self.free = False
+        self.next_free = INVALID_PAGENO
+
+    def unload(self):
+        # 变回只有 pageno 的节点，下次访问时重新加载
+        self.keys = []
+        self.children = []
+        self.values = []
+        self.next_leaf = None
+        self.prev_leaf = None
+        self.loaded = False
 
     def get_child(self, i):
         # keys ->          [1, 3, 5]
-        # children -> [>1, 1-3, 3-5, >=5]
-        if i >= len(self.children):
-            return self.next_leaf
+        # children -> [<=1, 1-3, 3-5, >=5]
+        # 内部节点的 children 总是比 keys 多一个
         return self.children[i]
 
     def count_children(self):
-        if self.next_leaf:
-            return len(self.children) + 1
         return len(self.children)
 
+    def record_overhead(self):
+        # 每条记录中，除了键以外的部分
+        if self.is_leaf:
+            return Slot.size() + LEAF_RECORD.size
+        return Slot.size() + INTERNAL_RECORD.size
+
+    def serialized_size(self):
+        # 与 to_page() 保持一致：内部节点的记录数是 children 的数量
+        records = len(self.keys) if self.is_leaf else len(self.children)
+        return (PageHeader.size() + records * self.record_overhead() +
+                sum(map(len, self.keys)))
+
     def to_page(self):
         # 也就是序列化过程的一部分，因为Page本身自带序列化的方法
         page = Page()
-        page.page_header.flags = 1 if self.is_leaf else 0
+        page.page_header.flags = LEAF_NODE_FLAG if self.is_leaf else INTERNAL_NODE_FLAG
         # page.page_header.lsn = self.lsn
 
-        if self.is_leaf:
-            page.page_header.reserved = self.next_leaf.pageno if self.next_leaf else 0xffffffff
+        if self.free:
+            page.page_header.flags = FREE_NODE_FLAG
+            page.page_header.reserved = self.next_free
+        elif self.is_leaf:
+            next_pageno = self.next_leaf.pageno if self.next_leaf else INVALID_PAGENO
+            prev_pageno = self.prev_leaf.pageno if self.prev_leaf else INVALID_PAGENO
+            page.page_header.reserved = prev_pageno << LEAF_LINK_BITS | next_pageno
             for k, v in zip(self.keys, self.values):
-                page.insert(pickle.dumps((k, v)))
+                page.insert(LEAF_RECORD.pack(*v) + k)
         else:
-            for i in range(len(self.keys)):
-                k = self.keys[i]
-                v = self.children[i].pageno
-                page.insert(pickle.dumps((k, v)))
-            # 打补丁，因为 children 是空隙，应该是 keys + 1
-            if len(self.children) > len(self.keys):
-                v = self.children[-1].pageno
-                page.insert(pickle.dumps((None, v)))
+            # children 比 keys 多一个，第一个 child 没有对应的 key
+            page.insert(INTERNAL_RECORD.pack(self.children[0].pageno))
+            for k, child in zip(self.keys, self.children[1:]):
+                page.insert(INTERNAL_RECORD.pack(child.pageno) + k)
 
         page.set_header(self.lsn)
         return page
@@ -149,30 +269,31 @@ class BPlusTreeNode:
         # 用来把 page 中的数据，反解析一下（反序列化），用于赋值到
         # 当前的 node 上
         self.loaded = True
-        self.is_leaf = page.page_header.flags == 1
+        self.is_leaf = page.page_header.flags == LEAF_NODE_FLAG
         self.lsn = page.page_header.lsn
 
         if self.is_leaf:
-            if page.page_header.reserved < 0xffffffff:
+            next_pageno = page.page_header.reserved & INVALID_PAGENO
+            prev_pageno = page.page_header.reserved >> LEAF_LINK_BITS
+            if next_pageno != INVALID_PAGENO:
                 self.next_leaf = BPlusTreeNode()
-                self.next_leaf.pageno = page.page_header.reserved
-
-            for sid in range(len(page.slot_directory)):
-                k, v = pickle.loads(page.select(sid))
-                self.keys.append(k)
-                self.values.append(v)
+                self.next_leaf.pageno = next_pageno
+            if prev_pageno != INVALID_PAGENO:
+                self.prev_leaf = BPlusTreeNode()
+                self.prev_leaf.pageno = prev_pageno
+
+            for sid in range(page.slot_count):
+                record = page.select(sid)
+                self.values.append(LEAF_RECORD.unpack_from(record))
+                self.keys.append(record[LEAF_RECORD.size:])
         else:
-            for sid in range(len(page.slot_directory)):
-                k, v = pickle.loads(page.select(sid))
-                if k is None:
-                    node = BPlusTreeNode()
-                    node.pageno = v
-                    self.children.append(node)
-                else:
-                    self.keys.append(k)
-                    node = BPlusTreeNode()
-                    node.pageno = v
-                    self.children.append(node)
+            for sid in range(page.slot_count):
+                record = page.select(sid)
+                if sid > 0:
+                    self.keys.append(record[INTERNAL_RECORD.size:])
+                node = BPlusTreeNode()
+                node.pageno = INTERNAL_RECORD.unpack_from(record)[0]
+                self.children.append(node)
 
     def __eq__(self, other):
         if not isinstance(other, BPlusTreeNode):
@@ -183,26 +304,21 @@ class BPlusTreeNode:
         return self.pageno
 
 
-HEADER_SIZE = 8  # 64bit int
+HEADER_SIZE = INDEX_HEADER_SIZE
 
 
-def load_page_from_disk(filename, pageno):
-    with open(filename, 'rb') as f:
-        f.seek(HEADER_SIZE + pageno * PAGE_SIZE)
-        # 标志着读的数据是 [pageno, pageno + 1)
-        buff = f.read(PAGE_SIZE)
-        page = Page.deserialize(buff)
-    return page
+def read_index_header(index_name):
+    """返回 (根节点的页号, 空闲链表中第一个页的页号)"""
+    filename = get_index_filename(index_name)
+    if not smgr.exists(filename):
+        raise BPlusTreeError(f'not found the file {filename}.')
+    # 其中会先完成崩溃之前没有做完的 doublewrite
+    return index_tuple_read_header(index_name)
 
 
-def load_root_node(filename):
-    if not os.path.exists(filename):
-        raise BPlusTreeError(f'not found the file {filename}.')
-    with open(filename, 'rb') as f:
-        buff = f.read(HEADER_SIZE)
-        root_node_pageno = int.from_bytes(buff, LITTLE_ORDER)
-        assert root_node_pageno >= 0
-    page = load_page_from_disk(filename, root_node_pageno)
+def load_root_node(index_name):
+    root_node_pageno, _ = read_index_header(index_name)
+    page = index_tuple_get_page(index_name, root_node_pageno)
     node = BPlusTreeNode()
     node.from_page(page)
     # 下面这个字段，很容易遗忘！
@@ -210,280 +326,730 @@ def load_root_node(filename):
     return node
 
 
-def count_pages(filename):
-    with open(filename, 'rb') as f:
-        file_size = os.fstat(f.fileno()).st_size
-
-    assert (file_size - HEADER_SIZE) % PAGE_SIZE == 0
-    return (file_size - HEADER_SIZE) // PAGE_SIZE
+def node_size_limits(fill_factor):
+    """返回 (节点序列化之后的最大字节数, 键的最大字节数)"""
+    if not 0.1 <= fill_factor <= 1:
+        raise BPlusTreeError(f'invalid fill factor {fill_factor}.')
+    # 与 Page.can_insert() 保持一致：页中不能一个空闲字节都不剩
+    max_node_size = min(int(PAGE_SIZE * fill_factor), PAGE_SIZE - 1)
+    max_key_size = ((max_node_size - PageHeader.size()) // MIN_KEYS_PER_NODE -
+                    Slot.size() - LEAF_RECORD.size)
+    return max_node_size, max_key_size
 
 
 class BPlusTree:
-    def __init__(self, filename=None, root_node=None):
+    def __init__(self, index_name=None, root_node=None, fill_factor=BPLUS_TREE_FILL_FACTOR):
+        self.max_node_size, self.max_key_size = node_size_limits(fill_factor)
+        self.min_node_size = int(self.max_node_size * BPLUS_TREE_MERGE_FACTOR)
+        # pageno -> 已经加载的节点，保证同一个页在内存中只有一个节点对象，
+        # 否则，通过 next_leaf 和通过 children 访问到的会是两个不同的副本
+        self.nodes = {}
+        # pageno -> 被修改过、还没有写回磁盘的节点
+        self.dirty_nodes = {}
+        # 当前正在执行的修改操作所对应的 redo 日志的 LSN
+        self.lsn = 0
+        # 每次分裂、合并等改变树结构的操作之后加一，游标据此判断是否需要重新定位
+        self.version = 0
         if root_node is None:
             # 是一个新的b+树，也就是create index 过程
             self.node_count = 0
+            self.free_pageno = INVALID_PAGENO
             self.root = self.allocate_node(is_leaf=True)
+            # 文件头中记录的根节点页号，新的b+树还没有写过文件头
+            self.root_pageno = None
         else:
             # 由于走到这个分支的b+树，不是新的b+树，因此，我们
-            # 需要从磁盘里的文件大小进行计算
+            # 需要从磁盘里的文件大小（以及 buffer pool 中新分配的页）进行计算
             self.root = root_node
-            self.node_count = count_pages(filename)
-
-        self.filename = filename
+            self.nodes[root_node.pageno] = root_node
+            self.node_count = index_tuple_get_pages(index_name)
+            self.root_pageno, self.free_pageno = read_index_header(index_name)
+            assert self.root_pageno == root_node.pageno
+        # 文件头中记录的空闲链表
+        self.header_free_pageno = self.free_pageno
+
+        self.index_name = index_name
+        self.filename = get_index_filename(index_name) if index_name else None
+        # 同一个打开的索引会被多个会话共享，读写都要加锁
+        self.mutex = threading.RLock()
 
     def allocate_node(self, is_leaf):
         node = BPlusTreeNode(is_leaf)
-        node.pageno = self.node_count
+        if self.free_pageno != INVALID_PAGENO:
+            # 优先复用被释放的页
+            node.pageno = self.free_pageno
+            freed = self.dirty_nodes.get(node.pageno)
+            if freed is not None and freed.free:
+                self.free_pageno = freed.next_free
+            else:
+                page = index_tuple_get_page(self.index_name, node.pageno)
+                assert page.page_header.flags == FREE_NODE_FLAG
+                self.free_pageno = page.page_header.reserved
+        else:
+            node.pageno = self.node_count
+            self.node_count += 1
         node.loaded = True
-        self.node_count += 1
+        self.nodes[node.pageno] = node
+        self.mark_dirty(node)
         return node
 
-    def insert(self, key, value):
+    def free_node(self, node):
+        """把节点所在的页放到空闲链表的头部，之后分配节点时复用"""
+        freed = BPlusTreeNode(node.is_leaf)
+        freed.pageno = node.pageno
+        freed.free = True
+        freed.next_free = self.free_pageno
+        self.free_pageno = node.pageno
+        self.nodes.pop(node.pageno, None)
+        node.unload()
+        self.mark_dirty(freed)
+
+    def trim_cache(self):
+        if len(self.nodes) <= BPLUS_TREE_CACHED_NODES:
+            return
+        for pageno, node in list(self.nodes.items()):
+            if node.is_leaf and node is not self.root and pageno not in self.dirty_nodes:
+                node.unload()
+                del self.nodes[pageno]
+
+    def mark_dirty(self, node):
+        # 与数据页一样，节点中记录最近一次修改它的 LSN, 恢复时据此判断是否需要重放
+        node.lsn = max(node.lsn, self.lsn)
+        self.dirty_nodes[node.pageno] = node
+
+    def insert(self, key, value, lsn=0):
         if key is None:
             raise BPlusTreeError('invalid key')
-
-        # 直接插入叶子节点中
-        node = self.find_leaf_node(key)
-        # 正因为，调用了下面的函数，我们可以保证，插入过程是
-        # 有序的，因为该函数，寻找的是最右边的相同的key的下标，
-        # 如果没有找到 0
+        key = normalize_key(key)
+        self.lsn = lsn
+        if len(key) > self.max_key_size:
+            raise BPlusTreeError(f'the key is too long, the maximum is {self.max_key_size} bytes.')
+
+        # 直接插入叶子节点中，相同的 key 插入到最右边，保持插入的先后顺序
+        # path 记录下降过程中经过的内部节点，分裂时沿着它向上回溯
+        path = []
+        node = self.find_leaf_node(key, rightmost=True, path=path)
         index = self._find_rightmost_key_index(node, key)
         node.keys.insert(index, key)
         node.values.insert(index, value)
+        self.mark_dirty(node)
 
         # 分裂，也就是不断递归，向父节点插入元素的过程
         if self._need_split(node):
-            self._split(node)
-
-    def _split(self, node):
-        """用于调整B+树的结构，用于做节点的分裂"""
-        middle_index = len(node.keys) // 2
-        # 把当前的 node 节点，拆分成相等元素的两个节点
-        # 这块在工程上可能有不同的发挥和改良
-        right_node = self.allocate_node(is_leaf=node.is_leaf)
-        left_node = node
-
-        # 拆分完之后，就要导数据
+            self._split(node, path)
+
+    def _split(self, node, path):
+        """用于调整B+树的结构，用于做节点的分裂.
+        path 是从根节点到 node 的父节点的 (内部节点, node 在其中的下标) 列表
+        """
+        self.version += 1
+        middle_index = self._split_index(node)
+        # 把当前的 node 节点，拆分成大小相近的两个节点
         # 新节点就是右节点，原来的旧节点就是左节点
         # 我们这里面之所以复用原来的节点，是因为传入的参数是一个引用（指针）
         # 如果直接用新的节点进行替换，出现找不到节点的问题
-        right_node.keys.extend(node.keys[middle_index:])
-        right_node.children.extend(node.children[middle_index:])
-        right_node.values.extend(node.values[middle_index:])
-        right_node.next_leaf = node.next_leaf
+        right_node = self.allocate_node(is_leaf=node.is_leaf)
+        right_node.lsn = node.lsn
+        left_node = node
 
-        left_node.keys = node.keys[:middle_index]
-        left_node.children = node.children[:middle_index]
-        left_node.values = node.values[:middle_index]
-        left_node.next_leaf = right_node
+        if node.is_leaf:
+            # 叶子节点：右节点的第一个 key 复制一份到父节点中，作为分隔符
+            separator = node.keys[middle_index]
+            right_node.keys.extend(node.keys[middle_index:])
+            right_node.values.extend(node.values[middle_index:])
+            right_node.next_leaf = node.next_leaf
+            right_node.prev_leaf = left_node
+            next_node = self.load_node(node.next_leaf)
+            if next_node is not None:
+                next_node.prev_leaf = right_node
+                self.mark_dirty(next_node)
+            left_node.keys = node.keys[:middle_index]
+            left_node.values = node.values[:middle_index]
+            left_node.next_leaf = right_node
+        else:
+            # 内部节点：中间的 key 上移到父节点中，不再保留在左右节点里，
+            # 这样，左右两个节点仍然满足 len(children) == len(keys) + 1
+            separator = node.keys[middle_index]
+            right_node.keys.extend(node.keys[middle_index + 1:])
+            right_node.children.extend(node.children[middle_index + 1:])
+            left_node.keys = node.keys[:middle_index]
+            left_node.children = node.children[:middle_index + 1]
+        self.mark_dirty(left_node)
 
         assert len(left_node.keys) > 0 and len(right_node.keys) > 0
-        assert tuple(left_node.keys) < tuple(right_node.keys)
+        # 允许重复的 key, 因此左节点的最大值可以等于右节点的最小值
+        assert not right_node.keys[0] < left_node.keys[-1]
 
-        if node is self.root:
+        if not path:
+            assert node is self.root
             new_root = self.allocate_node(is_leaf=False)
-            new_root.keys.append(right_node.keys[0])
+            new_root.keys.append(separator)
             new_root.children.extend([left_node, right_node])
             self.root = new_root
         else:
-            parent = self._find_parent(self.root, node)
-            index = parent.children.index(node)
-            parent.keys.insert(index, right_node.keys[0])
-            # parent.children[index] = left_node
+            # 父节点就是下降路径上的最后一个节点，不需要再从根节点开始查找
+            parent, index = path.pop()
+            parent.keys.insert(index, separator)
             parent.children.insert(index + 1, right_node)
+            self.mark_dirty(parent)
 
             if self._need_split(parent):
-                self._split(parent)
+                self._split(parent, path)
 
-    @staticmethod
-    def _need_split(node):
-        # 这里是随便写的，意思是，B+树节点中的元素数量，如果大于这个值
-        # 那么就分裂
-        return len(node.keys) > 10
+    def _need_split(self, node):
+        # 按照节点序列化之后的大小，而不是 key 的个数来判断，
+        # 键越短，一个节点中能放下的键就越多
+        return node.serialized_size() > self.max_node_size
 
+    @staticmethod
+    def _split_index(node):
+        """按照字节数，而不是 key 的个数，把节点分成大小相近的两半，
+        返回右节点（叶子节点）或者上移的 key（内部节点）的下标
+        """
+        overhead = node.record_overhead()
+        total = sum(map(len, node.keys)) + overhead * len(node.keys)
+        size = 0
+        index = 0
+        while index < len(node.keys) and size * 2 < total:
+            size += len(node.keys[index]) + overhead
+            index += 1
+        # 内部节点的 keys[index] 会被上移，右节点至少还要保留一个 key
+        upper = len(node.keys) - 1 if node.is_leaf else len(node.keys) - 2
+        return max(1, min(index, upper))
+
+    # 内部节点中，children[i] 中的 key 都位于 [keys[i - 1], keys[i]] 之间，
+    # 由于允许重复的 key, 两端都是闭区间。
+    # 节点内的 key 是有序的，都使用二分查找：
+    #   bisect_left: 第一个 >= key 的下标，用于寻找最左边的相同 key;
+    #   bisect_right: 第一个 > key 的下标，用于寻找最右边的相同 key 的下一个位置。
     @staticmethod
     def _find_rightmost_key_index(node, key):
         # 假如：
         # node.keys: [ 1,   3,  10,      100]
         #            /    |   |      \         \
         #  [ -1, 0 ]     [2] [7]   [11, 15, 99] [101]   -> children
-
-        # 寻找小于等于key的最大下标 i
-        i = 0
-        while i < len(node.keys):
-            if node.keys[i] <= key:
-                i += 1
-            else:
-                return i
-        return i
+        return bisect.bisect_right(node.keys, key)
 
     @staticmethod
     def _find_leftmost_key_index(node, key):
-        # 寻找 key <= node.keys 中最小值时的下标 i
-        # 他有更高效实现方法：
-        # 二分查找，但是二分查找，不能解决相同元素的情况，例如：
+        # 例如：
         # 元素值   [1,2,2,2,3,3,4,5,6]
         # 元素下标 [0,1,2,3,4,5,6,7,8]
-        # leetcode 的算法题：寻找二分搜索的最大/小值
-        i = 0
-        while i < len(node.keys):
-            if key <= node.keys[i]:
-                return i
-            i += 1
-        return len(node.keys)
-
-    def _find_parent(self, current, target):
-        if current.is_leaf or target in current.children:
-            return current
-
-        for child in current.children:
-            if target in child.children:
-                return self._find_parent(child, target)
-        return None
-
-    def delete(self, key, value=None):
-        node = self.find_leaf_node(key)
+        # key = 2 时，leftmost 为 1, rightmost 为 4
+        return bisect.bisect_left(node.keys, key)
+
+    def delete(self, key, value=None, lsn=0):
+        key = normalize_key(key)
+        self.lsn = lsn
+        # 每次删除一个元素之后，树的结构可能发生变化，因此从根节点重新下降
+        while self._delete_one(key, value):
+            pass
+
+    def _delete_one(self, key, value):
+        """删除一个 key 相等（value 不为 None 时 value 也相等）的元素，没有找到时返回 False"""
+        path = []
+        node = self.find_leaf_node(key, path=path)
         while node:
-            indexes = list(self._find_indexes(node.keys, key))
-            if len(indexes) == 0:
-                break
-            # 如何去解决删除一个元素后，对应的下标移位的问题
-            i = 0
-            deleted_count = 0
-            while i < len(indexes):
-                index = indexes[i]
-                actual_index = index - deleted_count
+            start = self._find_leftmost_key_index(node, key)
+            end = self._find_rightmost_key_index(node, key)
+            for i in range(start, end):
                 # 跳过 value 不等于参数的 key
-                if value is not None:
-                    if node.values[actual_index] != value:
-                        i += 1
-                        continue
-                node.keys.pop(actual_index)
-                node.values.pop(actual_index)
-                i += 1
-                deleted_count += 1
-
-            node = node.next_leaf
-            node = self.load_node(node)
-        # 准确来说，此时还应该补充一个合并机制(coalesce)，即把小于 n/2 的
-        # node进行合并
+                if value is not None and node.values[i] != value:
+                    continue
+                del node.keys[i]
+                del node.values[i]
+                self.mark_dirty(node)
+                self._rebalance(node, path)
+                return True
+            # 相同的 key 可能一直延续到下一个叶子节点
+            if end < len(node.keys):
+                break
+            node = self._next_leaf(node, path)
+        return False
+
+    def _rebalance(self, node, path):
+        """节点变小之后，与兄弟节点合并，或者从兄弟节点借用元素.
+        path 是从根节点到 node 的父节点的 (内部节点, node 在其中的下标) 列表
+        """
+        if not path:
+            assert node is self.root
+            # 根节点只剩下一个 child 时，树的高度降低一层
+            if not node.is_leaf and len(node.children) == 1:
+                self.version += 1
+                self.root = self.load_node(node.children[0])
+                self.free_node(node)
+            return
+        if node.serialized_size() >= self.min_node_size:
+            return
+
+        parent, index = path.pop()
+        if len(parent.children) == 1:
+            self._rebalance(parent, path)
+            return
+        # 优先选择右边的兄弟节点，node 是最后一个 child 时选择左边的
+        if index + 1 < len(parent.children):
+            separator_index = index
+        else:
+            separator_index = index - 1
+        left = self.load_node(parent.children[separator_index])
+        right = self.load_node(parent.children[separator_index + 1])
+        separator = parent.keys[separator_index]
+        self.version += 1
+
+        merged_size = left.serialized_size() + right.serialized_size() - PageHeader.size()
+        if not left.is_leaf:
+            # 内部节点合并时，父节点中的分隔符下移
+            merged_size += len(separator)
+        if merged_size <= self.max_node_size:
+            self._merge(left, right, separator)
+            del parent.keys[separator_index]
+            del parent.children[separator_index + 1]
+            self.free_node(right)
+            self.mark_dirty(left)
+            self.mark_dirty(parent)
+            self._rebalance(parent, path)
+        elif self._redistribute(left, right, parent, separator_index):
+            self.mark_dirty(left)
+            self.mark_dirty(right)
+            self.mark_dirty(parent)
+
+    def _merge(self, left, right, separator):
+        """把 right 中的元素都合并到 left 中"""
+        if left.is_leaf:
+            left.keys.extend(right.keys)
+            left.values.extend(right.values)
+            left.next_leaf = right.next_leaf
+            next_node = self.load_node(right.next_leaf)
+            if next_node is not None:
+                next_node.prev_leaf = left
+                self.mark_dirty(next_node)
+        else:
+            left.keys.append(separator)
+            left.keys.extend(right.keys)
+            left.children.extend(right.children)
+
+    def _redistribute(self, left, right, parent, separator_index):
+        """按照字节数，在相邻的两个节点之间重新分配元素，并替换父节点中的分隔符.
+        新的分隔符可能比原来的长得多，重新分配之后任何一个节点放不下时，
+        保持原样（节点只是不够满）并返回 False
+        """
+        separator = parent.keys[separator_index]
+        combined = BPlusTreeNode(left.is_leaf)
+        new_left = BPlusTreeNode(left.is_leaf)
+        new_right = BPlusTreeNode(left.is_leaf)
+        if left.is_leaf:
+            combined.keys = left.keys + right.keys
+            combined.values = left.values + right.values
+            middle_index = self._split_index(combined)
+            new_left.keys = combined.keys[:middle_index]
+            new_left.values = combined.values[:middle_index]
+            new_right.keys = combined.keys[middle_index:]
+            new_right.values = combined.values[middle_index:]
+            new_separator = new_right.keys[0]
+        else:
+            # 与分裂一样，内部节点的 keys[middle_index] 上移到父节点中
+            combined.keys = left.keys + [separator] + right.keys
+            combined.children = left.children + right.children
+            middle_index = self._split_index(combined)
+            new_left.keys = combined.keys[:middle_index]
+            new_left.children = combined.children[:middle_index + 1]
+            new_right.keys = combined.keys[middle_index + 1:]
+            new_right.children = combined.children[middle_index + 1:]
+            new_separator = combined.keys[middle_index]
+
+        parent_size = parent.serialized_size() - len(separator) + len(new_separator)
+        if (self._need_split(new_left) or self._need_split(new_right)
+                or parent_size > self.max_node_size):
+            return False
+        left.keys, right.keys = new_left.keys, new_right.keys
+        if left.is_leaf:
+            left.values, right.values = new_left.values, new_right.values
+        else:
+            left.children, right.children = new_left.children, new_right.children
+        parent.keys[separator_index] = new_separator
+        return True
 
     def find(self, key):
-        values = []
-        node = self.find_leaf_node(key)
-        while node:
-            indexes = list(self._find_indexes(node.keys, key))
-            if len(indexes) == 0:
-                break
-            for index in indexes:
-                values.append(node.values[index])
-            node = node.next_leaf
-            node = self.load_node(node)
-        return values
+        key = normalize_key(key)
+        return [value for _, value in self.cursor(key, key, True, True)]
 
-    def find_range(self, start=float('-inf'), end=float('inf'), return_keys=False):
+    def find_range(self, start=MIN_KEY, end=MAX_KEY, return_keys=False):
         # select * from t1 where a > 100;
-        # 不包含等值
-        # 因为，对于等值，可以直接补充等值查询即可
-        # 算法复杂度没有新增多少
-        values = []
-        node = self.find_leaf_node(start)
-        while node:
-            for index, key in enumerate(node.keys):
-                # 提前退出
-                if key >= end:
-                    break
-                # 如果我们不在上面指定trick start=-inf, ...
-                # 那么我们就要判断 start/end 是否为 None
-                if start < key < end:
-                    if return_keys:
-                        values.append(key)
-                    else:
-                        values.append(node.values[index])
-            node = node.next_leaf
-            node = self.load_node(node)
-        return values
-
-    def find_leaf_node(self, key):
-        """寻找最左边的叶子节点（我们B+树是按照从小到大组织数据的）"""
-        node = self.root
-        while node and not node.is_leaf:
-            node = self.load_node(node)
-            index = self._find_leftmost_key_index(node, key)
-            # 如果没有这样的 index, 则 node 为最后一个子节点
-            if index >= len(node.keys):
-                node = node.children[-1]
-            # 对于唯一key，应该使用下述方法，但是不唯一的key
-            # 会很麻烦，不能直接使用下述代码
-            # elif key == node.keys[index]:
-            #     node = node.get_child(index + 1)
+        # 不包含等值，需要包含等值时，使用 cursor() 并指定 start_inclusive/end_inclusive
+        # return_keys 为 True 时，返回编码之后的键，可以通过 decode_key() 还原
+        return [key if return_keys else value
+                for key, value in self.cursor(start, end)]
+
+    def cursor(self, start=MIN_KEY, end=MAX_KEY, start_inclusive=False, end_inclusive=False,
+               reverse=False):
+        return BPlusTreeCursor(self, start, end, start_inclusive, end_inclusive, reverse)
+
+    def find_leaf_node(self, key, rightmost=False, path=None):
+        """寻找 key 所在的最左边（rightmost 为 True 时为最右边）的叶子节点
+        （我们B+树是按照从小到大组织数据的）
+        path 不为 None 时，依次追加下降过程中经过的 (内部节点, child 的下标)
+        """
+        node = self.load_node(self.root)
+        while not node.is_leaf:
+            if rightmost:
+                index = self._find_rightmost_key_index(node, key)
             else:
-                node = node.get_child(index)
-
-        while node.keys and node.keys[-1] < key and node.next_leaf:
-            node = node.next_leaf
-            node = self.load_node(node)
+                index = self._find_leftmost_key_index(node, key)
+            if path is not None:
+                path.append((node, index))
+            node = self.load_node(node.children[index])
+
+        # 由于 key 可以重复，分隔符等于 key 时，最左边的 key 可能在下一个叶子节点中
+        while (not rightmost and node.keys and node.keys[-1] < key
+               and node.next_leaf):
+            node = self._next_leaf(node, path)
         return node
 
-    @staticmethod
-    def _find_indexes(keys, key):
-        for i, k in enumerate(keys):
-            if key == k:
-                yield i
-            # 这样可以做个剪枝
-            elif k > key:
-                break
+    def _next_leaf(self, node, path=None):
+        """返回右边相邻的叶子节点；path 不为 None 时，同时把它更新为到达该叶子节点的路径"""
+        if path is None:
+            return self.load_node(node.next_leaf)
+        while path:
+            parent, index = path.pop()
+            if index + 1 < len(parent.children):
+                path.append((parent, index + 1))
+                node = self.load_node(parent.children[index + 1])
+                while not node.is_leaf:
+                    path.append((node, 0))
+                    node = self.load_node(node.children[0])
+                return node
+        return None
 
     def load_node(self, node: BPlusTreeNode):
         if node is None:
             return None
         if node.loaded:
             return node
+        if node.pageno in self.nodes:
+            return self.nodes[node.pageno]
 
-        # 开始真正加载数据
-        page = load_page_from_disk(self.filename, node.pageno)
+        # 开始真正加载数据，索引页与数据页一样，经过 buffer pool
+        page = index_tuple_get_page(self.index_name, node.pageno)
         node.from_page(page)
+        self.nodes[node.pageno] = node
         return node
 
     def serialize(self):
+        """只处理修改过的节点，代价与索引的大小无关：
+        新建的b+树（create index）直接写入索引文件；
+        否则，把修改过的节点重新生成为页，替换 buffer pool 中的版本并标记为脏页，
+        与数据页一样，由 checkpoint 写回磁盘。
+        根节点变化时，把该索引的脏页与新的文件头一起原子地写回磁盘，见 flush().
+        只有空闲链表变化时，文件头由 checkpoint 与脏页一起写出，见 IndexManager.sync().
+        """
         assert self.filename
 
-        # 遍历树的节点
-        nodes = []
-        queue = [self.root]
-        while len(queue) > 0:
-            node = queue.pop(0)  # 拿第一个节点
-            # 等价于for 遍历children
-            if not node.is_leaf:
-                queue.extend(node.children)
-
-            nodes.append(node)
-
-        nodes.sort(key=lambda n: n.pageno)
-
-        # 校验所有node都有pageno，且赋值正确
-        for i in range(len(nodes)):
-            assert i == nodes[i].pageno
-
-        with open(self.filename, 'w+b') as f:
-            root_node_pageno = self.root.pageno
-            f.write(
-                int.to_bytes(root_node_pageno,
-                             HEADER_SIZE,
-                             LITTLE_ORDER,
-                             signed=False)
-            )
-            for node in nodes:
-                f.write(node.to_page().serialize())
-            # 是一个系统调用，确保文件能够刷到磁盘里
-            # 如果没有刷进去，就一直等着 blocking
-            os.fsync(f.fileno())
+        if self.root_pageno is None:
+            # 重新创建索引时，丢弃文件以及 buffer pool 中原有的内容
+            buffer_pool.discard(self.index_name)
+            index_tuple_discard_doublewrite(self.index_name)
+            smgr.truncate(self.filename, 0)
+            for pageno in sorted(self.dirty_nodes):
+                smgr.write(self.filename, HEADER_SIZE + pageno * PAGE_SIZE,
+                           self.dirty_nodes[pageno].to_page().serialize())
+        else:
+            for pageno in sorted(self.dirty_nodes):
+                index_tuple_put_page(self.index_name, pageno,
+                                     self.dirty_nodes[pageno].to_page())
+        self.dirty_nodes.clear()
+
+        if self.root.pageno != self.root_pageno:
+            self.flush()
+
+    def header_changed(self):
+        return (self.root.pageno, self.free_pageno) != (self.root_pageno, self.header_free_pageno)
+
+    def flush(self):
+        """把该索引的脏页与文件头一起原子地写回磁盘（其中包括 fsync），修改过的节点需要先 serialize()"""
+        index_relations.add(self.index_name)
+        index_tuple_flush(self.index_name, (self.root.pageno, self.free_pageno))
+        self.root_pageno = self.root.pageno
+        self.header_free_pageno = self.free_pageno
 
     @staticmethod
-    def deserialize(filename):
-        # 做一个判断
-        with open(filename, 'rb') as f:
-            file_size = os.fstat(f.fileno()).st_size
-            assert (file_size - HEADER_SIZE) % PAGE_SIZE == 0
-        return BPlusTree(filename, load_root_node(filename))
+    def deserialize(index_name):
+        return BPlusTree(index_name, load_root_node(index_name))
+
+
+def bulk_load(index_name, items, fill_factor=BPLUS_TREE_FILL_FACTOR, lsn=0) -> BPlusTree:
+    """自底向上地构建b+树，用于 create index.
+    items 是按照 (key, location) 排好序的迭代器，key 是编码之后的字节串。
+    先按照 fill_factor 依次装满叶子节点，再逐层构建内部节点，
+    页号按照构建的顺序分配，因此，整个索引文件是顺序写出的，不经过 buffer pool.
+    内存中只保留正在构建的节点，以及上一层节点的 (最小的 key, 页号).
+    """
+    max_node_size, max_key_size = node_size_limits(fill_factor)
+    filename = get_index_filename(index_name)
+    # 重新创建索引时，丢弃文件以及 buffer pool 中原有的内容
+    buffer_pool.discard(index_name)
+    index_tuple_discard_doublewrite(index_name)
+    smgr.truncate(filename, 0)
+
+    pending = []
+    written_pages = 0
+
+    def flush():
+        nonlocal written_pages
+        if pending:
+            smgr.write(filename, HEADER_SIZE + written_pages * PAGE_SIZE, b''.join(pending))
+            written_pages += len(pending)
+            pending.clear()
+
+    def emit(node):
+        node.lsn = lsn
+        pending.append(node.to_page().serialize())
+        if len(pending) >= BULK_LOAD_WRITE_PAGES:
+            flush()
+
+    def new_node(is_leaf, pageno):
+        node = BPlusTreeNode(is_leaf)
+        node.pageno = pageno
+        node.loaded = True
+        return node
+
+    # 第一层：叶子节点，level 中记录每个节点的 (最小的 key, 页号)
+    level = []
+    node = new_node(True, 0)
+    overhead = node.record_overhead()
+    size = PageHeader.size()
+    for key, location in items:
+        if len(key) > max_key_size:
+            raise BPlusTreeError(f'the key is too long, the maximum is {max_key_size} bytes.')
+        if node.keys and size + overhead + len(key) > max_node_size:
+            # 下一个叶子节点的页号一定紧跟在当前节点之后
+            node.next_leaf = BPlusTreeNode()
+            node.next_leaf.pageno = node.pageno + 1
+            emit(node)
+            level.append((node.keys[0], node.pageno))
+            node = new_node(True, node.pageno + 1)
+            node.prev_leaf = BPlusTreeNode()
+            node.prev_leaf.pageno = node.pageno - 1
+            size = PageHeader.size()
+        node.keys.append(key)
+        node.values.append(location)
+        size += overhead + len(key)
+    emit(node)
+    level.append((node.keys[0] if node.keys else MIN_KEY, node.pageno))
+    next_pageno = node.pageno + 1
+
+    # 逐层向上构建内部节点，直到只剩下一个根节点
+    overhead = Slot.size() + INTERNAL_RECORD.size
+    while len(level) > 1:
+        groups = [[level[0]]]
+        size = PageHeader.size() + overhead
+        for child in level[1:]:
+            # 每个 child 对应一个分隔符，即该 child 中最小的 key
+            if size + overhead + len(child[0]) > max_node_size:
+                groups.append([child])
+                size = PageHeader.size() + overhead
+            else:
+                groups[-1].append(child)
+                size += overhead + len(child[0])
+        if len(groups) > 1 and len(groups[-1]) == 1:
+            # 内部节点至少要有两个 child, 从前一个节点中挪一个过来
+            groups[-1].insert(0, groups[-2].pop())
+
+        upper_level = []
+        for group in groups:
+            node = new_node(False, next_pageno)
+            next_pageno += 1
+            for i, (low_key, pageno) in enumerate(group):
+                child = BPlusTreeNode()
+                child.pageno = pageno
+                node.children.append(child)
+                if i > 0:
+                    node.keys.append(low_key)
+            emit(node)
+            upper_level.append((group[0][0], node.pageno))
+        level = upper_level
+    flush()
+
+    # 与 serialize() 一样，页都落盘之后，再写入文件头中的根节点页号
+    smgr.fsync(filename)
+    smgr.write(filename, 0, INDEX_HEADER.pack(level[0][1], INVALID_PAGENO))
+    smgr.fsync(filename)
+    return BPlusTree(index_name, load_root_node(index_name), fill_factor)
+
+
+class BPlusTreeCursor:
+    """沿着叶子节点链表，惰性地返回 [start, end] 范围内的 (编码之后的键, value),
+    reverse 为 True 时沿着 prev_leaf 从大到小返回.
+    每次只在锁的保护下复制一个叶子节点中的元素，消费者可以随时停止迭代，
+    因此，扫描很大的范围时内存占用与范围的大小无关，也不会长时间持有索引的锁.
+    两次复制之间，树的结构发生变化（tree.version 改变）时，按照最后返回的键重新定位.
+    """
+
+    def __init__(self, tree, start=MIN_KEY, end=MAX_KEY, start_inclusive=False, end_inclusive=False,
+                 reverse=False):
+        self.tree = tree
+        self.start = normalize_key(start)
+        self.end = normalize_key(end)
+        self.start_inclusive = start_inclusive
+        self.end_inclusive = end_inclusive
+        self.reverse = reverse
+        self.batch = []
+        self.position = 0
+        # 上一次复制的叶子节点，以及当时的 tree.version
+        self.leaf = None
+        self.version = None
+        # 最后复制的键，以及已经复制过的、与它相等的元素的 value.
+        # 重新定位之后，相同的键可能跨越多个叶子节点，复制时总是跳过其中已经返回过的元素
+        self.last_key = None
+        self.last_key_values = set()
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.position >= len(self.batch):
+            if self.finished:
+                raise StopIteration
+            self._fetch()
+        item = self.batch[self.position]
+        self.position += 1
+        return item
+
+    def close(self):
+        self.finished = True
+        self.batch = []
+        self.position = 0
+
+    def _step(self, node):
+        if self.reverse:
+            return self.tree.load_node(node.prev_leaf)
+        return self.tree._next_leaf(node)
+
+    def _locate(self):
+        """返回 (叶子节点, 开始复制的下标)，下标为 None 时由范围的边界决定"""
+        tree = self.tree
+        if self.leaf is None:
+            if self.reverse:
+                return tree.find_leaf_node(self.end, rightmost=self.end_inclusive), None
+            return tree.find_leaf_node(self.start, rightmost=not self.start_inclusive), None
+        if self.version == tree.version:
+            # 叶子节点没有被释放或者拆分过，直接访问相邻的叶子节点
+            return self._step(tree.load_node(self.leaf)), None
+        node = tree.find_leaf_node(self.last_key, rightmost=self.reverse)
+        if self.reverse:
+            return node, bisect.bisect_right(node.keys, self.last_key)
+        return node, bisect.bisect_left(node.keys, self.last_key)
+
+    def _fetch(self):
+        tree = self.tree
+        with tree.mutex:
+            node, index = self._locate()
+            self.batch = []
+            self.position = 0
+            while node is not None:
+                if self.start_inclusive:
+                    lo = bisect.bisect_left(node.keys, self.start)
+                else:
+                    lo = bisect.bisect_right(node.keys, self.start)
+                if self.end_inclusive:
+                    hi = bisect.bisect_right(node.keys, self.end)
+                else:
+                    hi = bisect.bisect_left(node.keys, self.end)
+                if index is not None:
+                    if self.reverse:
+                        hi = min(hi, index)
+                    else:
+                        lo = max(lo, index)
+                    index = None
+                if lo < hi:
+                    self.batch = list(zip(node.keys[lo:hi], node.values[lo:hi]))
+                    if self.last_key_values and node.keys[hi - 1 if self.reverse else lo] == self.last_key:
+                        self.batch = [(key, value) for key, value in self.batch
+                                      if not (key == self.last_key and value in self.last_key_values)]
+                    if self.reverse:
+                        self.batch.reverse()
+                # 提前退出：范围的另一端就在当前叶子节点中
+                if (lo > 0) if self.reverse else (hi < len(node.keys)):
+                    self.finished = True
+                    break
+                if self.batch:
+                    break
+                node = self._step(node)
+            else:
+                self.finished = True
+            self.leaf = node
+            self.version = tree.version
+            self._remember_last_key()
+            tree.trim_cache()
+
+    def _remember_last_key(self):
+        if not self.batch:
+            return
+        last_key = self.batch[-1][0]
+        if last_key != self.last_key:
+            self.last_key = last_key
+            self.last_key_values = set()
+        for key, value in reversed(self.batch):
+            if key != last_key:
+                break
+            self.last_key_values.add(value)
+
+
+class IndexManager:
+    """进程内打开的索引 (index_name -> BPlusTree)，在多个会话之间共享。
+    根节点、页数等元数据以及内部节点都保留在内存中，每次访问索引时不需要重新打开文件、读取文件头。
+    索引被重建、删除（DDL）时，需要调用 invalidate().
+    """
+
+    def __init__(self):
+        self.trees = {}
+        self.mutex = threading.Lock()
+
+    def get(self, index_name) -> BPlusTree:
+        with self.mutex:
+            tree = self.trees.get(index_name)
+            if tree is None:
+                tree = BPlusTree(index_name, load_root_node(index_name))
+                self.trees[index_name] = tree
+            return tree
+
+    def set(self, index_name, tree):
+        with self.mutex:
+            self.trees[index_name] = tree
+
+    def invalidate(self, index_name=None):
+        with self.mutex:
+            if index_name is None:
+                self.trees.clear()
+            else:
+                self.trees.pop(index_name, None)
+
+    def sync(self):
+        """checkpoint 时调用，把每个索引的脏页与文件头（空闲链表）一起原子地写回"""
+        with self.mutex:
+            trees = dict(self.trees)
+        for index_name, tree in trees.items():
+            with tree.mutex:
+                if tree.filename and tree.root_pageno is not None:
+                    if tree.header_changed() or any(
+                            key[0] == index_name for key in buffer_pool.dirty_pages):
+                        tree.flush()
+        # 没有打开的索引（例如已经被 invalidate）也可能留有脏页，文件头保持不变
+        for index_name in {key[0] for key in buffer_pool.dirty_pages} & index_relations:
+            if index_name not in trees:
+                index_tuple_flush(index_name)
+
+    @contextmanager
+    def acquire(self, index_name):
+        """with index_mgr.acquire(index_name) as tree: ...
+        在锁的保护下访问索引，结束时释放多余的已解码节点
+        """
+        tree = self.get(index_name)
+        with tree.mutex:
+            try:
+                yield tree
+            finally:
+                tree.trim_cache()
+
+
+index_mgr = IndexManager()
@@ -1,25 +1,31 @@
 import os
-import pickle
+import struct
+
+from functools import partial
 
 from imoocdb.constant import DATA_DIRECTORY
+from imoocdb.storage.compression import compression_mgr, fsync_directory, write_file
 from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.readahead import readahead
+from imoocdb.storage.row_format import encode_tuple, decode_tuple
 from imoocdb.storage.slotted_page import PAGE_SIZE, Page
+from imoocdb.storage.smgr import smgr
 
 
 def get_table_filename(table_name):
-    if not os.path.exists(DATA_DIRECTORY):
-        os.mkdir(DATA_DIRECTORY)
+    smgr.ensure_directory(DATA_DIRECTORY)
     return os.path.join(DATA_DIRECTORY, table_name + '.tbl')
 
 
 def table_tuple_get_disk_pages(table_name):
-    filename = get_table_filename(table_name)
-    if not os.path.exists(filename):
-        return 0
-
-    if os.stat(filename).st_size > 0:
-        assert os.stat(filename).st_size % PAGE_SIZE == 0
-    return os.stat(filename).st_size // PAGE_SIZE
+    extent_map = compression_mgr.get(table_name)
+    if extent_map is not None:
+        # 压缩表中的页是变长的，页数以 extent map 为准
+        return len(extent_map)
+    # 文件大小由 smgr 在内存中维护，不需要每次都 stat
+    file_size = smgr.size(get_table_filename(table_name))
+    assert file_size % PAGE_SIZE == 0
+    return file_size // PAGE_SIZE
 
 
 def table_tuple_get_pages(table_name):
@@ -32,18 +38,19 @@ def table_tuple_get_pages(table_name):
 def table_tuple_get_page(table_name, pageno):
     key = (table_name, pageno)
     if key not in buffer_pool:
+        if key in buffer_pool.lru_cache.evicted:
+            # 被淘汰出去的页可能是还没有写回磁盘的脏页，
+            # 此时必须使用内存中的版本，而不是磁盘上的旧版本
+            buffer_pool[key] = buffer_pool.lru_cache.evicted.pop(key)
         # 是否磁盘里面已经包含了数据页，但是没有加载到内存中
-        if pageno < table_tuple_get_disk_pages(table_name):
+        elif pageno < table_tuple_get_disk_pages(table_name):
             # 意味着磁盘里面已经有该数据页了，需要先从磁盘里面加载
             # 到内存中
-            filename = get_table_filename(table_name)
-            if not os.path.exists(filename):
-                return None
-
-            with open(filename, 'rb') as f:
-                f.seek(pageno * PAGE_SIZE)
-                buff = f.read(PAGE_SIZE)
-                page = Page.deserialize(buff)
+            # 优先使用后台线程预读好的缓冲区
+            buff = readahead.take(table_name, pageno)
+            if buff is None:
+                buff = table_tuple_read_page(table_name, pageno)
+            page = Page(buff)
             # 把数据页装载到磁盘里面
             buffer_pool[key] = page
         else:
@@ -56,25 +63,171 @@ def table_tuple_get_page(table_name, pageno):
     return page
 
 
-def tuple_to_bytes(tup):
-    return pickle.dumps(tup)
+def table_tuple_read_page(table_name, pageno):
+    """从磁盘上读取一个页的缓冲区，不经过 buffer pool"""
+    filename = get_table_filename(table_name)
+    extent_map = compression_mgr.get(table_name)
+    if extent_map is None:
+        # pread 方式直接读到新的缓冲区中；mmap 方式则是映射区上的只读视图，
+        # 两种方式都不产生中间的 bytes 对象
+        return smgr.read_page(filename, pageno * PAGE_SIZE, PAGE_SIZE)
+    offset, capacity = extent_map.lookup(pageno)
+    if capacity == 0:
+        return bytearray(PAGE_SIZE)
+    return extent_map.decompress(smgr.read(filename, offset, capacity))
+
+
+def table_tuple_readahead(table_name, pageno):
+    """顺序扫描每访问到一个新的页时调用，由后台线程预读后续的页，
+    对于压缩表，解压也在后台线程中完成
+    """
+    readahead.access(table_name, pageno, table_tuple_get_disk_pages(table_name),
+                     partial(table_tuple_read_page, table_name),
+                     compressed=compression_mgr.get(table_name) is not None)
+
 
+def tuple_to_bytes(tup, codec=None, store_external=None):
+    # 有 codec 的时候，使用由列类型驱动的二进制行格式，否则使用 pickle
+    # store_external 用于把过长的值写到溢出表中
+    return encode_tuple(tup, codec, store_external)
 
-def bytes_to_tuple(bytes_):
-    if len(bytes_) == 0:
-        return ()
-    return pickle.loads(bytes_)
+
+def bytes_to_tuple(bytes_, codec=None, columns=None, fetch_external=None):
+    # columns 为需要解码的列下标，其余列不做反序列化
+    return decode_tuple(bytes_, codec, columns, fetch_external)
 
 
 def get_index_filename(index_name):
-    if not os.path.exists(DATA_DIRECTORY):
-        os.mkdir(DATA_DIRECTORY)
+    smgr.ensure_directory(DATA_DIRECTORY)
     return os.path.join(DATA_DIRECTORY, index_name + '.idx')
 
 
-def sync_table_page(table_name, pageno, page):
+def get_index_doublewrite_filename(index_name):
+    return get_index_filename(index_name) + '.dw'
+
+
+# 索引文件的布局：| 根节点的页号 (8B) | 空闲链表中第一个页的页号 (8B) | page 0 | page 1 | ... |
+INDEX_HEADER = struct.Struct('<QQ')
+INDEX_HEADER_SIZE = INDEX_HEADER.size
+# 索引页之间互相引用（分裂、合并、空闲链表），这些结构变化不记 redo 日志，
+# 因此一个索引的脏页必须与文件头成组地写回，否则中途崩溃会留下一棵撕裂的树。
+# 写回之前，先把这一组页与文件头写到 doublewrite 文件 (<索引名>.idx.dw):
+# | 文件头 (16B) | 页号 (8B) | page | 页号 (8B) | page | ... |
+# 它完整地落盘（原子地替换）之后才开始原地覆盖，覆盖完成并 fsync 之后删除。
+# 崩溃之后，打开索引时根据残留的 doublewrite 文件把覆盖做完
+DOUBLEWRITE_PAGENO = struct.Struct('<Q')
+# 通过 buffer pool 访问过的索引，checkpoint 时据此区分索引页与数据页
+index_relations = set()
+
+
+def index_tuple_get_disk_pages(index_name):
+    file_size = smgr.size(get_index_filename(index_name))
+    if file_size == 0:
+        return 0
+    assert (file_size - INDEX_HEADER_SIZE) % PAGE_SIZE == 0
+    return (file_size - INDEX_HEADER_SIZE) // PAGE_SIZE
+
+
+def index_tuple_get_pages(index_name):
+    # 新分配的索引页在 checkpoint 之前只存在于 buffer pool 中
+    memory_pages = buffer_pool.find_max_pageno(index_name) + 1
+    return max(memory_pages, index_tuple_get_disk_pages(index_name))
+
+
+def index_tuple_get_page(index_name, pageno):
+    """与数据页一样，索引页也缓存在 buffer pool 中，key 为 (index_name, pageno)"""
+    key = (index_name, pageno)
+    index_relations.add(index_name)
+    if key not in buffer_pool:
+        if key in buffer_pool.lru_cache.evicted:
+            buffer_pool[key] = buffer_pool.lru_cache.evicted.pop(key)
+        else:
+            buffer_pool[key] = Page(smgr.read_page(get_index_filename(index_name),
+                                                   INDEX_HEADER_SIZE + pageno * PAGE_SIZE,
+                                                   PAGE_SIZE))
+    return buffer_pool[key]
+
+
+def index_tuple_put_page(index_name, pageno, page):
+    """用修改之后的节点重新生成的页替换 buffer pool 中的版本，并标记为脏页"""
+    key = (index_name, pageno)
+    index_relations.add(index_name)
+    buffer_pool.lru_cache.evicted.pop(key, None)
+    buffer_pool[key] = page
+    buffer_pool.mark_dirty(key)
+
+
+def index_tuple_write_pages(index_name, header, pages):
+    """把一组索引页 [(pageno, page), ...] 与文件头 header (根节点的页号, 空闲链表) 原子地写回"""
+    # WAL: 页中的修改对应的 redo 日志必须先落盘
+    buffer_pool.flush_log(max((page.page_header.lsn for _, page in pages), default=0))
+    chunks = [INDEX_HEADER.pack(*header)]
+    for pageno, page in pages:
+        chunks.append(DOUBLEWRITE_PAGENO.pack(pageno))
+        chunks.append(page.serialize())
+    write_file(get_index_doublewrite_filename(index_name), b''.join(chunks))
+    fsync_directory(DATA_DIRECTORY)
+    index_tuple_finish_doublewrite(index_name)
+
+
+def index_tuple_finish_doublewrite(index_name):
+    """把 doublewrite 文件中的页与文件头写到索引文件中，崩溃之后重复执行也是安全的"""
+    dw_filename = get_index_doublewrite_filename(index_name)
+    if not os.path.exists(dw_filename):
+        return
+    with open(dw_filename, 'rb') as f:
+        buff = memoryview(f.read())
+    filename = get_index_filename(index_name)
+    record_size = DOUBLEWRITE_PAGENO.size + PAGE_SIZE
+    for offset in range(INDEX_HEADER_SIZE, len(buff), record_size):
+        pageno, = DOUBLEWRITE_PAGENO.unpack_from(buff, offset)
+        smgr.write(filename, INDEX_HEADER_SIZE + pageno * PAGE_SIZE,
+                   buff[offset + DOUBLEWRITE_PAGENO.size: offset + record_size])
+    smgr.write(filename, 0, buff[:INDEX_HEADER_SIZE])
+    smgr.fsync(filename)
+    os.remove(dw_filename)
+    fsync_directory(DATA_DIRECTORY)
+
+
+def index_tuple_discard_doublewrite(index_name):
+    # 重新创建索引时，残留的 doublewrite 文件属于旧的索引
+    dw_filename = get_index_doublewrite_filename(index_name)
+    if os.path.exists(dw_filename):
+        os.remove(dw_filename)
+
+
+def index_tuple_read_header(index_name):
+    """返回磁盘上的文件头 (根节点的页号, 空闲链表中第一个页的页号)"""
+    index_tuple_finish_doublewrite(index_name)
+    return INDEX_HEADER.unpack(smgr.read(get_index_filename(index_name), 0, INDEX_HEADER_SIZE))
+
+
+def index_tuple_flush(index_name, header=None):
+    """把某个索引在 buffer pool 中的脏页与文件头一起原子地写回磁盘，
+    header 为 None 时沿用磁盘上的文件头
+    """
+    pages = [(key, page) for key, page in buffer_pool.get_all_dirty_pages()
+             if key[0] == index_name]
+    if header is None:
+        if not pages:
+            return
+        header = index_tuple_read_header(index_name)
+    index_tuple_write_pages(index_name, header, [(key[1], page) for key, page in pages])
+    for key, _ in pages:
+        buffer_pool.unmark_dirty(key)
+
+
+def sync_table_page(table_name, pageno, page, fsync=True):
+    # 通过 pwrite 写到精确的偏移处（追加模式打开文件时，seek 是不起作用的）
     filename = get_table_filename(table_name)
-    with open(filename, 'ab') as f:
-        f.seek(pageno * PAGE_SIZE)
-        f.write(page.serialize())
-        os.fsync(f.fileno())
+    readahead.discard(table_name, pageno)
+    # WAL: 页中的修改对应的 redo 日志必须先落盘
+    buffer_pool.flush_log(page.page_header.lsn)
+    extent_map = compression_mgr.get(table_name)
+    if extent_map is None:
+        smgr.write(filename, pageno * PAGE_SIZE, page.serialize())
+    else:
+        image = extent_map.compress(page.serialize())
+        smgr.write(filename, extent_map.allocate(pageno, len(image)), image)
+    if fsync:
+        smgr.fsync(filename)
@@ -0,0 +1,282 @@
+import lzma
+import os
+import struct
+import threading
+import time
+import zlib
+
+from imoocdb.constant import DATA_DIRECTORY
+from imoocdb.storage.slotted_page import PAGE_SIZE
+
+# 表级别的页压缩：适用于很少被修改的冷数据（例如历史归档表），用 CPU 换 I/O。
+# 开启压缩之后，数据文件中的页不再是定长的 PAGE_SIZE, 而是变长的压缩镜像，
+# 由 extent map (.map 文件) 记录每个页在数据文件中的位置
+COMPRESSION_METHODS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+# .map 文件的布局：| 压缩方法名 (8B) | extent 0 | extent 1 | ... |
+MAP_HEADER = struct.Struct('<8s')
+# extent: 页在数据文件中的偏移，以及为它分配的空间大小
+EXTENT = struct.Struct('<QI')
+# 数据文件中的每个压缩镜像：| 压缩之后的长度 (4B) | 压缩之后的数据 |
+# extent 中记录的是对齐之后分配的空间，镜像的实际长度写在镜像中。
+# 镜像从不原地覆盖：页每次写回都写到新的 extent 中，磁盘上的 map 仍然指向完整的旧镜像，
+# 直到 checkpoint 写出新的 map 之后，旧的 extent 才可以被复用，因此写到一半崩溃也可以恢复
+IMAGE_HEADER = struct.Struct('<I')
+# 按照该粒度分配空间，便于复用被释放的 extent
+EXTENT_ALIGNMENT = 512
+# 开启、关闭压缩时，改写之后的数据文件与新的 extent map 需要成对地替换.
+# 先把 .pending 文件写出并落盘，它就是提交点，其中记录了：
+# | 数据文件名的长度 (2B) | 数据文件名 | 新的 extent map (为空表示关闭压缩) |
+# 之后依次替换数据文件、map, 最后删除 .pending. 崩溃之后，第一次加载该表的 map 时
+# 根据 .pending 把替换做完；没有 .pending 时，残留的改写文件不会被使用
+PENDING_HEADER = struct.Struct('<H')
+
+
+def get_extent_map_filename(table_name):
+    return os.path.join(DATA_DIRECTORY, table_name + '.map')
+
+
+def get_pending_filename(table_name):
+    return os.path.join(DATA_DIRECTORY, table_name + '.map.pending')
+
+
+def get_rewrite_filename(filename):
+    """改写整张表时，新的数据文件先写到这里"""
+    return filename + '.tmp'
+
+
+def fsync_directory(directory):
+    # 重命名、删除文件之后，目录项也需要落盘
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file(filename, data):
+    # 先写临时文件，再原子地替换
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        f.write(data)
+        os.fsync(f.fileno())
+    os.replace(temp_filename, filename)
+
+
+class CompressionStats:
+    """解压可能发生在预读的后台线程中，统计信息的修改需要加锁"""
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.compressed_pages = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_seconds = 0.
+        self.decompressed_pages = 0
+        self.decompress_seconds = 0.
+
+    @property
+    def ratio(self):
+        # 压缩之后的大小 / 压缩之前的大小，越小越好
+        if self.raw_bytes == 0:
+            return 1.
+        return self.compressed_bytes / self.raw_bytes
+
+    def add_compressed(self, raw_bytes, compressed_bytes, seconds):
+        with self.mutex:
+            self.compressed_pages += 1
+            self.raw_bytes += raw_bytes
+            self.compressed_bytes += compressed_bytes
+            self.compress_seconds += seconds
+
+    def add_decompressed(self, seconds):
+        with self.mutex:
+            self.decompressed_pages += 1
+            self.decompress_seconds += seconds
+
+    def to_dict(self):
+        with self.mutex:
+            return {
+                'compressed_pages': self.compressed_pages,
+                'ratio': self.ratio,
+                'compress_seconds': self.compress_seconds,
+                'decompressed_pages': self.decompressed_pages,
+                'decompress_seconds': self.decompress_seconds,
+            }
+
+
+class ExtentMap:
+    """单张压缩表的 extent map: pageno -> (offset, capacity).
+    capacity 为 0 的 extent 表示该页从未写出过，读取时为全 0 的页。
+    """
+
+    def __init__(self, table_name, method, extents=None):
+        if method not in COMPRESSION_METHODS:
+            raise ValueError(f'unknown compression method {method}.')
+        self.table_name = table_name
+        self.method = method
+        self.compress_function, self.decompress_function = COMPRESSION_METHODS[method]
+        self.extents = list(extents or [])
+        self.end = max((offset + capacity for offset, capacity in self.extents), default=0)
+        # 可以复用的空间 [(offset, capacity), ...], 加载时就是 map 中没有被引用的空洞
+        self.free_extents = self._find_holes()
+        # 被替换下来的旧 extent: 磁盘上的 map 可能仍然指向它们，map 落盘之后才能复用
+        self.released_extents = []
+        self.stats = CompressionStats()
+        self.dirty = False
+
+    def _find_holes(self):
+        holes = []
+        position = 0
+        for offset, capacity in sorted(e for e in self.extents if e[1] > 0):
+            if offset > position:
+                holes.append((position, offset - position))
+            position = max(position, offset + capacity)
+        return holes
+
+    def __len__(self):
+        return len(self.extents)
+
+    def lookup(self, pageno):
+        return self.extents[pageno]
+
+    def allocate(self, pageno, image_size):
+        """返回写入该页镜像的偏移：总是分配新的 extent (优先复用空闲的空间，否则追加到文件末尾),
+        旧的 extent 在 map 落盘之后才会被复用，见 release().
+        """
+        if pageno >= len(self.extents):
+            self.extents.extend([(0, 0)] * (pageno + 1 - len(self.extents)))
+        capacity = (image_size + EXTENT_ALIGNMENT - 1) // EXTENT_ALIGNMENT * EXTENT_ALIGNMENT
+        offset = self._take_free_extent(capacity)
+        if offset is None:
+            offset = self.end
+            self.end += capacity
+        old_extent = self.extents[pageno]
+        if old_extent[1] > 0:
+            self.released_extents.append(old_extent)
+        self.extents[pageno] = (offset, capacity)
+        self.dirty = True
+        return offset
+
+    def _take_free_extent(self, capacity):
+        # first fit, 剩余的部分仍然是空闲的
+        for i, (offset, free_capacity) in enumerate(self.free_extents):
+            if free_capacity >= capacity:
+                if free_capacity == capacity:
+                    del self.free_extents[i]
+                else:
+                    self.free_extents[i] = (offset + capacity, free_capacity - capacity)
+                return offset
+        return None
+
+    def release(self):
+        """新的 map 落盘之后调用，被替换下来的旧 extent 不再被引用，可以复用了"""
+        self.free_extents.extend(self.released_extents)
+        self.released_extents.clear()
+
+    def compress(self, buff) -> bytes:
+        start = time.thread_time()
+        data = self.compress_function(buff)
+        self.stats.add_compressed(len(buff), len(data), time.thread_time() - start)
+        return IMAGE_HEADER.pack(len(data)) + data
+
+    def decompress(self, image) -> bytearray:
+        size = IMAGE_HEADER.unpack_from(image)[0]
+        start = time.thread_time()
+        buff = bytearray(self.decompress_function(
+            image[IMAGE_HEADER.size: IMAGE_HEADER.size + size]))
+        self.stats.add_decompressed(time.thread_time() - start)
+        assert len(buff) == PAGE_SIZE
+        return buff
+
+    def serialize(self) -> bytes:
+        return (MAP_HEADER.pack(self.method.encode()) +
+                b''.join(EXTENT.pack(*extent) for extent in self.extents))
+
+    @staticmethod
+    def deserialize(table_name, buff) -> "ExtentMap":
+        method = MAP_HEADER.unpack_from(buff)[0].rstrip(b'\0').decode()
+        extents = [EXTENT.unpack_from(buff, position)
+                   for position in range(MAP_HEADER.size, len(buff), EXTENT.size)]
+        return ExtentMap(table_name, method, extents)
+
+
+class CompressionManager:
+    def __init__(self):
+        # table_name -> ExtentMap, 没有开启压缩的表为 None
+        self.maps = {}
+
+    def get(self, table_name):
+        if table_name not in self.maps:
+            self.maps[table_name] = self.load(table_name)
+        return self.maps[table_name]
+
+    @staticmethod
+    def load(table_name):
+        CompressionManager._finish_replace(table_name)
+        filename = get_extent_map_filename(table_name)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return ExtentMap.deserialize(table_name, f.read())
+
+    def replace(self, table_name, filename, extent_map):
+        """用 get_rewrite_filename(filename) 中改写好、已经 fsync 过的数据文件替换 filename,
+        同时替换表的 extent map (None 表示关闭压缩)。调用之前需要关闭 filename.
+        """
+        data_filename = filename.encode()
+        map_data = extent_map.serialize() if extent_map is not None else b''
+        write_file(get_pending_filename(table_name),
+                   PENDING_HEADER.pack(len(data_filename)) + data_filename + map_data)
+        fsync_directory(DATA_DIRECTORY)
+        self._finish_replace(table_name)
+        self.maps[table_name] = extent_map
+        if extent_map is not None:
+            extent_map.dirty = False
+
+    @staticmethod
+    def _finish_replace(table_name):
+        """完成 .pending 中记录的替换，崩溃之后重复执行也是安全的"""
+        pending_filename = get_pending_filename(table_name)
+        if not os.path.exists(pending_filename):
+            return
+        with open(pending_filename, 'rb') as f:
+            buff = f.read()
+        length = PENDING_HEADER.unpack_from(buff)[0]
+        filename = buff[PENDING_HEADER.size: PENDING_HEADER.size + length].decode()
+        map_data = buff[PENDING_HEADER.size + length:]
+
+        rewrite_filename = get_rewrite_filename(filename)
+        if os.path.exists(rewrite_filename):
+            os.replace(rewrite_filename, filename)
+        map_filename = get_extent_map_filename(table_name)
+        if map_data:
+            write_file(map_filename, map_data)
+        elif os.path.exists(map_filename):
+            os.remove(map_filename)
+        fsync_directory(DATA_DIRECTORY)
+        os.remove(pending_filename)
+
+    @staticmethod
+    def _write(filename, extent_map):
+        # 与 FSM 一样，先写临时文件，再原子地替换
+        write_file(filename, extent_map.serialize())
+        extent_map.dirty = False
+        extent_map.release()
+
+    def sync(self):
+        # 在数据文件 fsync 之后调用，保证 map 中记录的镜像都已经落盘
+        for table_name, extent_map in self.maps.items():
+            if extent_map is not None and extent_map.dirty:
+                self._write(get_extent_map_filename(table_name), extent_map)
+
+    def stats(self, table_name):
+        extent_map = self.get(table_name)
+        if extent_map is None:
+            return None
+        return extent_map.stats.to_dict()
+
+
+compression_mgr = CompressionManager()
@@ -1,80 +1,210 @@
+import logging
 import os
+from functools import partial
 
 from imoocdb.catalog.entry import catalog_table, catalog_index
 from imoocdb.errors import PageError
-from imoocdb.storage.bplus_tree import BPlusTree, BPlusTreeTuple, load_root_node
+from imoocdb.storage.bplus_tree import bulk_load, index_mgr, encode_key, decode_key, \
+    normalize_key, MIN_KEY, MAX_KEY
+from imoocdb.storage.compression import compression_mgr, ExtentMap, get_rewrite_filename
+from imoocdb.storage.fsm import fsm_mgr
 from imoocdb.storage.common import get_table_filename, table_tuple_get_pages, table_tuple_get_page, tuple_to_bytes, \
-    bytes_to_tuple, get_index_filename
+    bytes_to_tuple, table_tuple_readahead, table_tuple_read_page
 from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.readahead import readahead
+from imoocdb.storage.row_format import get_row_codec, is_pickle_format, RowAccessor, ROW_FORMAT_MAGIC, \
+    TOAST_CHUNK_HEADER, TOAST_CHUNK_SIZE, TOAST_NO_NEXT
 from imoocdb.storage.slotted_page import Page
+from imoocdb.storage.smgr import smgr
+from imoocdb.storage.sort import external_sort, SORT_WORKERS
 from imoocdb.storage.transaction.entry import transaction_mgr
 from imoocdb.storage.transaction.redo import RedoRecord, RedoAction
 from imoocdb.storage.transaction.undo import UndoRecord, UndoOperation
 
+logger = logging.getLogger(__name__)
+# 系统表中没有记录列类型的表，只提示一次
+untyped_tables = set()
 
-def table_tuple_get_all(table_name):
+
+def table_tuple_get_all(table_name, columns=None):
+    """columns 是扫描过程中真正需要的列名，为 None 时返回完整的元组；
+    否则，不需要的列不会被反序列化，在返回的元组中用 None 占位。
+    """
+    # 迪米特法则：（最小知道/知识原则）：上层的函数/class对底层的实现知道越少越好
+    for batch in table_tuple_get_batches(table_name, columns):
+        for _, tup in batch:
+            yield tup
+
+
+def table_tuple_get_batches(table_name, columns=None):
+    """按页扫描，每次返回一个页中全部存活的元组：[(location, tuple), ...]
+    每个页只查找一次 buffer pool, 死元组直接通过 slot 的状态跳过，不需要解码。
+    """
     # todo: 如果该函数的所有调用接口，都能确保传递进来的参数 table_name
     # 是有意义的，那么，此函数内部，就不需要再进行重复的判断了！！！
     assert catalog_table.select(lambda r: r.table_name == table_name)
-    # 迪米特法则：（最小知道/知识原则）：上层的函数/class对底层的实现知道越少越好
-    for location in table_tuple_get_all_locations(table_name):
-        yield table_tuple_get_one(table_name, location)
+    codec = table_tuple_get_codec(table_name)
+    column_indexes = table_tuple_get_column_indexes(table_name, columns)
+    try:
+        for pageno in range(0, table_tuple_get_pages(table_name)):
+            table_tuple_readahead(table_name, pageno)
+            batch = table_tuple_get_page_batch(table_name, pageno, codec, column_indexes)
+            if batch:
+                yield batch
+    finally:
+        # 扫描提前结束时，已经发起的预读不会再被取走
+        readahead.finish(table_name)
+
+
+def table_tuple_get_page_batch(table_name, pageno, codec=None, column_indexes=None):
+    key = (table_name, pageno)
+    page = table_tuple_get_page(table_name, pageno)
+    fetch_external = partial(table_tuple_toast_fetch, table_name)
+    # 解码期间 pin 住该页，在 yield 之前就 unpin.
+    # pin 是计数的，同一个页同时被多个扫描 pin 住时，一个扫描 unpin 不会使其他扫描失去保护
+    buffer_pool.pin(key)
+    try:
+        batch = []
+        for sid in range(page.slot_count):
+            if not page.is_live(sid):
+                continue
+            batch.append(((pageno, sid),
+                          bytes_to_tuple(page.select_view(sid), codec, column_indexes,
+                                         fetch_external)))
+    finally:
+        buffer_pool.unpin(key)
+    return batch
+
+
+def table_tuple_get_column_indexes(table_name, columns):
+    if columns is None:
+        return None
+    table_columns = catalog_table.select(
+        lambda r: r.table_name == table_name
+    )[0].columns
+    column_indexes = [table_columns.index(c) for c in columns]
+    # 全部的列都需要，等价于不做裁剪
+    if len(set(column_indexes)) == len(table_columns):
+        return None
+    return column_indexes
+
+
+def table_tuple_get_codec(table_name):
+    results = catalog_table.select(lambda r: r.table_name == table_name)
+    if not results:
+        # 不在系统表中的关系（例如溢出表）中存放的不是元组
+        return None
+    types = getattr(results[0], 'types', None)
+    if not types:
+        # 早期创建的表，系统表中没有记录列类型，这类表继续使用 pickle 格式.
+        # 这也意味着二进制行格式完全没有生效，因此要让人能够发现
+        if table_name not in untyped_tables:
+            untyped_tables.add(table_name)
+            logger.warning('the catalog has no column types for the table %s, '
+                           'its tuples are stored with pickle.', table_name)
+        return None
+    return get_row_codec(types)
+
+
+def table_tuple_estimate_count(table_name):
+    """粗略地估计表中的元组数，供优化器使用：页数 * 第一个页中的元组数"""
+    pages = table_tuple_get_pages(table_name)
+    if pages == 0:
+        return 0
+    return pages * table_tuple_get_page(table_name, 0).slot_count
 
 
 def table_tuple_get_page_tuples(table_name, pageno):
     page = table_tuple_get_page(table_name, pageno)
-    return len(page.slot_directory)
+    return page.slot_count
 
 
 def table_tuple_get_all_locations(table_name):
-    # 我们手动跳过被标记为空的元组
-    for pageno in range(0, table_tuple_get_pages(table_name)):
-        for sid in range(0, table_tuple_get_page_tuples(table_name, pageno)):
-            # 返回的 location 是一个二元组
-            # todo: 判断当前返回给用户的tuple是否为死元组，
-            # 无效元组应该过滤
-            location = (pageno, sid)
-            if not table_tuple_is_dead(table_name, location):
-                yield location
+    try:
+        for pageno in range(0, table_tuple_get_pages(table_name)):
+            table_tuple_readahead(table_name, pageno)
+            page = table_tuple_get_page(table_name, pageno)
+            # 直接读取 slot 的状态来跳过死元组，不需要读取元组本身
+            live_sids = [sid for sid in range(page.slot_count) if page.is_live(sid)]
+            for sid in live_sids:
+                # 返回的 location 是一个二元组
+                yield pageno, sid
+    finally:
+        # 扫描提前结束时，已经发起的预读不会再被取走
+        readahead.finish(table_name)
+
+
+def table_tuple_get_one(table_name, location, codec=None, column_indexes=None):
+    pageno, sid = location
+    page = table_tuple_get_page(table_name, pageno=pageno)
+    if codec is None:
+        codec = table_tuple_get_codec(table_name)
+    return bytes_to_tuple(page.select(sid), codec, column_indexes,
+                          partial(table_tuple_toast_fetch, table_name))
 
 
-def table_tuple_get_one(table_name, location):
+def table_tuple_get_accessor(table_name, location, codec=None):
+    """返回元组的访问器，只有真正访问某一列时，才会解码该列"""
     pageno, sid = location
     page = table_tuple_get_page(table_name, pageno=pageno)
-    return bytes_to_tuple(page.select(sid))
+    if codec is None:
+        codec = table_tuple_get_codec(table_name)
+    tuple_bytes = page.select(sid)
+    fetch_external = partial(table_tuple_toast_fetch, table_name)
+    if codec is None or not tuple_bytes or tuple_bytes[0] != ROW_FORMAT_MAGIC:
+        return bytes_to_tuple(tuple_bytes, codec, fetch_external=fetch_external)
+    # 被 toast 过的列，也是在访问时才解压、读取溢出表
+    return RowAccessor(codec, tuple_bytes, fetch_external)
 
 
 def table_tuple_is_dead(table_name, location):
-    return len(table_tuple_get_one(table_name, location)) == 0
+    pageno, sid = location
+    page = table_tuple_get_page(table_name, pageno=pageno)
+    return not page.is_live(sid)
 
 
 def table_tuple_update_one(table_name, location, tup):
+    """返回更新之后元组的 location.
+    新版本能放在原来的页内时，是 heap-only tuple (HOT) 更新，location 不变，
+    没有被修改的索引列也就不需要维护索引；否则，元组被挪到其他页上，location 会变化。
+    """
     pageno, sid = location
     page = table_tuple_get_page(table_name, pageno=pageno)
     xid = transaction_mgr.session_xid()
-    old_tuple_bytes = tuple_to_bytes(page.select(sid))
+    old_tuple_bytes = page.select(sid)
+    tuple_bytes = tuple_to_bytes(tup, table_tuple_get_codec(table_name),
+                                 partial(table_tuple_toast_store, table_name))
 
     try:
-        new_sid = page.update(sid, tuple_to_bytes(tup))
-        buffer_pool.mark_dirty((table_name, pageno))
-        # 写日志
-        undo_record = UndoRecord(
-            xid, UndoOperation.TABLE_UPDATE, table_name, (pageno, sid),
-            old_tuple_bytes
-        )
-        redo_record = RedoRecord(
-            xid, RedoAction.TABLE_UPDATE, table_name, (pageno, new_sid),
-            tuple_to_bytes(tup)
-        )
-        transaction_mgr.undo_mgr.write(undo_record)
-        lsn = transaction_mgr.redo_mgr.write(redo_record)
-        page.set_header(lsn)
+        page.update(sid, tuple_bytes)
     except PageError:
         # 只存在 insert 无法插入数据，是因为没有空间了，才会导致
         # 因此我们只需要处理该种异常即可
-        table_tuple_delete_one(table_name, location)
-        new_sid = table_tuple_insert_one(table_name, tup)
-    return new_sid
+        keep = transaction_mgr.get_pending_deletes(table_name, pageno)
+        if page.fits_after_compact(len(tuple_bytes), keep):
+            # 先做（记录了 redo 日志的）页内整理，再更新一次
+            table_tuple_reorganize(table_name, [pageno])
+            page.update(sid, tuple_bytes)
+        else:
+            table_tuple_delete_one(table_name, location)
+            # 已经编码（可能已经写入了溢出表）的元组直接插入，不要再编码一次
+            return table_tuple_insert_bytes(table_name, tuple_bytes)
+
+    buffer_pool.mark_dirty((table_name, pageno))
+    fsm_mgr.get(table_name).update(pageno, page.free_space_size)
+    # 写日志，HOT 更新之后 sid 保持不变，重放时同样是 page.update(sid, ...)
+    undo_record = UndoRecord(
+        xid, UndoOperation.TABLE_UPDATE, table_name, location,
+        old_tuple_bytes
+    )
+    redo_record = RedoRecord(
+        xid, RedoAction.TABLE_UPDATE, table_name, location,
+        tuple_bytes
+    )
+    transaction_mgr.undo_mgr.write(undo_record)
+    lsn = transaction_mgr.redo_mgr.write(redo_record)
+    page.set_header(lsn)
+    return location
 
 
 def table_tuple_get_last_pageno(table_name):
@@ -82,65 +212,113 @@ def table_tuple_get_last_pageno(table_name):
 
 
 def table_tuple_allocate_page(table_name):
-    pageno = table_tuple_get_last_pageno(table_name)
-    table_tuple_get_page(table_name, pageno)
-    new_pageno = table_tuple_get_last_pageno(table_name)
-    assert new_pageno == pageno + 1
+    # 新页的 pageno 就是当前的页数，获取一个不存在的页时，会自动创建该页（脏页）
+    new_pageno = table_tuple_get_pages(table_name)
+    page = table_tuple_get_page(table_name, new_pageno)
+    fsm_mgr.get(table_name).update(new_pageno, page.free_space_size)
     return new_pageno
 
 
+def table_tuple_find_page(table_name, record_size):
+    """借助 FSM 寻找一个能放下 record_size 字节的页，找不到时才分配新页"""
+    fsm = fsm_mgr.get(table_name)
+    while True:
+        pageno = fsm.search(record_size)
+        if pageno is None:
+            pageno = table_tuple_allocate_page(table_name)
+            return pageno, table_tuple_get_page(table_name, pageno)
+        page = table_tuple_get_page(table_name, pageno)
+        if page.can_insert(record_size):
+            return pageno, page
+        # FSM 只是提示信息，可能与页的实际情况不一致（例如崩溃恢复之后），
+        # 修正之后重新查找
+        fsm.update(pageno, page.free_space_size)
+
+
 def table_tuple_insert_one(table_name, tup):
-    pageno = table_tuple_get_last_pageno(table_name)
-    if pageno < 0:
-        pageno = table_tuple_allocate_page(table_name)
+    tuple_bytes = tuple_to_bytes(tup, table_tuple_get_codec(table_name),
+                                 partial(table_tuple_toast_store, table_name))
+    return table_tuple_insert_bytes(table_name, tuple_bytes)
 
-    # 产生了非常多的 overhead, 这也进一步证明了 buffer 的重要性
-    page = table_tuple_get_page(table_name, pageno=pageno)
+
+def table_tuple_insert_bytes(table_name, tuple_bytes):
     xid = transaction_mgr.session_xid()
-    tuple_bytes = tuple_to_bytes(tup)
 
-    try:
-        sid = page.insert(tuple_to_bytes(tup))
+    # 产生了非常多的 overhead, 这也进一步证明了 buffer 的重要性
+    pageno, page = table_tuple_find_page(table_name, len(tuple_bytes))
+    sid = page.insert(tuple_bytes)
+    buffer_pool.mark_dirty((table_name, pageno))
+    fsm_mgr.get(table_name).update(pageno, page.free_space_size)
+
+    # write logs
+    undo_record = UndoRecord(xid,
+                             UndoOperation.TABLE_DELETE,
+                             table_name, (pageno, sid),
+                             b'')
+    redo_record = RedoRecord(
+        xid, RedoAction.TABLE_INSERT, table_name, (pageno, sid), tuple_bytes
+    )
+    transaction_mgr.undo_mgr.write(undo_record)
+    lsn = transaction_mgr.redo_mgr.write(redo_record)
+    page.set_header(lsn=lsn)
+
+    return pageno, sid
+
+
+def table_tuple_insert_many(table_name, tuples):
+    """批量插入：每个页尽可能多地放入元组，并且每个页只写一条 redo 与 undo 日志。
+    返回与 tuples 一一对应的 location 列表。
+    """
+    xid = transaction_mgr.session_xid()
+    codec = table_tuple_get_codec(table_name)
+    fsm = fsm_mgr.get(table_name)
+    store_external = partial(table_tuple_toast_store, table_name)
+    all_tuple_bytes = [tuple_to_bytes(tup, codec, store_external) for tup in tuples]
+
+    locations = []
+    i = 0
+    while i < len(all_tuple_bytes):
+        pageno, page = table_tuple_find_page(table_name, len(all_tuple_bytes[i]))
+        first_sid = page.slot_count
+        page_tuple_bytes = []
+        while i < len(all_tuple_bytes):
+            # 每个页上的第一个元组直接插入：新分配的空页也放不下时，与 table_tuple_insert_one
+            # 一样由 page.insert() 抛出 PageError, 而不是不停地分配新页、写出空的日志
+            if page_tuple_bytes and not page.can_insert(len(all_tuple_bytes[i])):
+                break
+            sid = page.insert(all_tuple_bytes[i])
+            page_tuple_bytes.append(all_tuple_bytes[i])
+            locations.append((pageno, sid))
+            i += 1
         buffer_pool.mark_dirty((table_name, pageno))
-        # write logs
-        undo_record = UndoRecord(xid,
-                                 UndoOperation.TABLE_DELETE,
-                                 table_name, (pageno, sid),
-                                 b'')
-        redo_record = RedoRecord(
-            xid, RedoAction.TABLE_INSERT, table_name, (pageno, sid), tuple_bytes
-        )
-        transaction_mgr.undo_mgr.write(undo_record)
-        lsn = transaction_mgr.redo_mgr.write(redo_record)
-        page.set_header(lsn=lsn)
-    except PageError:
-        new_pageno = table_tuple_allocate_page(table_name)
-        new_page = table_tuple_get_page(table_name, new_pageno)
-        sid = new_page.insert(tuple_bytes)
-        buffer_pool.mark_dirty((table_name, new_pageno))
+        fsm.update(pageno, page.free_space_size)
 
-        # write logs
+        # write logs: 同一个页上插入的元组，其 sid 是连续的，
+        # 因此 undo 日志中只需要记录起始的 sid 与元组的数量
         undo_record = UndoRecord(xid,
-                                 UndoOperation.TABLE_DELETE,
-                                 table_name, (new_pageno, sid),
-                                 b'')
+                                 UndoOperation.TABLE_DELETE_MANY,
+                                 table_name, (pageno, first_sid),
+                                 len(page_tuple_bytes))
         redo_record = RedoRecord(
-            xid, RedoAction.TABLE_INSERT, table_name, (new_pageno, sid), tuple_bytes
+            xid, RedoAction.TABLE_INSERT_MANY, table_name, (pageno, first_sid),
+            page_tuple_bytes
         )
         transaction_mgr.undo_mgr.write(undo_record)
         lsn = transaction_mgr.redo_mgr.write(redo_record)
         page.set_header(lsn=lsn)
 
-    return pageno, sid
+    return locations
 
 
 def table_tuple_delete_one(table_name, location):
     pageno, sid = location
     page = table_tuple_get_page(table_name, pageno=pageno)
     xid = transaction_mgr.session_xid()
-    old_tuple_bytes = tuple_to_bytes(table_tuple_get_one(table_name, location))
+    old_tuple_bytes = page.select(sid)
     page.delete(sid)
     buffer_pool.mark_dirty((table_name, pageno))
+    # 事务结束之前，这个死元组可能还要被回滚回来，不能被整理回收
+    transaction_mgr.add_pending_delete(xid, table_name, location)
 
     # write logs
     undo_record = UndoRecord(xid,
@@ -155,33 +333,188 @@ def table_tuple_delete_one(table_name, location):
     page.set_header(lsn=lsn)
 
 
-def table_tuple_reorganize(table_name):
-    # 把所有的tuple的状态为 dead 的元组，统一进行整理
-    pass
+def table_tuple_reorganize(table_name, pagenos=None):
+    """把所有的tuple的状态为 dead 的元组，以及原地更新留下的空洞，统一进行整理。
+    pagenos 为需要整理的页，为 None 时整理整张表。返回回收的字节数。
+    还没有结束的事务删除的元组会被保留下来，等那个事务结束之后再整理才能回收。
+    """
+    if pagenos is None:
+        pagenos = range(0, table_tuple_get_pages(table_name))
+    xid = transaction_mgr.session_xid()
+    reclaimed_size = 0
+    for pageno in sorted(pagenos):
+        page = table_tuple_get_page(table_name, pageno)
+        keep = transaction_mgr.get_pending_deletes(table_name, pageno)
+        if page.reclaimable_size(keep) == 0 and not page.reclaimable_slots(keep):
+            continue
+        reclaimed_size += page.compact(keep)
+        buffer_pool.mark_dirty((table_name, pageno))
+        fsm_mgr.get(table_name).update(pageno, page.free_space_size)
+        # 整理不改变任何元组的内容和 location, 所以只需要 redo 日志，
+        # 重放时需要知道哪些死元组被保留了下来
+        lsn = transaction_mgr.redo_mgr.write(RedoRecord(
+            xid, RedoAction.TABLE_REORGANIZE, table_name, (pageno, None), sorted(keep)
+        ))
+        page.set_header(lsn)
+    return reclaimed_size
+
+
+def table_tuple_migrate_row_format(table_name):
+    """把表中仍然以 pickle 格式存储的元组，原地改写为二进制行格式。
+    改写不改变元组的逻辑内容，也不改变 location，所以只需要写 redo 日志。
+    返回被改写的元组数量。
+    """
+    codec = table_tuple_get_codec(table_name)
+    if codec is None:
+        return 0
+    migrated = 0
+    xid = transaction_mgr.session_xid()
+    for pageno in range(0, table_tuple_get_pages(table_name)):
+        page = table_tuple_get_page(table_name, pageno)
+        for sid in range(page.slot_count):
+            if not page.is_live(sid):
+                continue
+            old_tuple_bytes = page.select(sid)
+            if not is_pickle_format(old_tuple_bytes):
+                continue
+            tuple_bytes = tuple_to_bytes(bytes_to_tuple(old_tuple_bytes), codec)
+            # 新格式更长（例如元组与列类型不匹配，仍然是 pickle），就不动它，
+            # 避免元组被挪到新的 sid 上
+            if (is_pickle_format(tuple_bytes) or
+                    len(tuple_bytes) > len(old_tuple_bytes)):
+                continue
+            page.update(sid, tuple_bytes)
+            buffer_pool.mark_dirty((table_name, pageno))
+            fsm_mgr.get(table_name).update(pageno, page.free_space_size)
+            lsn = transaction_mgr.redo_mgr.write(RedoRecord(
+                xid, RedoAction.TABLE_UPDATE, table_name, (pageno, sid),
+                tuple_bytes
+            ))
+            page.set_header(lsn)
+            migrated += 1
+    return migrated
 
 
 def table_tuple_delete_multiple(table_name, locations):
+    # 删除的元组在事务结束之前都可能被回滚，这里不整理页，
+    # 空间在事务结束之后由 table_tuple_reorganize() 回收
     for location in locations:
         table_tuple_delete_one(table_name, location)
-    table_tuple_reorganize(table_name)
 
 
-def index_tuple_create(index_name, table_name, columns):
+def table_tuple_set_compression(table_name, method=None):
+    """开启（method 为 'zlib' 或 'lzma'）或者关闭（method 为 None）表的页压缩。
+    表中全部的页会按照新的方式重写一遍，因此，也可以用来回收压缩页被搬走之后留下的空间。
+    """
+    filename = get_table_filename(table_name)
+    extent_map = ExtentMap(table_name, method) if method else None
+    temp_filename = get_rewrite_filename(filename)
+    # WAL: 下面会把内存中的脏页写到新的数据文件中，修改它们的 redo 日志要先落盘
+    transaction_mgr.redo_mgr.flush()
+    with open(temp_filename, 'wb') as f:
+        for pageno in range(0, table_tuple_get_pages(table_name)):
+            key = (table_name, pageno)
+            # 内存中的版本（包括被淘汰但还没有写回的脏页）比磁盘上的新
+            if key in buffer_pool:
+                buff = buffer_pool[key].serialize()
+            elif key in buffer_pool.lru_cache.evicted:
+                buff = buffer_pool.lru_cache.evicted[key].serialize()
+            else:
+                buff = table_tuple_read_page(table_name, pageno)
+            if extent_map is None:
+                f.write(buff)
+            else:
+                image = extent_map.compress(buff)
+                f.seek(extent_map.allocate(pageno, len(image)))
+                f.write(image)
+        os.fsync(f.fileno())
+
+    # 预读的结果来自旧的文件
+    readahead.reset()
+    smgr.close(filename)
+    # 数据文件与 extent map 成对地替换，中途崩溃时由 compression_mgr 在加载 map 时完成替换
+    compression_mgr.replace(table_name, filename, extent_map)
+
+
+def table_tuple_compression_stats(table_name):
+    """压缩率（压缩后 / 压缩前）以及压缩、解压所花费的 CPU 时间，没有开启压缩的表返回 None"""
+    return compression_mgr.stats(table_name)
+
+
+def table_tuple_get_toast_relation(table_name):
+    # 每张表的溢出表 (toast relation) 也是一个堆表，只是其中存放的是 chunk
+    return table_name + '$toast'
+
+
+def table_tuple_toast_store(table_name, payload):
+    """把过长的值切分为 chunk 写到溢出表中，返回第一个 chunk 的 location"""
+    toast_relation = table_tuple_get_toast_relation(table_name)
+    location = (TOAST_NO_NEXT, TOAST_NO_NEXT)
+    # 从最后一个 chunk 开始写，这样，写每个 chunk 时都已经知道下一个 chunk 的 location 了
+    for start in reversed(range(0, len(payload), TOAST_CHUNK_SIZE)):
+        chunk = TOAST_CHUNK_HEADER.pack(*location) + payload[start: start + TOAST_CHUNK_SIZE]
+        location = table_tuple_insert_bytes(toast_relation, chunk)
+    return location
+
+
+def table_tuple_toast_chunks(table_name, location):
+    """沿着 chunk 链表，依次返回 (location, chunk 中的数据)"""
+    toast_relation = table_tuple_get_toast_relation(table_name)
+    pageno, sid = location
+    while pageno != TOAST_NO_NEXT:
+        chunk = table_tuple_get_page(toast_relation, pageno).select(sid)
+        yield (pageno, sid), chunk[TOAST_CHUNK_HEADER.size:]
+        pageno, sid = TOAST_CHUNK_HEADER.unpack_from(chunk)
+
+
+def table_tuple_toast_fetch(table_name, location):
+    return b''.join(data for _, data in table_tuple_toast_chunks(table_name, location))
+
+
+def table_tuple_vacuum_toast(table_name):
+    """删除、更新元组时，溢出表中的 chunk 不会被同步删除（事务回滚时还需要用到），
+    由该函数统一删除不再被任何存活元组引用的 chunk, 应当在没有进行中的事务修改该表时调用。
+    返回删除的 chunk 数量，提交之后对溢出表执行 table_tuple_reorganize() 回收空间。
+    """
+    codec = table_tuple_get_codec(table_name)
+    if codec is None:
+        return 0
+    referenced = set()
+    for pageno, sid in table_tuple_get_all_locations(table_name):
+        tuple_bytes = table_tuple_get_page(table_name, pageno).select(sid)
+        if not tuple_bytes or tuple_bytes[0] != ROW_FORMAT_MAGIC:
+            continue
+        for location in codec.external_pointers(tuple_bytes):
+            referenced.update(chunk_location for chunk_location, _ in
+                              table_tuple_toast_chunks(table_name, location))
+    toast_relation = table_tuple_get_toast_relation(table_name)
+    unreferenced = [location for location in table_tuple_get_all_locations(toast_relation)
+                    if location not in referenced]
+    if unreferenced:
+        table_tuple_delete_multiple(toast_relation, unreferenced)
+    return len(unreferenced)
+
+
+def index_tuple_create(index_name, table_name, columns, workers=SORT_WORKERS):
+    """批量构建索引：扫描表，只解码索引列，得到全部的 (key, location),
+    排序（数据量大时溢出到磁盘上，workers 大于 1 时并行排序）之后，自底向上地构建b+树。
+    """
     table_columns = catalog_table.select(
         lambda r: r.table_name == table_name
     )[0].columns
     # 获取索引列的下标
     columns_indexes = [table_columns.index(c) for c in columns]
 
-    filename = get_index_filename(index_name)
-    tree = BPlusTree(filename)
+    def entries():
+        for batch in table_tuple_get_batches(table_name, columns):
+            for location, tup in batch:
+                yield encode_key(tuple(tup[i] for i in columns_indexes)), location
 
-    for location in table_tuple_get_all_locations(table_name):
-        tup = table_tuple_get_one(table_name, location)
-        key = BPlusTreeTuple(tuple(tup[i] for i in columns_indexes))
-        tree.insert(key, location)
-
-    tree.serialize()
+    # DDL: 已经打开的同名索引不再可用
+    index_mgr.invalidate(index_name)
+    tree = bulk_load(index_name, external_sort(entries(), workers=workers),
+                     lsn=transaction_mgr.get_current_lsn())
+    index_mgr.set(index_name, tree)
 
 
 def range_compare(value, start, end):
@@ -195,47 +528,93 @@ def range_compare(value, start, end):
         return start < value < end
 
 
-def index_tuple_get_range_locations(index_name, start=float('-inf'), end=float('inf')):
+def index_tuple_get_range_locations(index_name, start=MIN_KEY, end=MAX_KEY,
+                                    start_inclusive=False, end_inclusive=False, reverse=False):
     """start, end 两个参数，是用来指定扫描索引中部分数据的，如果不给这两个参数赋值，
     那么，就默认拿这个索引中的全部数据.
+    默认不包含两端的等值，>= 与 <= 通过 start_inclusive/end_inclusive 指定.
+    通过游标沿着叶子节点惰性地返回，调用者可以随时停止迭代；reverse 为 True 时按照键从大到小返回.
     """
-    filename = get_index_filename(index_name)
-    tree = BPlusTree(filename, load_root_node(filename))
-    for location in tree.find_range(start, end):
+    if start is None:
+        start = MIN_KEY
+    if end is None:
+        end = MAX_KEY
+    cursor = index_mgr.get(index_name).cursor(start, end, start_inclusive, end_inclusive, reverse)
+    for _, location in cursor:
         yield location
 
 
-def index_tuple_get_range(index_name, start=None, end=None):
+def index_tuple_get_range(index_name, start=None, end=None, bitmap=False,
+                          start_inclusive=False, end_inclusive=False, reverse=False):
     """start, end 两个参数，是用来指定扫描索引中部分数据的，如果不给这两个参数赋值，
     那么，就默认拿这个索引中的全部数据.
+    bitmap 为 True 时，按照物理顺序回表（见 table_tuple_bitmap_fetch），返回的元组不再按索引键有序。
     """
     results = catalog_index.select(lambda r: r.index_name == index_name)
     table_name = results[0].table_name
-    for location in index_tuple_get_range_locations(index_name, start, end):
+    codec = table_tuple_get_codec(table_name)
+    locations = index_tuple_get_range_locations(index_name, start, end,
+                                                start_inclusive, end_inclusive, reverse)
+    if bitmap:
+        yield from table_tuple_bitmap_fetch(table_name, locations, codec)
+        return
+    for location in locations:
         # 该过程就是**回表**过程，即从全量表数据中获取location的部分
-        yield table_tuple_get_one(table_name, location)
+        yield table_tuple_get_one(table_name, location, codec)
 
 
 def index_tuple_get_equal_value_locations(index_name, equal_value):
-    filename = get_index_filename(index_name)
-    tree = BPlusTree(filename, load_root_node(filename))
-    for location in tree.find(equal_value):
+    key = normalize_key(equal_value)
+    for _, location in index_mgr.get(index_name).cursor(key, key, True, True):
         yield location
 
 
-def index_tuple_get_equal_value(index_name, equal_value):
+def index_tuple_get_equal_value(index_name, equal_value, bitmap=False):
     results = catalog_index.select(lambda r: r.index_name == index_name)
     table_name = results[0].table_name
-    for location in index_tuple_get_equal_value_locations(index_name, equal_value):
-        yield table_tuple_get_one(table_name, location)
+    codec = table_tuple_get_codec(table_name)
+    locations = index_tuple_get_equal_value_locations(index_name, equal_value)
+    if bitmap:
+        yield from table_tuple_bitmap_fetch(table_name, locations, codec)
+        return
+    for location in locations:
+        yield table_tuple_get_one(table_name, location, codec)
 
 
-def covered_index_tuple_get_range(index_name, start=float('-inf'), end=float('inf')):
-    filename = get_index_filename(index_name)
-    tree = BPlusTree(filename, load_root_node(filename))
-    for key in tree.find_range(start, end, return_keys=True):
-        # key 的数据类型是 BPlusTreeTuple
-        yield key.tup
+def table_tuple_bitmap_fetch(table_name, locations, codec=None, column_indexes=None):
+    """bitmap heap scan: 先从索引中收集全部的 location, 按页分组，
+    再按照页号的物理顺序回表，每个页只访问一次 buffer pool.
+    按索引键的顺序回表时，相邻的两个 location 往往落在不同的页上，
+    在 buffer pool 较小时，同一个页会被反复地换入换出。
+    """
+    if codec is None:
+        codec = table_tuple_get_codec(table_name)
+    bitmap = {}
+    for pageno, sid in locations:
+        bitmap.setdefault(pageno, []).append(sid)
+    for pageno in sorted(bitmap):
+        key = (table_name, pageno)
+        page = table_tuple_get_page(table_name, pageno)
+        buffer_pool.pin(key)
+        try:
+            batch = [bytes_to_tuple(page.select_view(sid), codec, column_indexes,
+                                    partial(table_tuple_toast_fetch, table_name))
+                     for sid in sorted(bitmap[pageno])]
+        finally:
+            buffer_pool.unpin(key)
+        yield from batch
+
+
+def covered_index_tuple_get_range(index_name, start=MIN_KEY, end=MAX_KEY,
+                                  start_inclusive=False, end_inclusive=False, reverse=False):
+    if start is None:
+        start = MIN_KEY
+    if end is None:
+        end = MAX_KEY
+    cursor = index_mgr.get(index_name).cursor(start, end, start_inclusive, end_inclusive, reverse)
+    for key, _ in cursor:
+        # B+树中存储的是编码之后的键，需要还原为 tuple
+        yield decode_key(key)
 
 
 def covered_index_tuple_get_equal_value(index_name, equal_value):
@@ -244,43 +623,49 @@ def covered_index_tuple_get_equal_value(index_name, equal_value):
 
 
 def index_tuple_insert_one(index_name, key, value):
-    filename = get_index_filename(index_name)
     xid = transaction_mgr.session_xid()
-    tree = BPlusTree(filename, load_root_node(filename))
-    tree.insert(BPlusTreeTuple(key), value)
-
-    # 这个key的数据类型并不是字节集合，但是不影响其的序列化过程，
-    # 这个Python的弱类型允许这么写
-    transaction_mgr.undo_mgr.write(UndoRecord(
-        xid, UndoOperation.INDEX_DELETE,
-        index_name, value,
-        key
-    ))
+    key = normalize_key(key)
 
-    # todo: LSN
-    tree.serialize()
+    with index_mgr.acquire(index_name) as tree:
+        # undo/redo 日志中记录的是编码之后的键
+        transaction_mgr.undo_mgr.write(UndoRecord(
+            xid, UndoOperation.INDEX_DELETE,
+            index_name, value,
+            key
+        ))
+        # 索引页与数据页一样，在 checkpoint 时才写回磁盘，因此也需要 redo 日志
+        lsn = transaction_mgr.redo_mgr.write(RedoRecord(
+            xid, RedoAction.INDEX_INSERT, index_name, value, key
+        ))
+        tree.insert(key, value, lsn)
+        tree.serialize()
 
 
 def index_tuple_delete_one(index_name, key, location=None):
-    filename = get_index_filename(index_name)
     xid = transaction_mgr.session_xid()
-
-    tree = BPlusTree(filename, load_root_node(filename))
-    old_locations = tree.find(key)
-    tree.delete(key, location)
-
-    # only undo log
-    for old_location in old_locations:
-        transaction_mgr.undo_mgr.write(UndoRecord(
-            xid, UndoOperation.INDEX_INSERT,
-            index_name, old_location,
-            key
+    key = normalize_key(key)
+
+    with index_mgr.acquire(index_name) as tree:
+        # 只有真正被删除的索引项才需要在回滚时插回去
+        old_locations = [old_location for old_location in tree.find(key)
+                         if location is None or old_location == location]
+
+        for old_location in old_locations:
+            transaction_mgr.undo_mgr.write(UndoRecord(
+                xid, UndoOperation.INDEX_INSERT,
+                index_name, old_location,
+                key
+            ))
+        lsn = transaction_mgr.redo_mgr.write(RedoRecord(
+            xid, RedoAction.INDEX_DELETE, index_name, location, key
         ))
-
-    # todo: LSN
-    tree.serialize()
+        tree.delete(key, location, lsn)
+        tree.serialize()
 
 
 def index_tuple_update_one(index_name, key, old_value, value):
+    # HOT 更新之后 location 不变，索引项仍然有效，不需要重写索引
+    if old_value == value:
+        return
     index_tuple_delete_one(index_name, key, old_value)
     index_tuple_insert_one(index_name, key, value)
@@ -0,0 +1,141 @@
+import os
+
+from imoocdb.constant import DATA_DIRECTORY
+from imoocdb.storage.common import table_tuple_get_pages, get_table_filename, table_tuple_get_disk_pages, \
+    table_tuple_read_page
+from imoocdb.storage.compression import compression_mgr
+from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.slotted_page import PAGE_SIZE, PageHeader, Slot
+from imoocdb.storage.smgr import smgr
+
+# 空闲空间映射表 (free space map, FSM)：
+# 每个数据页用 1 个字节记录其空闲空间所处的档位 (category)，
+# 档位 c 表示该页至少还有 c * FSM_CATEGORY_SIZE 字节的空闲空间
+FSM_CATEGORIES = 256
+FSM_CATEGORY_SIZE = PAGE_SIZE // FSM_CATEGORIES
+
+
+def free_space_to_category(free_space):
+    return min(free_space // FSM_CATEGORY_SIZE, FSM_CATEGORIES - 1)
+
+
+def record_size_to_category(record_size):
+    # 与 Page.can_insert() 保持一致：插入后至少还要剩下 1 个字节
+    required = Slot.size() + record_size + 1
+    return (required + FSM_CATEGORY_SIZE - 1) // FSM_CATEGORY_SIZE
+
+
+def get_fsm_filename(table_name):
+    return os.path.join(DATA_DIRECTORY, table_name + '.fsm')
+
+
+class FreeSpaceMap:
+    """单张表的空闲空间映射。
+    categories 是 pageno -> 档位 的数组，也是落盘的格式；
+    buckets 是 档位 -> pageno 集合 的倒排，用于在常数时间内找到有空间的页。
+    FSM 只是一个提示信息，不记 WAL, 与页的实际情况不一致时，由使用者修正即可。
+    """
+
+    def __init__(self, table_name, categories=b''):
+        self.table_name = table_name
+        self.categories = bytearray()
+        self.buckets = [set() for _ in range(FSM_CATEGORIES)]
+        self.dirty = False
+        for pageno, category in enumerate(categories):
+            self._set(pageno, category)
+
+    def _set(self, pageno, category):
+        if pageno < len(self.categories):
+            self.buckets[self.categories[pageno]].discard(pageno)
+        else:
+            # 中间缺失的页，先按照没有空闲空间处理
+            for missing_pageno in range(len(self.categories), pageno):
+                self.buckets[0].add(missing_pageno)
+            self.categories.extend(bytes(pageno + 1 - len(self.categories)))
+        self.categories[pageno] = category
+        self.buckets[category].add(pageno)
+
+    def __len__(self):
+        return len(self.categories)
+
+    def update(self, pageno, free_space):
+        category = free_space_to_category(free_space)
+        if pageno < len(self.categories) and self.categories[pageno] == category:
+            return
+        self._set(pageno, category)
+        self.dirty = True
+
+    def search(self, record_size):
+        """返回一个可以放下 record_size 字节的页，没有则返回 None"""
+        # 档位数是固定的，因此最多检查 FSM_CATEGORIES 个桶，与表的大小无关
+        for category in range(record_size_to_category(record_size), FSM_CATEGORIES):
+            if self.buckets[category]:
+                return next(iter(self.buckets[category]))
+        return None
+
+
+def read_page_free_space(table_name, pageno):
+    """只读取页头来计算空闲空间，不把数据页装载到 buffer 中"""
+    key = (table_name, pageno)
+    if key in buffer_pool:
+        return buffer_pool[key].free_space_size
+    if pageno >= table_tuple_get_disk_pages(table_name):
+        return PAGE_SIZE - PageHeader.size()
+    if compression_mgr.get(table_name) is not None:
+        # 压缩表只能把整个页解压出来
+        header = PageHeader(table_tuple_read_page(table_name, pageno))
+    else:
+        header = PageHeader.deserialize(smgr.read(get_table_filename(table_name),
+                                                  pageno * PAGE_SIZE, PageHeader.size()))
+    if header.free_space_start == 0:
+        # 从未被初始化过的页
+        return PAGE_SIZE - PageHeader.size()
+    return header.free_space_end - header.free_space_start
+
+
+class FreeSpaceMapManager:
+    def __init__(self):
+        self.maps = {}
+
+    def get(self, table_name) -> FreeSpaceMap:
+        if table_name not in self.maps:
+            self.maps[table_name] = self.load(table_name)
+        return self.maps[table_name]
+
+    @staticmethod
+    def load(table_name) -> FreeSpaceMap:
+        filename = get_fsm_filename(table_name)
+        categories = b''
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                categories = f.read()
+
+        pages = table_tuple_get_pages(table_name)
+        fsm = FreeSpaceMap(table_name, categories[:pages])
+        if len(fsm) < pages:
+            # FSM 文件丢失了，或者落后于数据文件，只需要读取缺失部分的页头即可重建
+            for pageno in range(len(fsm), pages):
+                fsm.update(pageno, read_page_free_space(table_name, pageno))
+        return fsm
+
+    def rebuild(self, table_name):
+        filename = get_fsm_filename(table_name)
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.maps[table_name] = self.load(table_name)
+
+    def sync(self):
+        for table_name, fsm in self.maps.items():
+            if not fsm.dirty:
+                continue
+            filename = get_fsm_filename(table_name)
+            # 先写临时文件，再原子地替换，避免写了一半的 FSM 文件
+            temp_filename = filename + '.tmp'
+            with open(temp_filename, 'wb') as f:
+                f.write(fsm.categories)
+                os.fsync(f.fileno())
+            os.replace(temp_filename, filename)
+            fsm.dirty = False
+
+
+fsm_mgr = FreeSpaceMapManager()
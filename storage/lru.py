@@ -16,7 +16,12 @@ class LRUNode:
         # 额外的字段
         # 用于判断当前 node 是否被上层业务代码使用
         # 如果被显性pinned, 那么就意味着，该节点暂时还不能剔除（淘汰）
-        self.pinned = False
+        # 同一个页可能同时被多个扫描 pin 住，所以记录的是次数，减到 0 才可以被淘汰
+        self.pin_count = 0
+
+    @property
+    def pinned(self):
+        return self.pin_count > 0
 
     def __repr__(self):
         return f'{self.key}:{self.value}'
@@ -48,12 +53,16 @@ class LRUCache:
         self.tail.prev = self.head
 
     def put(self, key, value):
+        pin_count = 0
         if key in self.cache:
             # 此时，相当于访问LRU中已经存在的一个节点
             # 需要把这个节点提取到最前面的位置
+            pin_count = self.cache[key].pin_count
             self._remove(self.cache[key])
 
         node = LRUNode(key, value)
+        # 替换页的内容不影响其他使用者对它的 pin
+        node.pin_count = pin_count
         self.cache[key] = node
         self._add(node)
 
@@ -61,7 +70,7 @@ class LRUCache:
         if len(self.cache) > self.capacity:
             # 大于就要进行淘汰
             evicted_node = self.head.next
-            while evicted_node and evicted_node.pinned:
+            while evicted_node is not self.tail and evicted_node.pinned:
                 evicted_node = evicted_node.next
 
             if evicted_node is self.tail:
@@ -100,15 +109,23 @@ class LRUCache:
         prev_node.next = next_node
         next_node.prev = prev_node
 
+    def remove(self, key):
+        node = self.cache.pop(key, None)
+        if node is not None:
+            self._remove(node)
+
     def pin(self, key):
         if key not in self.cache:
             raise LRUError(f'not found key {key}')
-        self.cache[key].pinned = True
+        self.cache[key].pin_count += 1
 
     def unpin(self, key):
         if key not in self.cache:
             raise LRUError(f'not found key {key}')
-        self.cache[key].pinned = False
+        node = self.cache[key]
+        if node.pin_count == 0:
+            raise LRUError(f'the key {key} is not pinned')
+        node.pin_count -= 1
 
     def items(self):
         # 思考：如果想遍历当前LRU中的所有元素，应该
@@ -120,6 +137,13 @@ class BufferPool:
     def __init__(self, buffer_size=LRU_CAPACITY):
         self.lru_cache = LRUCache(buffer_size)
         self.dirty_pages = set()
+        # WAL: 把 redo 日志落盘到指定的 LSN, 由 transaction_mgr 注册
+        self.log_flusher = None
+
+    def flush_log(self, lsn):
+        """页写回磁盘之前调用，保证修改该页的 redo 日志已经落盘"""
+        if self.log_flusher is not None:
+            self.log_flusher(lsn)
 
     def mark_dirty(self, key):
         assert key in self.lru_cache.cache
@@ -128,6 +152,29 @@ class BufferPool:
     def unmark_dirty(self, key):
         self.dirty_pages.remove(key)
 
+    def pin(self, key):
+        # 被 pin 住的页不会被 LRU 淘汰
+        self.lru_cache.pin(key)
+
+    def unpin(self, key):
+        self.lru_cache.unpin(key)
+
+    def discard(self, relation_name):
+        """丢弃一个关系在内存中的全部页（包括脏页），用于关系被重建或删除的时候"""
+        for key in [k for k in self.lru_cache.cache if k[0] == relation_name]:
+            self.lru_cache.remove(key)
+        for key in [k for k in self.lru_cache.evicted if k[0] == relation_name]:
+            del self.lru_cache.evicted[key]
+        self.dirty_pages = {k for k in self.dirty_pages if k[0] != relation_name}
+
+    def detach(self, buff):
+        """把仍然是 buff (mmap 映射区) 上的视图的页都拷贝出来，在映射区被丢弃之前调用"""
+        pages = [node.value for node in self.lru_cache.cache.values()]
+        pages.extend(self.lru_cache.evicted.values())
+        for page in pages:
+            if page.uses_buffer(buff):
+                page.detach()
+
     def get_all_dirty_pages(self):
         for key in sorted(self.dirty_pages):
             if key in self.lru_cache.cache:
@@ -0,0 +1,108 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.smgr import smgr, IO_METHOD_MMAP
+
+# 预读 (readahead)：顺序扫描访问第 N 页时，由后台的 I/O 线程提前读取 N+1..N+k 页，
+# 使得磁盘读与元组的解码、过滤重叠起来
+READAHEAD_WORKERS = 2
+# 预读窗口 k 从 READAHEAD_MIN_WINDOW 开始，只要访问保持顺序，就翻倍增长
+READAHEAD_MIN_WINDOW = 4
+READAHEAD_MAX_WINDOW = 32
+
+
+class ScanState:
+    def __init__(self):
+        # 还没有访问过任何页，第一次访问不算作顺序访问
+        self.last_pageno = None
+        self.window = READAHEAD_MIN_WINDOW
+        # 已经发起过预读的最大页号，避免重复发起
+        self.issued_pageno = -1
+
+
+class Readahead:
+    """后台线程只负责把页的原始字节读到缓冲区中，不会访问 buffer pool;
+    预读的结果由扫描线程在缺页时通过 take() 取走，再装载到 buffer pool 中，
+    因此，buffer pool 仍然只会被一个线程访问。
+    """
+
+    def __init__(self, workers=READAHEAD_WORKERS):
+        self.workers = workers
+        self.executor = None
+        self.pending = {}
+        self.states = {}
+        self.mutex = threading.Lock()
+
+    def _submit(self, key, read_page):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                               thread_name_prefix='readahead')
+        _, pageno = key
+        self.pending[key] = self.executor.submit(read_page, pageno)
+
+    def _cancel(self, table_name):
+        for key in [k for k in self.pending if k[0] == table_name]:
+            self.pending.pop(key).cancel()
+
+    def access(self, table_name, pageno, disk_pages, read_page, compressed=False):
+        """扫描访问到第 pageno 页时调用，用于识别顺序访问，并通过 read_page(pageno) 发起预读"""
+        # mmap 方式下，缺页不需要系统调用，交给操作系统自己的预读即可；
+        # 但压缩表的页仍然需要解压，值得放到后台线程中
+        if smgr.io_method == IO_METHOD_MMAP and not compressed:
+            return
+        with self.mutex:
+            state = self.states.setdefault(table_name, ScanState())
+            if pageno == state.last_pageno:
+                return
+            if state.last_pageno is not None and pageno == state.last_pageno + 1:
+                state.window = min(state.window * 2, READAHEAD_MAX_WINDOW)
+            else:
+                # 访问不再是顺序的，此前发起的预读很可能已经用不到了
+                self._cancel(table_name)
+                state.window = READAHEAD_MIN_WINDOW
+                state.issued_pageno = pageno
+            state.last_pageno = pageno
+
+            # 只预读磁盘上已经存在的页，新分配的页只在内存中
+            end = min(pageno + state.window, disk_pages - 1)
+            for next_pageno in range(max(state.issued_pageno, pageno) + 1, end + 1):
+                key = (table_name, next_pageno)
+                # 已经在内存中的页（包括被淘汰但还没有写回的脏页）不需要预读，
+                # 磁盘上的版本可能是旧的
+                if key in buffer_pool or key in buffer_pool.lru_cache.evicted \
+                        or key in self.pending:
+                    continue
+                self._submit(key, read_page)
+            state.issued_pageno = max(state.issued_pageno, end)
+
+    def take(self, table_name, pageno):
+        """取走预读好的缓冲区，没有发起过预读则返回 None"""
+        with self.mutex:
+            future = self.pending.pop((table_name, pageno), None)
+        if future is None:
+            return None
+        return future.result()
+
+    def discard(self, table_name, pageno):
+        """页被写回磁盘时调用，丢弃可能已经过时的预读结果"""
+        with self.mutex:
+            future = self.pending.pop((table_name, pageno), None)
+        if future is not None:
+            future.cancel()
+
+    def finish(self, table_name):
+        """扫描结束（包括提前结束）时调用，丢弃该表还没有被取走的预读结果"""
+        with self.mutex:
+            self._cancel(table_name)
+            self.states.pop(table_name, None)
+
+    def reset(self):
+        with self.mutex:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+            self.states.clear()
+
+
+readahead = Readahead()
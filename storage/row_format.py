@@ -0,0 +1,320 @@
+import pickle
+import struct
+import zlib
+from functools import lru_cache
+
+from imoocdb.storage.slotted_page import PAGE_SIZE, PageHeader, Slot
+
+# 堆表元组的二进制行格式，由系统表中的列类型驱动，布局为：
+# | magic (1B) | null bitmap (ceil(n / 8) B) | 各个非 NULL 列的值 ... |
+# 其中：
+#   整数列：定长 8 字节有符号整数
+#   其他列：2 字节长度前缀 + utf-8 编码的字节串
+# 列数本身来自系统表，不需要存储在每一行中
+# pickle (protocol >= 2) 产生的字节流总是以 0x80 开头，因此，通过第一个字节，
+# 就可以区分出新的行格式与旧的 pickle 格式
+ROW_FORMAT_MAGIC = 0x01
+PICKLE_MAGIC = 0x80
+
+ROW_HEADER = struct.Struct('<B')
+INT64 = struct.Struct('<q')
+LENGTH = struct.Struct('<H')
+# 一个页才 8kb，长度前缀的最高位留作他用
+MAX_INLINE_LENGTH = 0x7fff
+
+# TOAST (The Oversized-Attribute Storage Technique)：
+# 长度前缀的最高位为 1 时，表示该值被 "toast" 过了，后面的字节串不是 utf-8 文本，
+# 而是以 1 字节的类型开头：
+#   TOAST_COMPRESSED: 后面是 zlib 压缩之后的文本，仍然存放在行内；
+#   TOAST_EXTERNAL: 后面是 TOAST_POINTER, 指向溢出表中的第一个 chunk
+TOAST_FLAG = 0x8000
+TOAST_COMPRESSED = 1
+TOAST_EXTERNAL = 2
+TOAST_KIND = struct.Struct('<B')
+# 是否压缩过 (1B) | 溢出表中第一个 chunk 的 pageno | sid
+TOAST_POINTER = struct.Struct('<BQQ')
+# 整行超过该大小时，才开始 toast, 从最长的列开始，直到整行不超过该大小为止，
+# 这样，一个页至少可以放下 4 个元组
+TOAST_TUPLE_THRESHOLD = PAGE_SIZE // 4
+# 太短的值即便 toast 了，也省不下多少空间
+TOAST_MIN_VALUE_SIZE = 128
+# 溢出表中的每个 chunk: | 下一个 chunk 的 pageno | sid | 数据 |，最后一个 chunk 的 pageno 为 TOAST_NO_NEXT
+TOAST_CHUNK_HEADER = struct.Struct('<QQ')
+TOAST_NO_NEXT = 0xffffffffffffffff
+# 每个溢出页恰好可以放下 4 个 chunk
+TOAST_CHUNK_SIZE = ((PAGE_SIZE - PageHeader.size()) // 4 - Slot.size() - 1 -
+                    TOAST_CHUNK_HEADER.size)
+
+INTEGER_TYPES = ('int', 'integer', 'bigint', 'smallint')
+
+
+class ColumnKind:
+    INTEGER = 0
+    TEXT = 1
+
+
+def column_kind(type_name):
+    if str(type_name).lower() in INTEGER_TYPES:
+        return ColumnKind.INTEGER
+    return ColumnKind.TEXT
+
+
+class RowCodec:
+    """按照表结构（列类型），对元组进行编码、解码"""
+
+    def __init__(self, types):
+        self.kinds = tuple(column_kind(t) for t in types)
+        self.bitmap_size = (len(self.kinds) + 7) // 8
+        self.values_position = ROW_HEADER.size + self.bitmap_size
+
+    def encode(self, tup, store_external=None) -> bytes:
+        """如果元组中的值与列类型不匹配，则抛出 ValueError.
+        store_external(payload) 用于把过长的值写到溢出表中，返回第一个 chunk 的 location;
+        为 None 时只做压缩，不做行外存储。
+        """
+        if len(tup) != len(self.kinds):
+            raise ValueError('the number of values does not match the columns.')
+        bitmap = bytearray(self.bitmap_size)
+        # 每个非 NULL 列编码之后的字节串，toast 时只需要替换其中的某几项
+        segments = []
+        texts = {}
+        for i, (kind, value) in enumerate(zip(self.kinds, tup)):
+            if value is None:
+                bitmap[i >> 3] |= 1 << (i & 7)
+            elif kind == ColumnKind.INTEGER:
+                # bool 是 int 的子类，但不应该被当作整数存储
+                if type(value) is not int:
+                    raise ValueError(f'{value!r} is not an integer.')
+                try:
+                    segments.append(INT64.pack(value))
+                except struct.error as e:
+                    raise ValueError(e)
+            else:
+                if not isinstance(value, str):
+                    raise ValueError(f'{value!r} is not a string.')
+                data = value.encode('utf-8')
+                texts[len(segments)] = data
+                segments.append(LENGTH.pack(len(data)) + data
+                                if len(data) <= MAX_INLINE_LENGTH else None)
+        self._toast(segments, texts, store_external)
+        return (ROW_HEADER.pack(ROW_FORMAT_MAGIC) +
+                bytes(bitmap) + b''.join(segments))
+
+    def _toast(self, segments, texts, store_external):
+        def row_size():
+            return (ROW_HEADER.size + self.bitmap_size +
+                    sum(len(segment) for segment in segments if segment is not None))
+
+        # 超出长度前缀表示范围的值，无论整行多大，都必须 toast
+        candidates = sorted((j for j, data in texts.items()
+                             if len(data) > TOAST_MIN_VALUE_SIZE or segments[j] is None),
+                            key=lambda j: len(texts[j]), reverse=True)
+        # 第一轮：从最长的值开始，压缩之后仍然存放在行内
+        compressed = {}
+        for j in candidates:
+            if segments[j] is not None and row_size() <= TOAST_TUPLE_THRESHOLD:
+                break
+            payload = zlib.compress(texts[j])
+            if len(payload) + TOAST_KIND.size >= len(texts[j]):
+                # 压缩不了（例如随机的数据），保持原样
+                continue
+            compressed[j] = payload
+            segment = self._toast_segment(TOAST_COMPRESSED, payload)
+            if segment is not None:
+                segments[j] = segment
+        # 第二轮：仍然太长的话，从当前最长的值开始，挪到溢出表中，行内只留下一个指针
+        if store_external is not None:
+            candidates.sort(key=lambda j: len(segments[j]) if segments[j] is not None
+                            else len(compressed.get(j, texts[j])), reverse=True)
+            for j in candidates:
+                if segments[j] is not None and row_size() <= TOAST_TUPLE_THRESHOLD:
+                    break
+                payload = compressed.get(j, texts[j])
+                pageno, sid = store_external(payload)
+                segments[j] = self._toast_segment(
+                    TOAST_EXTERNAL, TOAST_POINTER.pack(j in compressed, pageno, sid))
+        if any(segment is None for segment in segments):
+            raise ValueError('the string is too long.')
+
+    @staticmethod
+    def _toast_segment(kind, payload):
+        length = TOAST_KIND.size + len(payload)
+        if length > MAX_INLINE_LENGTH:
+            return None
+        return LENGTH.pack(TOAST_FLAG | length) + TOAST_KIND.pack(kind) + payload
+
+    @staticmethod
+    def _decode_text(buff, position, fetch_external=None):
+        """返回 (文本, 该列在 buff 中占用的字节数)"""
+        length = LENGTH.unpack_from(buff, position)[0]
+        position += LENGTH.size
+        if not length & TOAST_FLAG:
+            return str(buff[position: position + length], 'utf-8'), LENGTH.size + length
+        length &= MAX_INLINE_LENGTH
+        kind = TOAST_KIND.unpack_from(buff, position)[0]
+        payload = buff[position + TOAST_KIND.size: position + length]
+        if kind == TOAST_EXTERNAL:
+            if fetch_external is None:
+                raise ValueError('can not read an out-of-line value.')
+            is_compressed, pageno, sid = TOAST_POINTER.unpack_from(payload)
+            data = fetch_external((pageno, sid))
+            if is_compressed:
+                data = zlib.decompress(data)
+        else:
+            data = zlib.decompress(payload)
+        return str(data, 'utf-8'), LENGTH.size + length
+
+    @staticmethod
+    def _text_size(buff, position):
+        return LENGTH.size + (LENGTH.unpack_from(buff, position)[0] & MAX_INLINE_LENGTH)
+
+    def decode(self, buff, fetch_external=None) -> tuple:
+        values = []
+        position = self.values_position
+        for i, kind in enumerate(self.kinds):
+            if buff[ROW_HEADER.size + (i >> 3)] & (1 << (i & 7)):
+                values.append(None)
+            elif kind == ColumnKind.INTEGER:
+                values.append(INT64.unpack_from(buff, position)[0])
+                position += INT64.size
+            else:
+                value, size = self._decode_text(buff, position, fetch_external)
+                values.append(value)
+                position += size
+        return tuple(values)
+
+    def is_null(self, buff, i):
+        return bool(buff[ROW_HEADER.size + (i >> 3)] & (1 << (i & 7)))
+
+    def column_position(self, buff, i):
+        """第 i 列在 buff 中的起始位置，前面的列只跳过，不解码"""
+        position = self.values_position
+        for j in range(i):
+            if self.is_null(buff, j):
+                continue
+            if self.kinds[j] == ColumnKind.INTEGER:
+                position += INT64.size
+            else:
+                position += self._text_size(buff, position)
+        return position
+
+    def decode_value(self, buff, i, position, fetch_external=None):
+        if self.is_null(buff, i):
+            return None
+        if self.kinds[i] == ColumnKind.INTEGER:
+            return INT64.unpack_from(buff, position)[0]
+        return self._decode_text(buff, position, fetch_external)[0]
+
+    def decode_columns(self, buff, indexes, fetch_external=None) -> tuple:
+        """只解码 indexes 中的列，其他列的位置上用 None 占位，
+        这样返回的元组与完整元组的下标仍然一一对应。
+        被 toast 过的列只有在需要时才解压、读取溢出表。
+        """
+        indexes = set(indexes)
+        values = [None] * len(self.kinds)
+        if not indexes:
+            return tuple(values)
+        last = max(indexes)
+        position = self.values_position
+        for i in range(last + 1):
+            if self.is_null(buff, i):
+                continue
+            if i in indexes:
+                values[i] = self.decode_value(buff, i, position, fetch_external)
+            if self.kinds[i] == ColumnKind.INTEGER:
+                position += INT64.size
+            else:
+                position += self._text_size(buff, position)
+        return tuple(values)
+
+    def external_pointers(self, buff):
+        """返回该行中所有行外存储的值在溢出表中的第一个 chunk 的 location"""
+        position = self.values_position
+        for i, kind in enumerate(self.kinds):
+            if self.is_null(buff, i):
+                continue
+            if kind == ColumnKind.INTEGER:
+                position += INT64.size
+                continue
+            length = LENGTH.unpack_from(buff, position)[0]
+            payload_position = position + LENGTH.size + TOAST_KIND.size
+            if (length & TOAST_FLAG and TOAST_KIND.unpack_from(
+                    buff, position + LENGTH.size)[0] == TOAST_EXTERNAL):
+                _, pageno, sid = TOAST_POINTER.unpack_from(buff, payload_position)
+                yield pageno, sid
+            position += LENGTH.size + (length & MAX_INLINE_LENGTH)
+
+
+class RowAccessor:
+    """元组的只读访问器：行为上类似 tuple, 但只有在访问某一列时，才解码该列"""
+
+    def __init__(self, codec, buff, fetch_external=None):
+        self.codec = codec
+        self.buff = buff
+        self.fetch_external = fetch_external
+        self._values = {}
+
+    def __len__(self):
+        return len(self.codec.kinds)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self[j] for j in range(*i.indices(len(self))))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('column index out of range.')
+        if i not in self._values:
+            position = self.codec.column_position(self.buff, i)
+            self._values[i] = self.codec.decode_value(self.buff, i, position,
+                                                      self.fetch_external)
+        return self._values[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+@lru_cache(maxsize=None)
+def _get_row_codec(types):
+    return RowCodec(types)
+
+
+def get_row_codec(types) -> RowCodec:
+    # 相同结构的表共用同一个 codec，因此缓存的 key 是列类型，而不是表名，
+    # 这样也就不存在表结构变化后缓存失效的问题
+    return _get_row_codec(tuple(types))
+
+
+def is_pickle_format(buff):
+    return len(buff) > 0 and buff[0] == PICKLE_MAGIC
+
+
+def encode_tuple(tup, codec=None, store_external=None) -> bytes:
+    if codec is not None:
+        try:
+            return codec.encode(tup, store_external)
+        except ValueError:
+            # 与列类型不匹配的元组（例如没有做类型检查的写入），
+            # 退化为 pickle 格式存储，读取时可以根据 magic 区分
+            pass
+    return pickle.dumps(tup)
+
+
+def decode_tuple(buff, codec=None, columns=None, fetch_external=None) -> tuple:
+    """columns 是需要解码的列下标，为 None 时解码全部的列"""
+    if len(buff) == 0:
+        return ()
+    if buff[0] == ROW_FORMAT_MAGIC:
+        assert codec is not None
+        if columns is None:
+            return codec.decode(buff, fetch_external)
+        return codec.decode_columns(buff, columns, fetch_external)
+    # pickle 格式只能整体解码
+    return pickle.loads(buff)
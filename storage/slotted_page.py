@@ -1,7 +1,11 @@
+import struct
+
 from imoocdb.errors import PageError
 
 PAGE_SIZE = 8 * 1024  # 8kb
 LITTLE_ORDER = 'little'
+# 所有定长结构体中的字段，都是 8 字节的无符号整数（小端序）
+UINT64 = struct.Struct('<Q')
 
 
 def uint8_to_bytes(value):
@@ -12,17 +16,40 @@ def bytes_to_uint8(buff):
     return int.from_bytes(buff, LITTLE_ORDER, signed=False)
 
 
+class Field:
+    """描述结构体中的第 index 个字段，读写时直接作用在结构体所映射的缓冲区上"""
+
+    def __init__(self, index):
+        self.offset = index * UINT64.size
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return UINT64.unpack_from(instance.buff, instance.base + self.offset)[0]
+
+    def __set__(self, instance, value):
+        UINT64.pack_into(instance.buff, instance.base + self.offset, value)
+
+
 class BaseStructure:
+    """定长结构体。
+    结构体本身不保存字段的值，而是映射到缓冲区 buff 的 base 偏移处，
+    因此，对字段的读写就是对缓冲区的原地读写，不需要再做额外的序列化。
+    """
+
+    def __init__(self, buff=None, base=0):
+        if buff is None:
+            buff = bytearray(self.size())
+        self.buff = buff
+        self.base = base
+
     def serialize(self) -> bytes:
-        buff = bytearray()
-        for field_name in self.serializable_fields():
-            buff += (uint8_to_bytes(getattr(self, field_name)))
-        return bytes(buff)
+        return bytes(self.buff[self.base: self.base + self.size()])
 
     @classmethod
     def size(cls):
         # 先这么写，避免添加字段后的霰弹式修改
-        return len(cls.serializable_fields()) * 8
+        return len(cls.serializable_fields()) * UINT64.size
 
     @classmethod
     def serializable_fields(cls):
@@ -31,13 +58,7 @@ class BaseStructure:
     @classmethod
     def deserialize(cls, buff):
         assert len(buff) == cls.size()
-        page_header = cls()
-        position = 0
-        for field_name in cls.serializable_fields():
-            value = bytes_to_uint8(buff[position: position + 8])
-            setattr(page_header, field_name, value)
-            position += 8
-        return page_header
+        return cls(bytearray(buff))
 
     def __eq__(self, other):
         if not isinstance(other, type(self)):
@@ -56,25 +77,22 @@ class BaseStructure:
 
 
 class PageHeader(BaseStructure):
-    def __init__(self):
-        """Header 是定长的！！！"""
-        # 如果不显性写明 PageNo，也可以通过 总的文件大小 / PAGE_SIZE 来获取
-        # 我们后面再考虑是否显性地增加这个字段
-
-        # self.pageno = 0
-        # 来自 WAL (redo)，用于表示哪个WAL最后修改了这个页
-        self.lsn = 0
-        # 可能还有些其他字段，根据需要再添加
-        # 如，crc 校验码之类的
-        # 预留的标志字段
-        self.flags = 0
-        # 预留字段，为某些个性化信息，提供承载的地方
-        self.reserved = 0
-
-        # slotted page 可能会用到这两个字段，用于表示
-        # 最后一个record和第一个记录的位置
-        self.free_space_start = 0  # free space start: Postgres lower
-        self.free_space_end = 0  # free space end: Postgres upper
+    """Header 是定长的！！！
+    如果不显性写明 PageNo，也可以通过 总的文件大小 / PAGE_SIZE 来获取
+    我们后面再考虑是否显性地增加这个字段
+    """
+    # 来自 WAL (redo)，用于表示哪个WAL最后修改了这个页
+    lsn = Field(0)
+    # 可能还有些其他字段，根据需要再添加
+    # 如，crc 校验码之类的
+    # 预留的标志字段
+    flags = Field(1)
+    # 预留字段，为某些个性化信息，提供承载的地方
+    reserved = Field(2)
+    # slotted page 用这两个字段表示空闲空间的范围:
+    # [free_space_start, free_space_end)
+    free_space_start = Field(3)  # free space start: Postgres lower
+    free_space_end = Field(4)  # free space end: Postgres upper
 
     @classmethod
     def serializable_fields(cls):
@@ -85,153 +103,306 @@ class RecordState:
     UNUSED = 0
     NORMAL = 1
     DEAD = 2
+    # heap-only tuple (HOT) 更新之后，原来的 slot 变为 REDIRECT, 其 offset 字段
+    # 保存的是新版本所在的 sid, length 为 0; 新版本的 slot 为 HEAP_ONLY,
+    # 它只能通过 REDIRECT 访问到，扫描时不会单独返回
+    REDIRECT = 3
+    HEAP_ONLY = 4
 
 
 class Slot(BaseStructure):
-    def __init__(self):
-        """Slot 是定长的！！！"""
-        self.offset = 0
-        self.length = 0
-        self.state = 0  # 例如该state可以实现标记清除
+    """Slot 是定长的！！！"""
+    # offset 是 record 在页内的绝对偏移
+    offset = Field(0)
+    length = Field(1)
+    state = Field(2)  # 例如该state可以实现标记清除
 
     @classmethod
     def serializable_fields(cls):
         return 'offset', 'length', 'state'
 
 
+# 一次性读写一个 slot 的全部字段：offset, length, state
+SLOT_STRUCT = struct.Struct('<QQQ')
+assert SLOT_STRUCT.size == Slot.size()
+
+
 class Page:
-    def __init__(self, header=None):
-        if header:
-            self.page_header = header
-        else:
-            self.page_header = PageHeader()
-        self.slot_directory = list()
-        self.records = bytearray()  # 用于存放数据元组 tuple，或者index的key
+    """Page 整体就是一个 PAGE_SIZE 大小的缓冲区，布局为：
+
+    | header | slot 0 | slot 1 | ... -> free space <- ... | record 1 | record 0 |
+
+    slot directory 从前往后增长，record 从页尾往前增长，
+    所有的读写都直接在缓冲区上原地完成。
+    缓冲区也可以是只读的 memoryview (例如 mmap 映射区上的视图)，
+    此时在第一次修改之前才拷贝出一份可写的缓冲区（写时复制）。
+    """
+
+    def __init__(self, buff=None):
+        if buff is None:
+            buff = bytearray(PAGE_SIZE)
+        assert len(buff) == PAGE_SIZE
+        self.buff = buff
+        self.page_header = PageHeader(buff)
+        # 全 0 的缓冲区，说明这是一个从未被初始化过的页
+        if self.page_header.free_space_start == 0:
+            self._ensure_writable()
+            self.page_header.free_space_start = PageHeader.size()
+            self.page_header.free_space_end = PAGE_SIZE
+
+    def _ensure_writable(self):
+        if isinstance(self.buff, bytearray):
+            return
+        self.buff = bytearray(self.buff)
+        self.page_header = PageHeader(self.buff)
+
+    def uses_buffer(self, buff):
+        """页是否仍然直接使用 buff (例如 mmap 映射区) 上的视图"""
+        return isinstance(self.buff, memoryview) and self.buff.obj is buff
+
+    def detach(self):
+        # 不再引用调用者的缓冲区，拷贝出一份自己的
+        self._ensure_writable()
+
+    @property
+    def slot_count(self):
+        return ((self.page_header.free_space_start - PageHeader.size()) //
+                Slot.size())
+
+    @property
+    def free_space_size(self):
+        return self.page_header.free_space_end - self.page_header.free_space_start
 
     @property
     def total_record_size(self):
-        return len(self.records)
+        return PAGE_SIZE - self.page_header.free_space_end
 
     @property
     def total_slot_directory_size(self):
-        return len(self.slot_directory) * Slot.size()
-
-    def allocate_slot(self, record):
-        # 我们在 allocate_slot 这个方法里面，没有修改任何状态
-        # 调用者，别忘了自己来修改Page的状态！
-        current_slot_num = len(self.slot_directory)
-        total_slot_size = (current_slot_num + 1) * Slot.size()
-        total_record_size = self.total_record_size + len(record)
-        total_page_size = (self.page_header.size() +
-                           total_slot_size +
-                           total_record_size
-                           )
-        if total_page_size >= PAGE_SIZE:
-            return None
-        slot = Slot()
-        # 这里面记录逻辑位置和物理位置都可以，
-        # 我们暂时先用物理位置，因为，在Page这一层，
-        # 我们还不知道 record 具体是什么对象类型，只知道他是一个 bytes
-        # self.total_record_size 意思是当前 record 写入的起始位置
-        slot.offset = self.total_record_size
-        slot.length = len(record)
-        slot.state = RecordState.UNUSED
-        return slot
+        return self.page_header.free_space_start - PageHeader.size()
+
+    @staticmethod
+    def _slot_position(sid):
+        return PageHeader.size() + sid * Slot.size()
+
+    def _check_sid(self, sid):
+        if sid >= self.slot_count:
+            raise PageError('invalid sid.')
+
+    def get_slot(self, sid) -> Slot:
+        # 返回的 Slot 只是缓冲区上的一个视图，修改它就是修改 Page
+        self._check_sid(sid)
+        self._ensure_writable()
+        return Slot(self.buff, self._slot_position(sid))
+
+    def slot_state(self, sid):
+        self._check_sid(sid)
+        return UINT64.unpack_from(
+            self.buff, self._slot_position(sid) + Slot.state.offset)[0]
+
+    def is_live(self, sid):
+        """sid 是否对应一个存活的元组（可能经过了 HOT 更新）"""
+        return self.slot_state(sid) in (RecordState.NORMAL, RecordState.REDIRECT)
+
+    def _find_unused_slot(self):
+        for sid in range(self.slot_count):
+            if UINT64.unpack_from(self.buff, self._slot_position(sid) + Slot.state.offset)[0] \
+                    == RecordState.UNUSED:
+                return sid
+        return None
+
+    def can_insert(self, record_size):
+        # 不能把空闲空间完全用完，与此前的实现保持一致
+        return Slot.size() + record_size < self.free_space_size
 
     def set_header(self, lsn):
+        # free_space_start 与 free_space_end 在每次修改 Page 时已经原地维护了
+        self._ensure_writable()
         self.page_header.lsn = lsn
-        self.page_header.free_space_start = (self.page_header.size() +
-                                             self.total_slot_directory_size)
-        self.page_header.free_space_end = PAGE_SIZE - len(self.records)
 
     def insert(self, record: bytes) -> int:
-        slot = self.allocate_slot(record)
-        if not slot:
+        if not self.can_insert(len(record)):
             raise PageError('out of space in the page.')
-        self.slot_directory.append(slot)
-        self.records += record
-        # 严格意义上，slotted page 的 新record 是加在最前面的，即：
-        # self.records = (record + self.records)
-        # 但是，我们可以通过total_size这个机制，实现逻辑等价
-        slot.state = RecordState.NORMAL
+        self._ensure_writable()
+        sid = self.slot_count
+        slot_position = self.page_header.free_space_start
+        offset = self.page_header.free_space_end - len(record)
+        self.buff[offset: offset + len(record)] = record
+        SLOT_STRUCT.pack_into(self.buff, slot_position,
+                              offset, len(record), RecordState.NORMAL)
+        self.page_header.free_space_start = slot_position + Slot.size()
+        self.page_header.free_space_end = offset
         # 返回 slot 的下标，对于 堆表 来说，可以作为唯一的id，
         # 即 tid (tuple id)
-        return len(self.slot_directory) - 1
+        return sid
 
     def delete(self, sid) -> bool:
-        if sid >= len(self.slot_directory):
-            raise PageError('invalid sid.')
-        slot: Slot
-        slot = self.slot_directory[sid]
+        self._check_sid(sid)
         # 用到的是标记清除法，如果原地删除，对于我们的Page来讲，很简单
         # 但是，有一个场景会很麻烦：索引的更新，例如
         # 我们有一个元组 tid = 1, 那么，其他的元组id 可能是 2,3,4, ...
         # 如果说，直接把 tid = 1 的元组删了，空间页回收了，那么，其他的
         # 该元组后面的元组的 tid 也要对应 -1, 即 1,2,3, ...
         # 所以这样，对索引的更新就会工作量非常大
-        slot.state = RecordState.DEAD
+        self._ensure_writable()
+        slot_position = self._slot_position(sid)
+        offset, length, state = SLOT_STRUCT.unpack_from(self.buff, slot_position)
+        if state == RecordState.REDIRECT:
+            # 把 HOT 链收拢回原来的 slot: 原来的 slot 指向新版本的 record,
+            # 新版本的 slot 置为不占用空间的 DEAD. 它同样要等到整理时才变为 UNUSED,
+            # 在此之前不能被复用
+            heap_only_position = self._slot_position(offset)
+            offset, length, _ = SLOT_STRUCT.unpack_from(self.buff, heap_only_position)
+            SLOT_STRUCT.pack_into(self.buff, heap_only_position, 0, 0, RecordState.DEAD)
+        SLOT_STRUCT.pack_into(self.buff, slot_position, offset, length, RecordState.DEAD)
         return True
 
-    def select(self, sid) -> bytes:
-        if sid >= len(self.slot_directory):
-            raise PageError('invalid sid.')
-        slot: Slot
-        slot = self.slot_directory[sid]
+    def restore(self, sid, record: bytes):
+        """撤销删除：把 record 放回原来的 sid, 使得索引中记录的 location 仍然有效。
+        死元组在删除它的事务结束之前不会被整理回收，record 通常仍然在原来的位置上。
+        """
+        self._check_sid(sid)
+        self._ensure_writable()
+        slot_position = self._slot_position(sid)
+        offset, length, _ = SLOT_STRUCT.unpack_from(self.buff, slot_position)
+        if len(record) > length:
+            if len(record) >= self.free_space_size:
+                raise PageError('out of space in the page.')
+            offset = self.page_header.free_space_end - len(record)
+            self.page_header.free_space_end = offset
+        self.buff[offset: offset + len(record)] = record
+        SLOT_STRUCT.pack_into(self.buff, slot_position, offset, len(record), RecordState.NORMAL)
+
+    def select_view(self, sid) -> memoryview:
+        """与 select() 相同，但返回的是缓冲区上的 memoryview，不发生拷贝。
+        注意：调用者不能在 Page 被修改之后继续使用该视图。
+        """
+        self._check_sid(sid)
+        offset, length, state = SLOT_STRUCT.unpack_from(
+            self.buff, self._slot_position(sid))
+        if state == RecordState.REDIRECT:
+            offset, length, state = SLOT_STRUCT.unpack_from(
+                self.buff, self._slot_position(offset))
         # 由于我们采用了标记清除的机制，所以，我们此时要判断一下该标记
-        if slot.state != RecordState.NORMAL:
-            return bytes()
-        record = bytes(self.records[slot.offset: slot.offset + slot.length])
-        return record
+        if state not in (RecordState.NORMAL, RecordState.HEAP_ONLY):
+            return memoryview(b'')
+        return memoryview(self.buff)[offset: offset + length]
+
+    def select(self, sid) -> bytes:
+        return bytes(self.select_view(sid))
 
     def update(self, sid, record: bytes) -> int:
-        # 有两种实现方法：
-        # 一种是先删除，再新增
-        # 另一种是直接覆盖
-        # 第二种：先判断一下，是否有足够的空间，用于覆盖
-        slot = self.slot_directory[sid]
-        if len(record) <= slot.length:
-            self.records[slot.offset: slot.offset + len(record)] = record
-            slot.length = len(record)
-            slot.state = RecordState.NORMAL
-            # 第二种方法，虽然做到了原地更新，但是还没有做完善，
-            # 还有会一些空洞
-            # 我们可以在此时，进行后续元素的整体搬移，也可以后续批量去做组织
+        """更新之后，元组仍然可以通过原来的 sid 访问到，返回值就是 sid.
+        新的 record 不比原来的长时，直接原地覆盖；
+        否则，作为 heap-only tuple 放在本页的其他位置，原来的 slot 变为 REDIRECT 指向它，
+        这样，索引中记录的 location 不需要变化。本页放不下时抛出 PageError, 页不被修改。
+        这里不做页内整理：哪些死元组可以回收由调用者决定，见 fits_after_compact().
+        """
+        self._check_sid(sid)
+        self._ensure_writable()
+        slot_position = self._slot_position(sid)
+        offset, length, state = SLOT_STRUCT.unpack_from(self.buff, slot_position)
+        target_sid = sid
+        if state == RecordState.REDIRECT:
+            target_sid = offset
+            offset, length, state = SLOT_STRUCT.unpack_from(
+                self.buff, self._slot_position(target_sid))
+        if len(record) <= length:
+            self.buff[offset: offset + len(record)] = record
+            SLOT_STRUCT.pack_into(self.buff, self._slot_position(target_sid),
+                                  offset, len(record), state)
+            # 原地更新之后留下的空洞，由 compact() 统一回收
             return sid
-        # 第一种：
-        slot = self.slot_directory[sid]
-        old_state = slot.state
-        try:
-            self.delete(sid)
-            new_sid = self.insert(record)
-        except PageError as e:
-            slot.state = old_state
-            raise e
-        return new_sid
 
-    def serialize(self) -> bytes:
-        free_space_size = (self.page_header.free_space_end -
-                           self.page_header.free_space_start)
-        assert PAGE_SIZE == (self.page_header.size() +
-                             self.total_slot_directory_size +
-                             free_space_size +
-                             self.total_record_size)
-        slot_directory_bytes = bytearray()
-        for slot in self.slot_directory:
-            slot_directory_bytes += slot.serialize()
-        return (
-                self.page_header.serialize() +
-                bytes(slot_directory_bytes) +
-                bytes(free_space_size) +
-                bytes(self.records)
-        )
+        new_sid = self._insert_heap_only(record)
+        if target_sid != sid:
+            # 旧的 heap-only 版本已经没有用了
+            UINT64.pack_into(self.buff,
+                             self._slot_position(target_sid) + Slot.state.offset,
+                             RecordState.DEAD)
+        SLOT_STRUCT.pack_into(self.buff, slot_position, new_sid, 0, RecordState.REDIRECT)
+        return sid
+
+    def fits_after_compact(self, record_size, keep=()):
+        """compact(keep) 之后，能否放下一个 heap-only tuple"""
+        # 整理之后，不在 keep 中的 DEAD 的 slot 会变为 UNUSED, 可以被复用
+        has_free_slot = any(
+            self.slot_state(sid) == RecordState.UNUSED for sid in range(self.slot_count)
+        ) or bool(self.reclaimable_slots(keep))
+        slot_size = 0 if has_free_slot else Slot.size()
+        return slot_size + record_size < self.free_space_size + self.reclaimable_size(keep)
+
+    def _insert_heap_only(self, record: bytes) -> int:
+        # 优先复用 UNUSED 的 slot, 避免频繁的 HOT 更新让 slot directory 不断变长。
+        # UNUSED 的 slot 只由 compact() 产生，而整理不会回收还没有结束的事务删除的元组，
+        # 所以这里复用的 slot 不会再被任何 undo 日志引用
+        sid = self._find_unused_slot()
+        if sid is None:
+            sid = self.insert(record)
+            UINT64.pack_into(self.buff, self._slot_position(sid) + Slot.state.offset,
+                             RecordState.HEAP_ONLY)
+            return sid
+        if len(record) >= self.free_space_size:
+            raise PageError('out of space in the page.')
+        offset = self.page_header.free_space_end - len(record)
+        self.buff[offset: offset + len(record)] = record
+        SLOT_STRUCT.pack_into(self.buff, self._slot_position(sid),
+                              offset, len(record), RecordState.HEAP_ONLY)
+        self.page_header.free_space_end = offset
+        return sid
+
+    def reclaimable_size(self, keep=()):
+        """死元组和原地更新留下的空洞所占用的空间，keep 的含义见 compact()"""
+        live_size = 0
+        for sid in range(self.slot_count):
+            _, length, state = SLOT_STRUCT.unpack_from(
+                self.buff, self._slot_position(sid))
+            if state in (RecordState.NORMAL, RecordState.HEAP_ONLY) or sid in keep:
+                live_size += length
+        return self.total_record_size - live_size
+
+    def reclaimable_slots(self, keep=()):
+        """整理之后会变为 UNUSED 的 slot"""
+        return [sid for sid in range(self.slot_count)
+                if sid not in keep and self.slot_state(sid) == RecordState.DEAD]
+
+    def compact(self, keep=()) -> int:
+        """页内整理：把存活的 record 重新紧凑地排列到页尾，回收死元组与空洞的空间。
+        slot 相当于行指针 (line pointer)，整理时只修改 slot 中的 offset,
+        slot 的下标 (sid) 保持不变，因此索引中记录的 location 仍然有效。
+        死元组的 slot 被置为 UNUSED, 之后可以被复用；REDIRECT 的 slot 不占用 record 空间，保持不变。
+        keep 中的死元组是还没有结束的事务删除的，回滚时要放回原来的 sid, 因此与存活的元组一样保留。
+        返回回收的字节数。该过程是确定性的，因此可以通过 redo 日志（其中记录了 keep）重放。
+        """
+        self._ensure_writable()
+        records = []
+        for sid in range(self.slot_count):
+            slot_position = self._slot_position(sid)
+            offset, length, state = SLOT_STRUCT.unpack_from(self.buff, slot_position)
+            if state in (RecordState.NORMAL, RecordState.HEAP_ONLY) or (
+                    state == RecordState.DEAD and sid in keep):
+                records.append((slot_position, state, bytes(self.buff[offset: offset + length])))
+            elif state == RecordState.DEAD:
+                SLOT_STRUCT.pack_into(self.buff, slot_position, 0, 0, RecordState.UNUSED)
+
+        old_free_space_end = self.page_header.free_space_end
+        free_space_end = PAGE_SIZE
+        for slot_position, state, record in records:
+            free_space_end -= len(record)
+            self.buff[free_space_end: free_space_end + len(record)] = record
+            SLOT_STRUCT.pack_into(self.buff, slot_position,
+                                  free_space_end, len(record), state)
+        # 空闲空间清零，使得页镜像只与页内的有效内容相关
+        free_space_start = self.page_header.free_space_start
+        self.buff[free_space_start: free_space_end] = bytes(free_space_end - free_space_start)
+        self.page_header.free_space_end = free_space_end
+        return free_space_end - old_free_space_end
+
+    def serialize(self) -> memoryview:
+        # Page 本身就是页的字节镜像，写回磁盘时不需要再做任何拼接
+        return memoryview(self.buff)
 
     @staticmethod
     def deserialize(buff) -> "Page":
-        header = PageHeader.deserialize(buff[:PageHeader.size()])
-        page = Page(header)
-        for slot_offset in range(header.size(), header.free_space_start, Slot.size()):
-            slot = Slot.deserialize(buff[slot_offset: slot_offset + Slot.size()])
-            page.slot_directory.append(slot)
-
-        page.records = bytearray(buff[header.free_space_end:])
-        return page
+        # 只有一次缓冲区拷贝，不再为每个 slot 构造对象
+        return Page(bytearray(buff))
@@ -0,0 +1,182 @@
+import mmap
+import os
+import threading
+
+from imoocdb.constant import DATA_DIRECTORY
+from imoocdb.storage.lru import buffer_pool
+
+# 读取数据页的方式：
+# pread: 每次缺页都通过一次系统调用，把数据拷贝到新的缓冲区中；
+# mmap: 把关系文件映射到内存中，数据页直接是映射区上的只读视图，不发生拷贝
+IO_METHOD_PREAD = 'pread'
+IO_METHOD_MMAP = 'mmap'
+IO_METHODS = (IO_METHOD_PREAD, IO_METHOD_MMAP)
+IO_METHOD = IO_METHOD_PREAD
+# 每个数据库（数据目录）选择的读取方式记录在数据目录下的该文件中
+IO_METHOD_FILENAME = 'io_method'
+
+
+def get_io_method_filename():
+    return os.path.join(DATA_DIRECTORY, IO_METHOD_FILENAME)
+
+
+class StorageManager:
+    """存储管理层 (storage manager)：数据表、索引等关系文件的读写都经过这里。
+    - 缓存每个关系文件已经打开的文件描述符，不再为每次读写重新打开文件；
+    - 在内存中维护文件的大小，不再反复 stat；
+    - 通过 pread/pwrite 在精确的偏移处读写，不依赖文件对象的 seek 位置。
+    """
+
+    def __init__(self, io_method=None):
+        self.fds = {}
+        self.sizes = {}
+        self.mappings = {}
+        self.directories = set()
+        self.mutex = threading.Lock()
+        # 为 None 时，第一次用到时从数据目录中加载，见 load_io_method()
+        self._io_method = None
+        if io_method is not None:
+            self._apply_io_method(io_method)
+
+    @property
+    def io_method(self):
+        if self._io_method is None:
+            self.load_io_method()
+        return self._io_method
+
+    def _apply_io_method(self, io_method):
+        if io_method not in IO_METHODS:
+            raise ValueError(f'unknown io method {io_method}.')
+        self._io_method = io_method
+        if io_method != IO_METHOD_MMAP:
+            self.mappings.clear()
+
+    def load_io_method(self):
+        """读取当前数据库选择的读取方式，没有选择过时使用默认的 IO_METHOD"""
+        io_method = IO_METHOD
+        filename = get_io_method_filename()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                io_method = f.read().strip()
+        self._apply_io_method(io_method)
+        return io_method
+
+    def set_io_method(self, io_method):
+        """按数据库（数据目录）选择读取方式并记录下来，重新打开数据库之后仍然生效，
+        便于在同一份数据上对比两种方式
+        """
+        self._apply_io_method(io_method)
+        self.ensure_directory(DATA_DIRECTORY)
+        # 先写临时文件，再原子地替换
+        filename = get_io_method_filename()
+        with open(filename + '.tmp', 'w') as f:
+            f.write(io_method)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + '.tmp', filename)
+
+    def ensure_directory(self, directory):
+        if directory in self.directories:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.directories.add(directory)
+
+    def _open(self, filename):
+        fd = self.fds.get(filename)
+        if fd is not None:
+            return fd
+        with self.mutex:
+            if filename not in self.fds:
+                fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+                self.fds[filename] = fd
+                self.sizes[filename] = os.fstat(fd).st_size
+            return self.fds[filename]
+
+    def exists(self, filename):
+        return filename in self.fds or os.path.exists(filename)
+
+    def size(self, filename):
+        if filename not in self.sizes:
+            # 不存在的文件，大小视为 0，且不因为读操作而创建文件
+            if not os.path.exists(filename):
+                return 0
+            self._open(filename)
+        return self.sizes[filename]
+
+    def read(self, filename, offset, size) -> bytes:
+        return os.pread(self._open(filename), size, offset)
+
+    def read_into(self, filename, offset, buff) -> int:
+        """直接读到调用者提供的缓冲区中（例如 Page 的缓冲区），避免中间的 bytes 对象"""
+        return os.preadv(self._open(filename), [buff], offset)
+
+    def _map(self, filename, end):
+        mapping = self.mappings.get(filename)
+        if mapping is not None and len(mapping) >= end:
+            return mapping
+        size = self.size(filename)
+        if size < end:
+            return None
+        # 关系文件变大了（或者第一次访问），按照当前的文件大小重新映射。
+        # 旧的映射不需要显式关闭，在其上的视图都被释放之后会自动回收
+        mapping = mmap.mmap(self._open(filename), size, access=mmap.ACCESS_READ)
+        with self.mutex:
+            self.mappings[filename] = mapping
+        return mapping
+
+    def read_page(self, filename, offset, size):
+        """读取一个数据页：
+        pread 方式返回一个新的 bytearray;
+        mmap 方式返回映射区上的只读 memoryview, 由 Page 在第一次修改时再拷贝（写时复制）。
+        超出文件末尾的部分按全 0 处理。
+        """
+        if self.io_method == IO_METHOD_MMAP:
+            mapping = self._map(filename, offset + size)
+            if mapping is not None:
+                return memoryview(mapping)[offset: offset + size]
+        buff = bytearray(size)
+        self.read_into(filename, offset, buff)
+        return buff
+
+    def write(self, filename, offset, data):
+        fd = self._open(filename)
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += os.pwrite(fd, view[written:], offset + written)
+        with self.mutex:
+            self.sizes[filename] = max(self.sizes[filename], offset + written)
+        return written
+
+    def fsync(self, filename):
+        fd = self.fds.get(filename)
+        if fd is not None:
+            os.fsync(fd)
+
+    def truncate(self, filename, size=0):
+        fd = self._open(filename)
+        with self.mutex:
+            # 文件缩小之后，再访问映射区中超出文件末尾的部分会触发 SIGBUS,
+            # 因此必须丢弃旧的映射
+            mapping = self.mappings.pop(filename, None)
+        if mapping is not None:
+            # buffer pool 中的页可能仍然是旧映射区上的视图，截断之前先把它们拷贝出来
+            buffer_pool.detach(mapping)
+        os.ftruncate(fd, size)
+        with self.mutex:
+            self.sizes[filename] = size
+
+    def close(self, filename):
+        with self.mutex:
+            fd = self.fds.pop(filename, None)
+            self.sizes.pop(filename, None)
+            self.mappings.pop(filename, None)
+        if fd is not None:
+            os.close(fd)
+
+    def close_all(self):
+        for filename in list(self.fds):
+            self.close(filename)
+
+
+smgr = StorageManager()
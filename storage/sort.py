@@ -0,0 +1,84 @@
+import heapq
+import os
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from imoocdb.constant import DATA_DIRECTORY
+from imoocdb.storage.smgr import smgr
+
+# 外部排序：create index 时对 (key, location) 进行排序。
+# 每攒够 SORT_RUN_SIZE 个元素就排序一次，写到临时文件中，成为一个有序的 run,
+# 最后再对所有的 run 做多路归并；全部的元素只有一个 run 时，不落盘
+SORT_RUN_SIZE = 500000
+# 大于 1 时，run 的排序与写出在进程池中并行进行
+SORT_WORKERS = 1
+# run 文件中的每条记录：| key 的长度 (2B) | location 的 pageno (8B) | sid (8B) | key |
+RUN_RECORD = struct.Struct('<HQQ')
+RUN_BUFFER_SIZE = 1 << 20
+
+
+def get_sort_directory():
+    return os.path.join(DATA_DIRECTORY, 'sort')
+
+
+def write_run(items, filename):
+    """对 [(key, (pageno, sid)), ...] 排序并写到 filename 中，可以在子进程中执行"""
+    items.sort()
+    with open(filename, 'wb', buffering=RUN_BUFFER_SIZE) as f:
+        for key, (pageno, sid) in items:
+            f.write(RUN_RECORD.pack(len(key), pageno, sid))
+            f.write(key)
+    return filename
+
+
+def read_run(filename):
+    with open(filename, 'rb', buffering=RUN_BUFFER_SIZE) as f:
+        while True:
+            header = f.read(RUN_RECORD.size)
+            if not header:
+                break
+            length, pageno, sid = RUN_RECORD.unpack(header)
+            yield f.read(length), (pageno, sid)
+
+
+def external_sort(items, run_size=SORT_RUN_SIZE, workers=SORT_WORKERS):
+    """返回按照 (key, location) 排好序的迭代器，key 是编码之后的字节串"""
+    filenames = []
+    futures = []
+    executor = None
+    buffer = []
+    try:
+        for item in items:
+            buffer.append(item)
+            if len(buffer) < run_size:
+                continue
+            smgr.ensure_directory(get_sort_directory())
+            fd, filename = tempfile.mkstemp(suffix='.run', dir=get_sort_directory())
+            os.close(fd)
+            filenames.append(filename)
+            if workers > 1:
+                if executor is None:
+                    executor = ProcessPoolExecutor(max_workers=workers)
+                # 同时在排序的 run 不超过进程数，避免内存中堆积过多的元素
+                if len(futures) >= workers:
+                    futures.pop(0).result()
+                futures.append(executor.submit(write_run, buffer, filename))
+            else:
+                write_run(buffer, filename)
+            buffer = []
+        for future in futures:
+            future.result()
+
+        if not filenames:
+            buffer.sort()
+            yield from buffer
+            return
+        buffer.sort()
+        yield from heapq.merge(buffer, *(read_run(filename) for filename in filenames))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
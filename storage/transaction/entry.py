@@ -1,8 +1,13 @@
 import os
 import threading
 
-from imoocdb.storage.bplus_tree import BPlusTree, load_root_node, BPlusTreeTuple
-from imoocdb.storage.common import table_tuple_get_page, get_index_filename, sync_table_page
+from imoocdb.errors import PageError
+from imoocdb.storage.bplus_tree import index_mgr
+from imoocdb.storage.common import table_tuple_get_page, get_index_filename, get_table_filename, \
+    index_relations, sync_table_page
+from imoocdb.storage.smgr import smgr
+from imoocdb.storage.compression import compression_mgr
+from imoocdb.storage.fsm import fsm_mgr
 from imoocdb.storage.lru import buffer_pool
 from imoocdb.storage.transaction.redo import RedoLogManager, RedoRecord, RedoAction
 from imoocdb.storage.transaction.undo import UndoLogManager, UndoOperation
@@ -15,19 +20,36 @@ def checkpoint():
     # 不然，我们checkpoint 落到磁盘中的数据，会存在中间态
     # checkpoint 要有锁
     # todo: 实现锁
+    # WAL: 脏页写回之前，修改它们的 redo 日志都要先落盘
+    transaction_mgr.redo_mgr.flush()
+
+    # 接着，我们要把脏页识别出来，然后把他们刷到磁盘中
+    filenames = set()
+    for key, page in list(buffer_pool.get_all_dirty_pages()):
+        relation, pageno = key
+        if relation in index_relations:
+            # 索引页与文件头由 index_mgr.sync() 成组地、原子地写回
+            continue
+        # 先统一写出，最后每个文件只 fsync 一次
+        sync_table_page(relation, pageno, page, fsync=False)
+        filenames.add(get_table_filename(relation))
+        buffer_pool.unmark_dirty(key)
+    for filename in filenames:
+        smgr.fsync(filename)
+    index_mgr.sync()
+    # FSM 不记 WAL, 随着 checkpoint 一起落盘即可
+    fsm_mgr.sync()
+    # 数据文件 fsync 之后，再写出压缩表的 extent map
+    compression_mgr.sync()
+
+    # 所有的页都落盘之后才写 checkpoint 记录，恢复时从它之后开始重放。
+    # 如果在此之前崩溃，仍然从上一个 checkpoint 开始重放
     transaction_mgr.redo_mgr.write(
         RedoRecord(
             INVALID_XID, RedoAction.CHECKPOINT, None, None, b''
         )
     )
-
-    # 接着，我们要把脏页识别出来，然后把他们刷到磁盘中
-    for key, page in buffer_pool.get_all_dirty_pages():
-        relation, pageno = key
-        sync_table_page(relation, pageno, page)
-        buffer_pool.unmark_dirty(key)
-        if key in buffer_pool.lru_cache.evicted:
-            pass
+    transaction_mgr.redo_mgr.flush()
 
 
 class TransactionManager:
@@ -38,6 +60,39 @@ class TransactionManager:
         # 线程的 thread local 变量
         self.thread_local = threading.local()
         self.allocation_mutex = threading.Lock()
+        # 还没有结束的事务删除的元组：(relation, pageno) -> {sid: xid}.
+        # 回滚时要把它们放回原来的 sid（索引中记录的仍然是这个 location），
+        # 因此，在删除它们的事务结束之前，页内整理不能回收这些 slot
+        self.pending_deletes = {}
+        # xid -> [(relation, pageno, sid), ...], 事务结束时据此清理 pending_deletes
+        self.transaction_deletes = {}
+        self.pending_deletes_mutex = threading.Lock()
+        # WAL: buffer pool 写回页之前，通过它把 redo 日志落盘
+        buffer_pool.log_flusher = self.flush_log
+
+    def flush_log(self, lsn):
+        self.redo_mgr.flush_to(lsn)
+
+    def add_pending_delete(self, xid, relation, location):
+        pageno, sid = location
+        with self.pending_deletes_mutex:
+            self.pending_deletes.setdefault((relation, pageno), {})[sid] = xid
+            self.transaction_deletes.setdefault(xid, []).append((relation, pageno, sid))
+
+    def get_pending_deletes(self, relation, pageno):
+        """返回该页上仍然可能被回滚的死元组的 sid, 它们不能被整理回收"""
+        with self.pending_deletes_mutex:
+            return frozenset(self.pending_deletes.get((relation, pageno), ()))
+
+    def finish_pending_deletes(self, xid):
+        # 事务提交或者回滚之后，它删除的元组就可以被回收了
+        with self.pending_deletes_mutex:
+            for relation, pageno, sid in self.transaction_deletes.pop(xid, ()):
+                sids = self.pending_deletes.get((relation, pageno))
+                if sids is not None and sids.get(sid) == xid:
+                    del sids[sid]
+                    if not sids:
+                        del self.pending_deletes[(relation, pageno)]
 
     def session_xid(self):
         if not hasattr(self.thread_local, "xid"):
@@ -59,7 +114,7 @@ class TransactionManager:
 
         checkpoint_lsn = 0
         replay_lsn = 0
-        for redo_record in self.redo_mgr.replay():
+        for redo_record in self.redo_mgr.replay(self.redo_mgr.log_filename):
             # 我们是先加的 LSN，意味着，拿到的这个LSN
             # 对应的是 redo record 的 tail 位置
             replay_lsn += len(redo_record)
@@ -71,7 +126,8 @@ class TransactionManager:
         # 就是0
         replay_lsn = checkpoint_lsn
         transactions = []
-        for redo_record in self.redo_mgr.replay(start_lsn=checkpoint_lsn):
+        for redo_record in self.redo_mgr.replay(self.redo_mgr.log_filename,
+                                                start_lsn=checkpoint_lsn):
             replay_lsn += len(redo_record)
 
             xid = redo_record.xid
@@ -93,21 +149,54 @@ class TransactionManager:
                     new_sid = page.insert(data)
                     page.set_header(replay_lsn)
                     assert new_sid == sid
+            elif action == RedoAction.TABLE_INSERT_MANY:
+                pageno, sid = location
+                page = table_tuple_get_page(relation, pageno)
+                if page.page_header.lsn < replay_lsn:
+                    for i, tuple_bytes in enumerate(data):
+                        new_sid = page.insert(tuple_bytes)
+                        assert new_sid == sid + i
+                    page.set_header(replay_lsn)
             elif action == RedoAction.TABLE_DELETE:
                 pageno, sid = location
                 page = table_tuple_get_page(relation, pageno)
                 if page.page_header.lsn < replay_lsn:
                     page.delete(sid)
                     page.set_header(replay_lsn)
+                self.add_pending_delete(xid, relation, location)
             elif action == RedoAction.TABLE_UPDATE:
                 pageno, sid = location
                 page = table_tuple_get_page(relation, pageno)
                 if page.page_header.lsn < replay_lsn:
                     page.update(sid, data)
                     page.set_header(replay_lsn)
+            elif action == RedoAction.TABLE_REORGANIZE:
+                pageno, _ = location
+                page = table_tuple_get_page(relation, pageno)
+                if page.page_header.lsn < replay_lsn:
+                    # data 中是整理时保留下来的、还没有结束的事务删除的元组
+                    page.compact(keep=frozenset(data))
+                    page.set_header(replay_lsn)
+            elif action in (RedoAction.INDEX_INSERT, RedoAction.INDEX_DELETE):
+                if not smgr.exists(get_index_filename(relation)):
+                    # 索引已经被删除了
+                    continue
+                with index_mgr.acquire(relation) as tree:
+                    # 与数据页一样，通过叶子节点中的 LSN 判断是否需要重放
+                    if action == RedoAction.INDEX_INSERT:
+                        if tree.find_leaf_node(data, rightmost=True).lsn < replay_lsn:
+                            tree.insert(data, location, replay_lsn)
+                    elif tree.find_leaf_node(data).lsn < replay_lsn:
+                        tree.delete(data, location, replay_lsn)
+                    tree.serialize()
             elif action == RedoAction.ABORT:
                 self.perform_undo(xid, replay_lsn)
+                self.finish_pending_deletes(xid)
+                # 已经回滚过的事务，不能在下面再回滚一次
+                if xid in transactions:
+                    transactions.remove(xid)
             elif action == RedoAction.COMMIT:
+                self.finish_pending_deletes(xid)
                 transactions.remove(xid)
 
         # redo 日志都重放完之后，存在一部分事务没有提交的场景，也就是
@@ -117,6 +206,7 @@ class TransactionManager:
                                                  RedoAction.ABORT,
                                                  None, None, b''))
             self.perform_undo(xid, lsn)
+            self.finish_pending_deletes(xid)
 
     def start_transaction(self) -> int:
         with self.allocation_mutex:
@@ -137,6 +227,7 @@ class TransactionManager:
         self.redo_mgr.write(RedoRecord(self.thread_local.xid, RedoAction.COMMIT,
                                        None, None, b''))
         self.undo_mgr.commit_transaction(xid)
+        self.finish_pending_deletes(xid)
 
     def abort_transaction(self, xid):
         lsn = self.redo_mgr.write(RedoRecord(xid, RedoAction.ABORT,
@@ -146,6 +237,7 @@ class TransactionManager:
         # 数据页在内存中回滚
         self.perform_undo(xid, lsn)
         self.undo_mgr.abort_transaction(xid)
+        self.finish_pending_deletes(xid)
 
     def get_current_lsn(self):
         return self.redo_mgr.max_lsn()
@@ -160,34 +252,47 @@ class TransactionManager:
                 page.set_header(lsn)
                 # todo: buffer 标记为脏页
                 buffer_pool.mark_dirty((undo_record.relation, pageno))
+            elif undo_record.operation == UndoOperation.TABLE_DELETE_MANY:
+                pageno, sid = undo_record.location
+                page = table_tuple_get_page(undo_record.relation, pageno)
+                for i in range(undo_record.data):
+                    page.delete(sid + i)
+                page.set_header(lsn)
+                buffer_pool.mark_dirty((undo_record.relation, pageno))
             elif undo_record.operation == UndoOperation.TABLE_INSERT:
                 pageno, sid = undo_record.location
                 page = table_tuple_get_page(undo_record.relation, pageno)
-                page.insert(undo_record.data)
+                # 放回原来的 sid, 而不是插入为一个新的元组，
+                # 索引的回滚恢复的是原来的 location
+                page.restore(sid, undo_record.data)
                 page.set_header(lsn)
                 buffer_pool.mark_dirty((undo_record.relation, pageno))
             elif undo_record.operation == UndoOperation.TABLE_UPDATE:
                 pageno, sid = undo_record.location
                 page = table_tuple_get_page(undo_record.relation, pageno)
-                page.update(sid, undo_record.data)
+                try:
+                    page.update(sid, undo_record.data)
+                except PageError:
+                    # 旧版本更长，并且页已经被其他元组占满了：整理之后再放回去。
+                    # 还没有结束的事务删除的元组仍然要保留
+                    page.compact(self.get_pending_deletes(undo_record.relation, pageno))
+                    page.update(sid, undo_record.data)
                 page.set_header(lsn)
                 buffer_pool.mark_dirty((undo_record.relation, pageno))
             elif undo_record.operation == UndoOperation.INDEX_INSERT:
                 index_name = undo_record.relation
                 key = undo_record.data
                 value = undo_record.location
-                filename = get_index_filename(index_name)
-                tree = BPlusTree(filename, load_root_node(filename))
-                tree.insert(BPlusTreeTuple(key), value)
-                tree.serialize()
+                with index_mgr.acquire(index_name) as tree:
+                    tree.insert(key, value, lsn)
+                    tree.serialize()
             elif undo_record.operation == UndoOperation.INDEX_DELETE:
                 index_name = undo_record.relation
                 key = undo_record.data
                 value = undo_record.location
-                filename = get_index_filename(index_name)
-                tree = BPlusTree(filename, load_root_node(filename))
-                tree.delete(key, value)
-                tree.serialize()
+                with index_mgr.acquire(index_name) as tree:
+                    tree.delete(key, value, lsn)
+                    tree.serialize()
 
 
 transaction_mgr = TransactionManager()
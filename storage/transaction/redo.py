@@ -20,6 +20,10 @@ class RedoAction:
 
     # 其他的
     CHECKPOINT = 9
+    # 页内整理，location 为 (pageno, None), data 为整理时保留下来的死元组的 sid 列表
+    TABLE_REORGANIZE = 10
+    # 同一个页上的批量插入，location 为 (pageno, 起始 sid), data 为各元组的字节串列表
+    TABLE_INSERT_MANY = 11
     # undo log 的操作
     # ...
     # 系统表/数据字典的修改 catalog
@@ -88,6 +92,11 @@ class RedoLogManager:
 
         return self.write_lsn
 
+    def flush_to(self, lsn):
+        # 只有 lsn 之前的日志还在 log buffer 中时才需要落盘
+        if lsn > self.flush_lsn and self.log_buffer:
+            self.flush()
+
     def flush(self):
         with open(self.log_filename, 'ab') as f:
             for record in self.log_buffer:
@@ -15,6 +15,8 @@ class UndoOperation:
     ABORT = 5
     INDEX_INSERT = 6
     INDEX_DELETE = 7
+    # 批量插入的回滚，location 为 (pageno, 起始 sid), data 为元组的数量
+    TABLE_DELETE_MANY = 8
     # 其他的，还可以包括：
     # table schema 表结构的变化
     # ...
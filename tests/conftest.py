@@ -0,0 +1,174 @@
+import importlib
+import importlib.util
+import os
+import sys
+import threading
+import types
+
+import pytest
+
+# 仓库中的 storage, sql 是 imoocdb 包的子包，模块之间都通过 imoocdb.xxx 互相引用。
+# 这里把仓库的根目录挂到 imoocdb 包的搜索路径的最前面，
+# 这样，直接在仓库中执行 pytest 时，测试的就是仓库中的代码
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 存储引擎依赖的、不在本仓库中的模块
+REQUIRED_MODULES = ('imoocdb.errors', 'imoocdb.constant', 'imoocdb.catalog')
+
+
+def _mount_repository():
+    try:
+        package = importlib.import_module('imoocdb')
+    except ImportError:
+        package = types.ModuleType('imoocdb')
+        package.__path__ = []
+        sys.modules['imoocdb'] = package
+    if REPO_ROOT not in package.__path__:
+        package.__path__.insert(0, REPO_ROOT)
+
+
+def _missing_modules():
+    missing = []
+    for name in REQUIRED_MODULES:
+        try:
+            if importlib.util.find_spec(name) is None:
+                missing.append(name)
+        except ImportError:
+            missing.append(name)
+    return missing
+
+
+_mount_repository()
+MISSING_MODULES = _missing_modules()
+if MISSING_MODULES:
+    # 缺少 imoocdb 的其余部分时，测试模块连 import 都无法完成，不收集它们
+    collect_ignore_glob = ['test_*.py']
+
+
+def pytest_report_header(config):
+    if MISSING_MODULES:
+        return f'skipping all tests: {", ".join(MISSING_MODULES)} not found.'
+    return None
+
+
+class Form(types.SimpleNamespace):
+    pass
+
+
+class Catalog:
+    """系统表的替身，只实现存储引擎用到的 select()"""
+
+    def __init__(self):
+        self.rows = []
+
+    def select(self, predicate):
+        return [row for row in self.rows if predicate(row)]
+
+
+class Catalogs:
+    def __init__(self):
+        self.table = Catalog()
+        self.index = Catalog()
+
+    def create_table(self, table_name, columns, types=None):
+        form = Form(table_name=table_name, columns=list(columns))
+        if types is not None:
+            form.types = list(types)
+        self.table.rows.append(form)
+        return form
+
+    def create_index(self, index_name, table_name, columns):
+        form = Form(index_name=index_name, table_name=table_name, columns=list(columns))
+        self.index.rows.append(form)
+        return form
+
+
+@pytest.fixture
+def data_directory(tmp_path, monkeypatch):
+    """每个测试使用独立的数据目录，并且从空的 buffer pool、索引句柄、日志开始"""
+    from imoocdb.storage import common, compression, fsm, smgr as smgr_module, sort
+    from imoocdb.storage.bplus_tree import index_mgr
+    from imoocdb.storage.lru import buffer_pool, LRUCache
+    from imoocdb.storage.readahead import readahead
+    from imoocdb.storage.smgr import smgr
+    from imoocdb.storage.transaction.entry import transaction_mgr
+    from imoocdb.storage.transaction.redo import RedoLogManager
+    from imoocdb.storage.transaction.undo import UndoLogManager
+
+    directory = str(tmp_path)
+    for module in (common, compression, fsm, smgr_module, sort):
+        monkeypatch.setattr(module, 'DATA_DIRECTORY', directory)
+    smgr.close_all()
+    # 读取方式在第一次用到时从新的数据目录中加载
+    monkeypatch.setattr(smgr, '_io_method', None)
+    readahead.reset()
+    common.index_relations.clear()
+    monkeypatch.setattr(buffer_pool, 'lru_cache', LRUCache(buffer_pool.lru_cache.capacity))
+    monkeypatch.setattr(buffer_pool, 'dirty_pages', set())
+    monkeypatch.setattr(index_mgr, 'trees', {})
+    monkeypatch.setattr(fsm.fsm_mgr, 'maps', {})
+    monkeypatch.setattr(compression.compression_mgr, 'maps', {})
+    monkeypatch.setattr(transaction_mgr, 'redo_mgr',
+                        RedoLogManager(os.path.join(directory, 'redo.log')))
+    monkeypatch.setattr(transaction_mgr, 'undo_mgr',
+                        UndoLogManager(os.path.join(directory, 'undo')))
+    monkeypatch.setattr(transaction_mgr, 'current_xid', 0)
+    monkeypatch.setattr(transaction_mgr, 'thread_local', threading.local())
+    monkeypatch.setattr(transaction_mgr, 'pending_deletes', {})
+    monkeypatch.setattr(transaction_mgr, 'transaction_deletes', {})
+    yield directory
+    readahead.reset()
+    smgr.close_all()
+    common.index_relations.clear()
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    """把存储引擎与优化器使用的系统表替换为内存中的替身"""
+    from imoocdb.storage import entry
+
+    catalogs = Catalogs()
+    monkeypatch.setattr(entry, 'catalog_table', catalogs.table)
+    monkeypatch.setattr(entry, 'catalog_index', catalogs.index)
+    return catalogs
+
+
+@pytest.fixture
+def xid(data_directory):
+    """在当前线程中开启一个事务，由测试自己提交或者回滚"""
+    from imoocdb.storage.transaction.entry import transaction_mgr
+
+    return transaction_mgr.start_transaction()
+
+
+@pytest.fixture
+def restart(data_directory, monkeypatch):
+    """模拟崩溃之后重启：丢弃内存中的全部状态（包括没有写回的脏页），只留下磁盘上的文件。
+    返回的函数不做恢复，由测试自己调用 transaction_mgr.recovery()
+    """
+    from imoocdb.storage import compression, fsm
+    from imoocdb.storage.bplus_tree import index_mgr
+    from imoocdb.storage.lru import buffer_pool, LRUCache
+    from imoocdb.storage.readahead import readahead
+    from imoocdb.storage.smgr import smgr
+    from imoocdb.storage.transaction.entry import transaction_mgr
+    from imoocdb.storage.transaction.redo import RedoLogManager
+    from imoocdb.storage.transaction.undo import UndoLogManager
+
+    def restart():
+        readahead.reset()
+        smgr.close_all()
+        monkeypatch.setattr(buffer_pool, 'lru_cache', LRUCache(buffer_pool.lru_cache.capacity))
+        monkeypatch.setattr(buffer_pool, 'dirty_pages', set())
+        monkeypatch.setattr(index_mgr, 'trees', {})
+        monkeypatch.setattr(fsm.fsm_mgr, 'maps', {})
+        monkeypatch.setattr(compression.compression_mgr, 'maps', {})
+        monkeypatch.setattr(transaction_mgr, 'redo_mgr',
+                            RedoLogManager(transaction_mgr.redo_mgr.log_filename))
+        monkeypatch.setattr(transaction_mgr, 'undo_mgr',
+                            UndoLogManager(transaction_mgr.undo_mgr.file_directory))
+        monkeypatch.setattr(transaction_mgr, 'current_xid', 0)
+        monkeypatch.setattr(transaction_mgr, 'thread_local', threading.local())
+        monkeypatch.setattr(transaction_mgr, 'pending_deletes', {})
+        monkeypatch.setattr(transaction_mgr, 'transaction_deletes', {})
+
+    return restart
@@ -0,0 +1,357 @@
+import os
+import random
+
+import pytest
+
+from imoocdb.errors import BPlusTreeError
+from imoocdb.storage import bplus_tree, common
+from imoocdb.storage.bplus_tree import BPlusTree, encode_key, decode_key, index_mgr, HEADER_SIZE, MIN_KEY
+from imoocdb.storage.common import get_index_doublewrite_filename, get_index_filename
+from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.slotted_page import PAGE_SIZE
+from imoocdb.storage.smgr import smgr
+from imoocdb.storage.transaction.entry import transaction_mgr
+from imoocdb.storage.transaction.redo import RedoRecord, RedoAction
+
+
+def check_node_size(tree, node):
+    node = tree.load_node(node)
+    assert node.serialized_size() <= tree.max_node_size
+    for child in node.children:
+        check_node_size(tree, child)
+
+
+def test_insert_delete_with_long_keys(data_directory):
+    # 删除时重新分配元素，新的分隔符可能很长，任何节点都不能超过页的大小
+    random.seed(1)
+    tree = BPlusTree('test_bplus_tree_long_keys')
+    tree.serialize()
+    entries = []
+    for i in range(6000):
+        if entries and random.random() < 0.45:
+            key, value = entries.pop(random.randrange(len(entries)))
+            tree.delete(key, value)
+        else:
+            length = random.choice([random.randint(1, 30),
+                                    random.randint(tree.max_key_size - 400, tree.max_key_size - 14)])
+            key = ('%06d' % random.randint(0, 999999) + 'x' * length,)
+            if len(encode_key(key)) > tree.max_key_size:
+                continue
+            tree.insert(key, (0, i))
+            entries.append((key, (0, i)))
+        if i % 50 == 0:
+            tree.serialize()
+            check_node_size(tree, tree.root)
+    tree.serialize()
+    check_node_size(tree, tree.root)
+    assert sorted(tree.find_range()) == sorted(value for _, value in entries)
+
+
+def reopen(index_name):
+    # 模拟重启：丢弃内存中的页与文件描述符，重新打开索引
+    buffer_pool.discard(index_name)
+    smgr.close(get_index_filename(index_name))
+    return BPlusTree.deserialize(index_name)
+
+
+def test_crash_during_index_flush(data_directory, monkeypatch):
+    tree = BPlusTree('test_bplus_tree_doublewrite')
+    tree.serialize()
+    entries = [(encode_key(('%06d' % i,)), (0, i)) for i in range(3000)]
+    for key, value in entries:
+        tree.insert(key, value)
+    tree.serialize()
+    for key, value in entries[::3]:
+        tree.delete(key, value)
+    tree.serialize()
+    expected = sorted(value for i, (_, value) in enumerate(entries) if i % 3)
+
+    def crash(index_name):
+        raise OSError('crash')
+
+    # doublewrite 文件落盘之后、原地覆盖之前崩溃
+    with monkeypatch.context() as m:
+        m.setattr(common, 'index_tuple_finish_doublewrite', crash)
+        with pytest.raises(OSError):
+            tree.flush()
+    assert os.path.exists(get_index_doublewrite_filename(tree.index_name))
+
+    # 打开索引时完成覆盖，分裂、合并以及空闲链表的变化都是完整的
+    tree = reopen(tree.index_name)
+    assert not os.path.exists(get_index_doublewrite_filename(tree.index_name))
+    assert sorted(tree.find_range()) == expected
+    for i in range(3000, 3500):
+        tree.insert(encode_key(('%06d' % i,)), (1, i))
+    tree.serialize()
+    tree.flush()
+    tree = reopen(tree.index_name)
+    assert sorted(tree.find_range()) == sorted(expected + [(1, i) for i in range(3000, 3500)])
+
+
+def test_index_flush_writes_redo_first(data_directory):
+    tree = BPlusTree('test_bplus_tree_wal')
+    tree.serialize()
+    key = encode_key(('k',))
+    lsn = transaction_mgr.redo_mgr.write(
+        RedoRecord(1, RedoAction.INDEX_INSERT, tree.index_name, (0, 0), key))
+    tree.insert(key, (0, 0), lsn)
+    tree.serialize()
+    assert transaction_mgr.redo_mgr.flush_lsn < lsn
+    tree.flush()
+    # 索引页写回之前，修改它的 redo 日志已经落盘
+    assert transaction_mgr.redo_mgr.flush_lsn >= lsn
+
+
+def test_numeric_keys_sort_by_value():
+    values = [100, 2.5, -3, -2.5, 0, 2 ** 63 - 1, 2 ** 53 + 1, float(2 ** 53), -2 ** 63,
+              float('inf'), float('-inf'), 1e-300, 7]
+    assert sorted(values, key=lambda v: encode_key((v,))) == sorted(values)
+    # 整数与数值相等的浮点数，编码相同
+    assert encode_key((2,)) == encode_key((2.0,))
+    assert encode_key((2 ** 53 + 1,)) != encode_key((float(2 ** 53 + 1),))
+
+
+def test_key_round_trip():
+    keys = [(None, 2.5, 'a\x00b', b'\x00\xff', 2 ** 63 - 1), (-2 ** 63, float('-inf'), '', b'', 0)]
+    for key in keys:
+        assert decode_key(encode_key(key)) == key
+    # NULL 排在所有非 NULL 值之前
+    assert sorted(keys, key=encode_key) == keys
+
+
+def leaves(tree):
+    node = tree.find_leaf_node(MIN_KEY)
+    while node is not None:
+        yield node
+        node = tree.load_node(node.next_leaf)
+
+
+def test_split_by_serialized_size(data_directory):
+    # 节点按照序列化之后的字节数分裂，键越短，一个节点中能放下的键就越多
+    short = BPlusTree('test_bplus_tree_short_keys')
+    long = BPlusTree('test_bplus_tree_long_keys')
+    for i in range(2000):
+        short.insert(('%04d' % i,), (0, i))
+        long.insert(('%04d' % i + 'x' * 500,), (0, i))
+    for tree in (short, long):
+        check_node_size(tree, tree.root)
+        assert [value for node in leaves(tree) for value in node.values] == \
+            [(0, i) for i in range(2000)]
+    short_fanout = min(len(node.keys) for node in leaves(short))
+    long_fanout = max(len(node.keys) for node in leaves(long))
+    # 不再是固定的每个节点 10 个键
+    assert short_fanout > 10
+    assert short_fanout > 5 * long_fanout
+    # 分裂之后，除了最后一个叶子节点，每个节点至少是半满的
+    for node in list(leaves(short))[:-1]:
+        assert node.serialized_size() * 2 >= short.max_node_size - short.max_key_size
+
+
+def test_key_size_limit(data_directory):
+    tree = BPlusTree('test_bplus_tree_key_limit')
+    with pytest.raises(BPlusTreeError):
+        tree.insert(b'x' * (tree.max_key_size + 1), (0, 0))
+    key = b'x' * tree.max_key_size
+    for i in range(10):
+        tree.insert(key, (0, i))
+    check_node_size(tree, tree.root)
+    assert tree.find(key) == [(0, i) for i in range(10)]
+
+
+def read_pages(filename):
+    with open(filename, 'rb') as f:
+        f.seek(HEADER_SIZE)
+        data = f.read()
+    return [data[i:i + PAGE_SIZE] for i in range(0, len(data), PAGE_SIZE)]
+
+
+def test_only_dirty_nodes_are_written(data_directory):
+    tree = BPlusTree('test_bplus_tree_dirty_nodes')
+    for i in range(5000):
+        tree.insert(encode_key(('%06d' % i,)), (0, i))
+    tree.serialize()
+    tree.flush()
+    assert not tree.dirty_nodes
+    before = read_pages(tree.filename)
+    assert len(before) > 20
+
+    # 不引起分裂的一次插入只修改一个叶子节点
+    key = encode_key(('%06d' % 2500 + 'x',))
+    tree.insert(key, (1, 0))
+    leaf = tree.find_leaf_node(key)
+    assert list(tree.dirty_nodes) == [leaf.pageno]
+    tree.serialize()
+    assert not tree.dirty_nodes
+    assert {key for key in buffer_pool.dirty_pages if key[0] == tree.index_name} == \
+        {(tree.index_name, leaf.pageno)}
+
+    tree.flush()
+    after = read_pages(tree.filename)
+    assert len(after) == len(before)
+    assert [pageno for pageno in range(len(after)) if after[pageno] != before[pageno]] == \
+        [leaf.pageno]
+    tree = reopen(tree.index_name)
+    assert tree.find(key) == [(1, 0)]
+
+
+def test_index_manager_shares_open_trees(data_directory, monkeypatch):
+    monkeypatch.setattr(bplus_tree, 'BPLUS_TREE_CACHED_NODES', 0)
+    tree = BPlusTree('test_bplus_tree_registry')
+    tree.serialize()
+    # 同一个索引只打开一次，各个会话共享同一个 BPlusTree
+    opened = index_mgr.get(tree.index_name)
+    assert opened is not tree
+    assert index_mgr.get(tree.index_name) is opened
+
+    with index_mgr.acquire(tree.index_name) as acquired:
+        assert acquired is opened
+        for i in range(3000):
+            acquired.insert(encode_key(('%06d' % i,)), (0, i))
+        acquired.serialize()
+    # 结束时释放多余的已解码节点，只保留脏节点与内部节点
+    assert all(not node.is_leaf or node is opened.root or pageno in opened.dirty_nodes
+               for pageno, node in opened.nodes.items())
+    assert len(index_mgr.get(tree.index_name).find_range()) == 3000
+
+    # DDL 之后重新打开，看到的是 buffer pool 中的最新内容
+    index_mgr.invalidate(tree.index_name)
+    reopened = index_mgr.get(tree.index_name)
+    assert reopened is not opened
+    assert reopened.find_range() == [(0, i) for i in range(3000)]
+    index_mgr.invalidate()
+    assert not index_mgr.trees
+
+
+def check_tree(tree, node, low=None, high=None, depth=0):
+    """检查 key 的有序性以及分隔符的范围，返回叶子节点的深度"""
+    node = tree.load_node(node)
+    assert node.keys == sorted(node.keys)
+    assert all((low is None or low <= key) and (high is None or key <= high) for key in node.keys)
+    if node.is_leaf:
+        return {depth}
+    assert len(node.children) == len(node.keys) + 1
+    bounds = [low] + node.keys + [high]
+    depths = set()
+    for i, child in enumerate(node.children):
+        depths |= check_tree(tree, child, bounds[i], bounds[i + 1], depth + 1)
+    return depths
+
+
+def test_split_with_duplicate_keys(data_directory):
+    # 较长的键使得内部节点也发生分裂，相同的 key 跨越多个叶子节点
+    tree = BPlusTree('test_bplus_tree_duplicates')
+    keys = [encode_key(('%03d' % (i % 7) + 'x' * 300,)) for i in range(7)]
+    random.seed(2)
+    inserted = {key: [] for key in keys}
+    for i in range(4000):
+        key = random.choice(keys)
+        tree.insert(key, (0, i))
+        inserted[key].append((0, i))
+    depths = check_tree(tree, tree.root)
+    # 所有叶子节点在同一层，并且树至少有三层
+    assert len(depths) == 1 and depths.pop() >= 2
+    check_node_size(tree, tree.root)
+    # 相同的 key 保持插入的先后顺序
+    for key in keys:
+        assert tree.find(key) == inserted[key]
+    assert tree.find_range() == [value for key in sorted(keys) for value in inserted[key]]
+
+    for key in keys[::2]:
+        for value in inserted[key][::2]:
+            tree.delete(key, value)
+        del inserted[key][::2]
+    check_tree(tree, tree.root)
+    for key in keys:
+        assert tree.find(key) == inserted[key]
+
+
+def int_key(i):
+    return encode_key((i,))
+
+
+def test_cursor_bounds(data_directory):
+    tree = BPlusTree('test_bplus_tree_bounds')
+    for i in range(1000):
+        tree.insert(int_key(i), (0, i))
+    for start_inclusive in (False, True):
+        for end_inclusive in (False, True):
+            cursor = tree.cursor(int_key(100), int_key(800), start_inclusive, end_inclusive)
+            low = 100 if start_inclusive else 101
+            high = 800 if end_inclusive else 799
+            assert [value for _, value in cursor] == [(0, i) for i in range(low, high + 1)]
+    # 不包含等值时，两端相等的范围是空的
+    assert list(tree.cursor(int_key(5), int_key(5))) == []
+    assert [value for _, value in tree.cursor(int_key(5), int_key(5), True, True)] == [(0, 5)]
+    assert list(tree.cursor(int_key(2000), int_key(3000), True, True)) == []
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_cursor_after_concurrent_splits(data_directory, reverse):
+    tree = BPlusTree('test_bplus_tree_cursor')
+    expected = {}
+    for i in range(0, 4000, 2):
+        tree.insert(int_key(i), (0, i))
+        expected[i] = [(0, i)]
+    # 相同的 key 跨越多个叶子节点
+    for j in range(300):
+        tree.insert(int_key(2000), (1, j))
+        expected[2000].append((1, j))
+
+    cursor = tree.cursor(int_key(500), int_key(3500), True, False, reverse)
+    # 停在 key 为 2000 的重复元素中间
+    seen = [next(cursor) for _ in range(900)]
+    last = decode_key(seen[-1][0])[0]
+    assert last == 2000
+    seen = [value for _, value in seen]
+    # 迭代的过程中，其他会话插入、删除元素，引起分裂与合并
+    version = tree.version
+    rng = random.Random(3)
+    for i in range(1, 4000, 2):
+        tree.insert(int_key(i), (0, i))
+        expected[i] = [(0, i)]
+    for j in range(300, 600):
+        tree.insert(int_key(2000), (1, j))
+        expected[2000].append((1, j))
+    for i in rng.sample(range(0, 4000, 2), 1000):
+        if i != 2000:
+            tree.delete(int_key(i), (0, i))
+            del expected[i]
+    assert tree.version != version
+    seen.extend(value for _, value in cursor)
+
+    # 已经返回过的元素不会重复，之后的元素以最新的树为准
+    assert len(set(seen)) == len(seen)
+    keys = sorted((i for i in expected if 500 <= i < 3500), reverse=reverse)
+    if reverse:
+        remaining = [value for i in keys if i < last for value in expected[i]]
+    else:
+        remaining = [value for i in keys if i > last for value in expected[i]]
+    # 与最后返回的键相等、还没有返回过的元素都在其余的键之前返回，
+    # 已经复制出来的那一批元素保持原样，因此相同 key 之间的先后顺序不做要求
+    duplicates = [value for value in expected[last] if value not in seen[:900]]
+    assert sorted(seen[900:900 + len(duplicates)]) == sorted(duplicates)
+    assert seen[900 + len(duplicates):] == remaining
+
+
+def test_reverse_cursor(data_directory):
+    tree = BPlusTree('test_bplus_tree_reverse')
+    random.seed(4)
+    values = list(range(3000))
+    random.shuffle(values)
+    for i in values:
+        tree.insert(int_key(i // 2), (0, i))
+    for i in values[:1000]:
+        tree.delete(int_key(i // 2), (0, i))
+    tree.serialize()
+    tree.flush()
+    # prev_leaf 与 next_leaf 一样写到页中，重新打开之后仍然可以逆序扫描
+    tree = reopen(tree.index_name)
+    forward = list(tree.cursor())
+    assert list(tree.cursor(reverse=True)) == forward[::-1]
+
+    for start_inclusive in (False, True):
+        for end_inclusive in (False, True):
+            cursor = tree.cursor(int_key(100), int_key(800), start_inclusive, end_inclusive)
+            reverse = tree.cursor(int_key(100), int_key(800), start_inclusive, end_inclusive,
+                                  reverse=True)
+            assert list(reverse) == list(cursor)[::-1]
@@ -0,0 +1,55 @@
+from imoocdb.storage import entry
+from imoocdb.storage.common import get_table_filename, sync_table_page
+from imoocdb.storage.compression import ExtentMap, EXTENT_ALIGNMENT, compression_mgr
+from imoocdb.storage.lru import buffer_pool, LRUCache
+from imoocdb.storage.smgr import smgr
+from imoocdb.storage.transaction.entry import transaction_mgr, checkpoint
+
+
+def test_allocate_always_uses_a_new_extent():
+    extent_map = ExtentMap('t', 'zlib')
+    first = extent_map.allocate(0, 100)
+    extent_map.allocate(1, 600)
+    # 即使原来的空间放得下，也不原地覆盖
+    second = extent_map.allocate(0, 100)
+    assert second != first
+    assert extent_map.lookup(0) == (second, EXTENT_ALIGNMENT)
+    # 旧的 extent 在 map 落盘之前不能被复用
+    assert extent_map.allocate(2, 100) not in (first, second)
+    extent_map.release()
+    assert extent_map.allocate(3, 100) == first
+
+
+def test_holes_are_reused_after_load():
+    extent_map = ExtentMap('t', 'zlib', [(0, 512), (1536, 512), (0, 0)])
+    assert extent_map.free_extents == [(512, 1024)]
+    assert extent_map.allocate(2, 600) == 512
+    assert extent_map.allocate(3, 100) == 2048
+
+
+def test_torn_write_keeps_the_old_image(catalog, xid, monkeypatch):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    rows = [(i, 'name %d' % i) for i in range(100)]
+    locations = [entry.table_tuple_insert_one('t', row) for row in rows]
+    transaction_mgr.commit_transaction(xid)
+    entry.table_tuple_set_compression('t', 'zlib')
+    checkpoint()
+    old_extent = compression_mgr.get('t').lookup(0)
+
+    xid = transaction_mgr.start_transaction()
+    entry.table_tuple_update_one('t', locations[0], (0, 'changed'))
+    transaction_mgr.commit_transaction(xid)
+    page = entry.table_tuple_get_page('t', 0)
+    sync_table_page('t', 0, page)
+    new_offset, capacity = compression_mgr.get('t').lookup(0)
+    assert new_offset != old_extent[0]
+    # 新的镜像只写了一半就崩溃了，map 还没有写出
+    smgr.write(get_table_filename('t'), new_offset + capacity // 2, bytes(capacity // 2))
+
+    # 重启之后，磁盘上的 map 仍然指向完整的旧镜像，redo 日志从这里开始重放
+    smgr.close_all()
+    monkeypatch.setattr(buffer_pool, 'lru_cache', LRUCache(buffer_pool.lru_cache.capacity))
+    monkeypatch.setattr(buffer_pool, 'dirty_pages', set())
+    monkeypatch.setattr(compression_mgr, 'maps', {})
+    assert compression_mgr.get('t').lookup(0) == old_extent
+    assert list(entry.table_tuple_get_all('t')) == rows
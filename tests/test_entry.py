@@ -0,0 +1,232 @@
+import logging
+import random
+
+from imoocdb.storage import entry
+from imoocdb.storage.entry import table_tuple_insert_one, table_tuple_get_all, table_tuple_get_one
+from imoocdb.storage.row_format import ROW_FORMAT_MAGIC, is_pickle_format
+from imoocdb.storage.transaction.entry import transaction_mgr
+
+ROWS = [(i, 'name %d' % i, None if i % 3 else 'x' * i) for i in range(50)]
+
+
+def raw_tuple(table_name, location):
+    pageno, sid = location
+    return entry.table_tuple_get_page(table_name, pageno).select(sid)
+
+
+def test_insert_and_scan_with_row_format(catalog, xid):
+    catalog.create_table('t', ['id', 'name', 'memo'], ['int', 'text', 'text'])
+    locations = [table_tuple_insert_one('t', row) for row in ROWS]
+    transaction_mgr.commit_transaction(xid)
+
+    assert all(raw_tuple('t', location)[0] == ROW_FORMAT_MAGIC for location in locations)
+    assert list(table_tuple_get_all('t')) == ROWS
+    assert table_tuple_get_one('t', locations[7]) == ROWS[7]
+    # 只解码需要的列，其他列用 None 占位
+    assert list(table_tuple_get_all('t', ['name'])) == [(None, row[1], None) for row in ROWS]
+
+
+def test_table_without_column_types(catalog, xid, caplog, monkeypatch):
+    monkeypatch.setattr(entry, 'untyped_tables', set())
+    catalog.create_table('legacy', ['id', 'name'])
+    with caplog.at_level(logging.WARNING, logger=entry.__name__):
+        locations = [table_tuple_insert_one('legacy', row[:2]) for row in ROWS]
+    transaction_mgr.commit_transaction(xid)
+
+    # 退化为 pickle 格式时要给出提示，并且每张表只提示一次
+    warnings = [record for record in caplog.records if 'legacy' in record.getMessage()]
+    assert len(warnings) == 1
+    assert all(is_pickle_format(raw_tuple('legacy', location)) for location in locations)
+    assert list(table_tuple_get_all('legacy')) == [row[:2] for row in ROWS]
+
+
+def test_abort_delete_restores_original_locations(catalog, xid):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    catalog.create_index('t_id', 't', ['id'])
+    rows = [(i, 'name %d' % i) for i in range(10)]
+    locations = [table_tuple_insert_one('t', row) for row in rows]
+    transaction_mgr.commit_transaction(xid)
+    entry.index_tuple_create('t_id', 't', ['id'])
+
+    xid = transaction_mgr.start_transaction()
+    for row, location in zip(rows[:3], locations[:3]):
+        entry.index_tuple_delete_one('t_id', (row[0],), location)
+    entry.table_tuple_delete_multiple('t', locations[:3])
+    # 事务还没有结束，整理页也不能回收被删除的元组
+    entry.table_tuple_reorganize('t')
+    transaction_mgr.abort_transaction(xid)
+
+    # 回滚之后，元组回到原来的 sid, 索引中的 location 仍然有效
+    assert list(entry.index_tuple_get_equal_value('t_id', (0,))) == [rows[0]]
+    assert [table_tuple_get_one('t', location) for location in locations] == rows
+
+
+def test_reorganize_after_commit(catalog, xid):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    rows = [(i, 'name %d' % i) for i in range(10)]
+    locations = [table_tuple_insert_one('t', row) for row in rows]
+    transaction_mgr.commit_transaction(xid)
+
+    xid = transaction_mgr.start_transaction()
+    entry.table_tuple_delete_multiple('t', locations[:3])
+    assert entry.table_tuple_reorganize('t') == 0
+    transaction_mgr.commit_transaction(xid)
+
+    xid = transaction_mgr.start_transaction()
+    assert entry.table_tuple_reorganize('t') > 0
+    transaction_mgr.commit_transaction(xid)
+    # 整理只回收空间，存活元组的 location 不变
+    assert [table_tuple_get_one('t', location) for location in locations[3:]] == rows[3:]
+    assert list(table_tuple_get_all('t')) == rows[3:]
+
+
+def test_abort_after_hot_update_and_delete(catalog, xid):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    catalog.create_index('t_id', 't', ['id'])
+    rows = [(i, 'name %d' % i) for i in range(10)]
+    locations = [table_tuple_insert_one('t', row) for row in rows]
+    transaction_mgr.commit_transaction(xid)
+    entry.index_tuple_create('t_id', 't', ['id'])
+
+    xid = transaction_mgr.start_transaction()
+    # HOT 更新之后再删除同一个元组，它的 heap-only slot 在事务结束之前不能被复用
+    assert entry.table_tuple_update_one('t', locations[0], (0, 'x' * 100)) == locations[0]
+    entry.index_tuple_delete_one('t_id', (0,), locations[0])
+    entry.table_tuple_delete_one('t', locations[0])
+    assert entry.table_tuple_update_one('t', locations[1], (1, 'y' * 100)) == locations[1]
+    transaction_mgr.abort_transaction(xid)
+
+    assert list(entry.index_tuple_get_equal_value('t_id', (0,))) == [rows[0]]
+    assert [table_tuple_get_one('t', location) for location in locations] == rows
+
+
+def test_update_compacts_around_pending_deletes(catalog, xid):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    rows, locations = [], []
+    # 把第一个页填满
+    while not locations or locations[-1][0] == 0:
+        rows.append((len(rows), 'n' * 200))
+        locations.append(table_tuple_insert_one('t', rows[-1]))
+    rows, locations = rows[:-1], locations[:-1]
+    transaction_mgr.commit_transaction(xid)
+
+    xid = transaction_mgr.start_transaction()
+    entry.table_tuple_delete_one('t', locations[0])
+    for i in (1, 2, 3):
+        entry.table_tuple_update_one('t', locations[i], (i, 'n' * 10))
+    # 页内已经没有空闲空间，需要整理之后才能 HOT 更新，但不能回收第一个元组
+    assert entry.table_tuple_update_one('t', locations[4], (4, 'm' * 400)) == locations[4]
+    transaction_mgr.abort_transaction(xid)
+
+    assert [table_tuple_get_one('t', location) for location in locations] == rows
+
+
+def test_insert_many_is_replayed_after_crash(catalog, xid, restart):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    rows = [(i, 'name %d' % i) for i in range(1000)]
+    locations = entry.table_tuple_insert_many('t', rows)
+    # 同一个页上的元组只写一条 redo 日志
+    pages = {pageno for pageno, _ in locations}
+    assert len(pages) > 1
+    records = [record for record in transaction_mgr.redo_mgr.log_buffer if record.relation == 't']
+    assert len(records) == len(pages)
+    transaction_mgr.commit_transaction(xid)
+
+    # 还没有被批量插入的事务，日志已经落盘，但是没有提交
+    xid = transaction_mgr.start_transaction()
+    entry.table_tuple_insert_many('t', [(i, 'uncommitted') for i in range(1000, 1500)])
+    transaction_mgr.undo_mgr.flush(xid)
+    transaction_mgr.redo_mgr.flush()
+
+    # 脏页都没有写回就崩溃了，全部由 redo 日志重放，没有提交的事务被回滚
+    restart()
+    transaction_mgr.recovery()
+    assert list(table_tuple_get_all('t')) == rows
+    assert [table_tuple_get_one('t', location) for location in locations[::97]] == rows[::97]
+
+
+def test_bitmap_fetch_in_physical_order(catalog, xid):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    catalog.create_index('t_name', 't', ['name'])
+    # 索引键的顺序与元组的物理顺序无关
+    rows = [(i, 'name %03d' % ((i * 37) % 500)) for i in range(500)]
+    locations = entry.table_tuple_insert_many('t', rows)
+    transaction_mgr.commit_transaction(xid)
+    entry.index_tuple_create('t_name', 't', ['name'])
+
+    by_key = list(entry.index_tuple_get_range('t_name', ('name 100',), ('name 300',)))
+    by_page = list(entry.index_tuple_get_range('t_name', ('name 100',), ('name 300',), bitmap=True))
+    assert sorted(by_page) == sorted(by_key)
+    assert by_key == sorted(by_key, key=lambda row: row[1])
+    # 按照 location 的顺序回表，正好是插入的顺序
+    assert by_page == [row for row in rows if 'name 100' < row[1] < 'name 300']
+
+    shuffled = locations[::-1]
+    assert list(entry.table_tuple_bitmap_fetch('t', shuffled)) == rows
+    assert list(entry.index_tuple_get_equal_value('t_name', ('name 037',), bitmap=True)) == [rows[1]]
+
+
+def test_toast_round_trip(catalog, xid):
+    catalog.create_table('t', ['id', 'name', 'memo'], ['int', 'text', 'text'])
+    rng = random.Random(0)
+    big = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(30000))
+    rows = [(0, 'small', None), (1, 'x' * 20000, 'compressible'), (2, 'y', big)]
+    locations = [table_tuple_insert_one('t', row) for row in rows]
+    transaction_mgr.commit_transaction(xid)
+
+    toast_relation = entry.table_tuple_get_toast_relation('t')
+    chunks = list(entry.table_tuple_get_all_locations(toast_relation))
+    assert chunks
+    assert [table_tuple_get_one('t', location) for location in locations] == rows
+    assert list(table_tuple_get_all('t')) == rows
+    assert entry.table_tuple_get_accessor('t', locations[2])[2] == big
+
+    # 删除之后，溢出表中的 chunk 由 vacuum 统一回收
+    xid = transaction_mgr.start_transaction()
+    entry.table_tuple_delete_one('t', locations[2])
+    transaction_mgr.commit_transaction(xid)
+    xid = transaction_mgr.start_transaction()
+    assert entry.table_tuple_vacuum_toast('t') == len(chunks)
+    transaction_mgr.commit_transaction(xid)
+    assert list(entry.table_tuple_get_all_locations(toast_relation)) == []
+    assert list(table_tuple_get_all('t')) == rows[:2]
+
+
+def test_create_index_replaces_open_handle(catalog, xid):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    catalog.create_index('t_id', 't', ['id'])
+    rows = [(i, 'name %d' % i) for i in range(100)]
+    entry.table_tuple_insert_many('t', rows[:50])
+    transaction_mgr.commit_transaction(xid)
+    entry.index_tuple_create('t_id', 't', ['id'])
+    old = entry.index_mgr.get('t_id')
+    assert entry.index_mgr.get('t_id') is old
+
+    xid = transaction_mgr.start_transaction()
+    entry.table_tuple_insert_many('t', rows[50:])
+    transaction_mgr.commit_transaction(xid)
+    # 重建索引之后，不能再使用原来打开的句柄
+    entry.index_tuple_create('t_id', 't', ['id'])
+    assert entry.index_mgr.get('t_id') is not old
+    assert list(entry.index_tuple_get_range('t_id', (40,), (60,))) == rows[41:60]
+
+
+def test_reverse_index_scan(catalog, xid):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    catalog.create_index('t_id', 't', ['id'])
+    catalog.create_index('t_name_id', 't', ['name', 'id'])
+    rows = [(i % 100, 'name %d' % (i % 7)) for i in range(500)]
+    entry.table_tuple_insert_many('t', rows)
+    transaction_mgr.commit_transaction(xid)
+    entry.index_tuple_create('t_id', 't', ['id'])
+    entry.index_tuple_create('t_name_id', 't', ['name', 'id'])
+
+    # 相同的 key 逆序返回时，location 也是逆序的，与正向扫描的结果正好相反
+    forward = list(entry.index_tuple_get_range('t_id', (10,), (20,), end_inclusive=True))
+    backward = list(entry.index_tuple_get_range('t_id', (10,), (20,), end_inclusive=True,
+                                                reverse=True))
+    assert backward == forward[::-1]
+    assert [row[0] for row in backward] == sorted((row[0] for row in rows if 10 < row[0] <= 20),
+                                                  reverse=True)
+    keys = list(entry.covered_index_tuple_get_range('t_name_id', reverse=True))
+    assert keys == sorted(((row[1], row[0]) for row in rows), reverse=True)
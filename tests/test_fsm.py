@@ -0,0 +1,56 @@
+import os
+
+from imoocdb.storage import entry
+from imoocdb.storage.fsm import FreeSpaceMap, fsm_mgr, get_fsm_filename, FSM_CATEGORY_SIZE, \
+    free_space_to_category, record_size_to_category
+from imoocdb.storage.slotted_page import PAGE_SIZE, PageHeader
+from imoocdb.storage.transaction.entry import transaction_mgr, checkpoint
+
+
+def test_search_finds_a_page_with_enough_space():
+    fsm = FreeSpaceMap('t')
+    fsm.update(0, 10)
+    fsm.update(1, 1000)
+    fsm.update(3, PAGE_SIZE - PageHeader.size())
+    # 中间缺失的页按照没有空闲空间处理
+    assert len(fsm) == 4 and fsm.categories[2] == 0
+    assert fsm.search(500) in (1, 3)
+    assert fsm.search(2000) == 3
+    assert fsm.search(PAGE_SIZE) is None
+    fsm.update(3, 0)
+    assert fsm.search(2000) is None
+    # 档位向下取整，申请时向上取整，找到的页一定放得下
+    assert free_space_to_category(FSM_CATEGORY_SIZE * 2 - 1) == 1
+    assert record_size_to_category(1) == 1
+
+
+def test_insert_reuses_reclaimed_space(catalog, xid):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    locations = [entry.table_tuple_insert_one('t', (i, 'x' * 500)) for i in range(60)]
+    transaction_mgr.commit_transaction(xid)
+    pages = entry.table_tuple_get_pages('t')
+    assert pages > 1
+
+    xid = transaction_mgr.start_transaction()
+    entry.table_tuple_delete_multiple('t', [location for location in locations if location[0] == 0])
+    transaction_mgr.commit_transaction(xid)
+    xid = transaction_mgr.start_transaction()
+    entry.table_tuple_reorganize('t')
+    # 第一个页的空间被回收之后，新的元组放回第一个页，而不是分配新页
+    assert entry.table_tuple_insert_one('t', (100, 'y' * 500))[0] == 0
+    transaction_mgr.commit_transaction(xid)
+    assert entry.table_tuple_get_pages('t') == pages
+
+
+def test_rebuild_from_page_headers(catalog, xid):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    for i in range(60):
+        entry.table_tuple_insert_one('t', (i, 'x' * 500))
+    transaction_mgr.commit_transaction(xid)
+    checkpoint()
+    expected = bytes(fsm_mgr.get('t').categories)
+    assert os.path.exists(get_fsm_filename('t'))
+
+    # FSM 文件丢失时，读取页头重建
+    fsm_mgr.rebuild('t')
+    assert bytes(fsm_mgr.get('t').categories) == expected
@@ -0,0 +1,38 @@
+import pytest
+
+from imoocdb.errors import LRUError
+from imoocdb.storage.lru import LRUCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert set(cache.cache) == {'a', 'c'}
+    assert cache.evicted == {'b': 2}
+
+
+def test_pin_is_counted():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.pin('a')
+    cache.pin('a')
+    cache.unpin('a')
+    # 还有一次 pin, 仍然不能被淘汰
+    cache.put('c', 3)
+    assert 'a' in cache.cache and 'b' in cache.evicted
+
+    # 替换页的内容不影响 pin
+    cache.put('a', 10)
+    cache.put('d', 4)
+    assert 'a' in cache.cache and 'c' in cache.evicted
+
+    cache.unpin('a')
+    with pytest.raises(LRUError):
+        cache.unpin('a')
+    cache.put('e', 5)
+    assert 'a' in cache.evicted
+
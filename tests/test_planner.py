@@ -0,0 +1,81 @@
+import types
+
+import pytest
+
+# 优化器依赖的执行器、公共数据结构不在本仓库中
+fabric = pytest.importorskip('imoocdb.common.fabric')
+pytest.importorskip('imoocdb.executor.operator.physical_operator')
+
+from imoocdb.sql import logical_operator  # noqa: E402
+from imoocdb.sql.logical_operator import ScanOperator, SortOperator  # noqa: E402
+from imoocdb.sql.optimizier import planner  # noqa: E402
+from imoocdb.sql.optimizier.planner import (  # noqa: E402
+    SelectImplementation, TableScan, IndexScan, CoveredIndexScan, Sort)
+from imoocdb.storage.entry import table_tuple_insert_many  # noqa: E402
+from imoocdb.storage.transaction.entry import transaction_mgr  # noqa: E402
+
+
+@pytest.fixture
+def tables(catalog, xid, monkeypatch):
+    monkeypatch.setattr(planner, 'catalog_table', catalog.table)
+    monkeypatch.setattr(planner, 'catalog_index', catalog.index)
+    monkeypatch.setattr(logical_operator, 'catalog_table', catalog.table)
+    catalog.create_table('t', ['id', 'name', 'memo'], ['int', 'text', 'text'])
+    catalog.create_index('t_id', 't', ['id'])
+    catalog.create_index('t_name_id', 't', ['name', 'id'])
+    table_tuple_insert_many('t', [(i, 'name %d' % i, None) for i in range(1000)])
+    transaction_mgr.commit_transaction(xid)
+    return catalog
+
+
+def plan_sort(column_name, asc, columns=None, condition=None):
+    scan = ScanOperator('t')
+    if columns is not None:
+        scan.columns = columns
+    scan.condition = condition
+    sort = SortOperator(fabric.TableColumn('t', column_name), asc)
+    sort.add_child(scan)
+    return SelectImplementation.implement(sort)
+
+
+def condition(column_name, sign, value):
+    return types.SimpleNamespace(sign=sign, left=fabric.TableColumn('t', column_name), right=value)
+
+
+@pytest.mark.parametrize('asc', [True, False])
+def test_order_by_uses_index_order(tables, asc):
+    # 没有谓词时，通过索引扫描全部的数据，DESC 时逆序扫描，不再需要 Sort
+    scan = plan_sort('id', asc)
+    assert isinstance(scan, IndexScan) and not isinstance(scan, CoveredIndexScan)
+    assert scan.index_name == 't_id'
+    assert scan.condition is None
+    assert scan.reverse is not asc
+    assert not scan.bitmap_heap_scan
+    assert not scan.children
+
+    scan = plan_sort('name', asc, columns=['name', 'id'])
+    assert isinstance(scan, CoveredIndexScan)
+    assert scan.index_name == 't_name_id'
+    assert scan.reverse is not asc
+
+
+def test_order_by_with_index_predicate(tables):
+    # 谓词已经用到了 ORDER BY 列上的索引，按照索引的顺序回表，不能使用 bitmap heap scan
+    scan = plan_sort('id', False, condition=condition('id', '>', 10))
+    assert isinstance(scan, IndexScan)
+    assert scan.index_name == 't_id'
+    assert scan.reverse
+    assert not scan.bitmap_heap_scan
+
+
+@pytest.mark.parametrize('column_name, predicate', [
+    ('memo', None),
+    ('id', condition('memo', '=', 'x')),
+    ('name', condition('id', '>', 10)),
+])
+def test_order_by_keeps_sort(tables, column_name, predicate):
+    # 没有可用的索引顺序时，仍然是扫描 + Sort
+    sort = plan_sort(column_name, True, condition=predicate)
+    assert isinstance(sort, Sort)
+    assert len(sort.children) == 1
+    assert isinstance(sort.children[0], (TableScan, IndexScan))
@@ -0,0 +1,53 @@
+import threading
+
+from imoocdb.storage import entry
+from imoocdb.storage.lru import buffer_pool, LRUCache
+from imoocdb.storage.readahead import Readahead, readahead, READAHEAD_MIN_WINDOW, READAHEAD_MAX_WINDOW
+from imoocdb.storage.transaction.entry import transaction_mgr, checkpoint
+
+
+def test_window_grows_while_access_is_sequential(data_directory):
+    reader = Readahead()
+    issued = []
+    release = threading.Event()
+
+    def read_page(pageno):
+        issued.append(pageno)
+        release.wait()
+        return bytearray()
+
+    windows = []
+    for pageno in range(6):
+        reader.access('t', pageno, 1000, read_page)
+        windows.append(reader.states['t'].window)
+    # 第一次访问不算作顺序访问，从最小的窗口开始
+    assert windows == [4, 8, 16, 32, 32, 32]
+    assert max(key[1] for key in reader.pending) == 5 + READAHEAD_MAX_WINDOW
+
+    # 随机访问时，窗口回到最小值，此前的预读被取消
+    reader.access('t', 500, 1000, read_page)
+    assert reader.states['t'].window == READAHEAD_MIN_WINDOW
+    assert all(key[1] > 500 for key in reader.pending)
+
+    reader.finish('t')
+    assert not reader.pending and 't' not in reader.states
+    release.set()
+    reader.executor.shutdown()
+
+
+def test_scan_stopped_early_releases_readahead(catalog, xid, monkeypatch):
+    catalog.create_table('t', ['id', 'name'], ['int', 'text'])
+    for i in range(500):
+        entry.table_tuple_insert_one('t', (i, 'x' * 200))
+    transaction_mgr.commit_transaction(xid)
+    checkpoint()
+    # 模拟重启，之后的扫描都需要从磁盘上读取
+    monkeypatch.setattr(buffer_pool, 'lru_cache', LRUCache(buffer_pool.lru_cache.capacity))
+
+    scan = entry.table_tuple_get_all('t')
+    assert next(scan) == (0, 'x' * 200)
+    next(scan)
+    assert any(key[0] == 't' for key in readahead.pending)
+    scan.close()
+    assert not any(key[0] == 't' for key in readahead.pending)
+    assert 't' not in readahead.states
@@ -0,0 +1,92 @@
+import pickle
+import random
+
+import pytest
+
+from imoocdb.storage.row_format import get_row_codec, encode_tuple, decode_tuple, is_pickle_format, \
+    ROW_FORMAT_MAGIC, TOAST_TUPLE_THRESHOLD, RowAccessor
+
+TYPES = ('int', 'text', 'int', 'text')
+
+
+def test_round_trip():
+    codec = get_row_codec(TYPES)
+    for tup in [(1, 'a', -2, 'bc'), (None, '', None, None), (2 ** 63 - 1, '中文', -2 ** 63, '\x00')]:
+        buff = encode_tuple(tup, codec)
+        assert buff[0] == ROW_FORMAT_MAGIC
+        assert decode_tuple(buff, codec) == tup
+
+
+def test_smaller_than_pickle():
+    codec = get_row_codec(TYPES)
+    tup = (12345, 'alice', 1, 'beijing')
+    assert len(encode_tuple(tup, codec)) < len(pickle.dumps(tup))
+
+
+def test_codec_is_shared_by_column_types():
+    assert get_row_codec(list(TYPES)) is get_row_codec(TYPES)
+
+
+def test_mismatched_values_fall_back_to_pickle():
+    codec = get_row_codec(TYPES)
+    with pytest.raises(ValueError):
+        codec.encode(('1', 'a', 2, 'b'))
+    with pytest.raises(ValueError):
+        codec.encode((True, 'a', 2, 'b'))
+    with pytest.raises(ValueError):
+        codec.encode((1, 'a', 2))
+    buff = encode_tuple(('1', 'a', 2, 'b'), codec)
+    assert is_pickle_format(buff)
+    assert decode_tuple(buff, codec) == ('1', 'a', 2, 'b')
+
+
+def test_pickle_rows_are_still_readable():
+    codec = get_row_codec(TYPES)
+    buff = pickle.dumps((1, 'a', 2, 'b'))
+    assert is_pickle_format(buff)
+    assert decode_tuple(buff, codec) == (1, 'a', 2, 'b')
+    assert decode_tuple(b'', codec) == ()
+
+
+def random_text(length, seed=0):
+    # 随机的文本压缩不了，只能挪到溢出表中
+    rng = random.Random(seed)
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(length))
+
+
+class ExternalStore:
+    """溢出表的替身"""
+
+    def __init__(self):
+        self.values = {}
+
+    def store(self, payload):
+        location = (len(self.values), 0)
+        self.values[location] = payload
+        return location
+
+    def fetch(self, location):
+        return self.values[location]
+
+
+def test_toast_compresses_inline():
+    codec = get_row_codec(TYPES)
+    tup = (1, 'x' * 10000, 2, 'short')
+    buff = encode_tuple(tup, codec)
+    assert len(buff) <= TOAST_TUPLE_THRESHOLD
+    assert decode_tuple(buff, codec) == tup
+
+
+def test_toast_stores_externally():
+    codec = get_row_codec(TYPES)
+    store = ExternalStore()
+    tup = (1, random_text(5000), 2, random_text(70000, seed=1))
+    buff = encode_tuple(tup, codec, store.store)
+    assert len(buff) <= TOAST_TUPLE_THRESHOLD
+    assert len(store.values) == 2
+    assert decode_tuple(buff, codec, fetch_external=store.fetch) == tup
+
+    # 只访问行内的列时，不需要读取溢出表
+    accessor = RowAccessor(codec, buff)
+    assert accessor[0] == 1 and accessor[2] == 2
+    assert decode_tuple(buff, codec, columns=[0, 2]) == (1, None, 2, None)
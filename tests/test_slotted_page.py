@@ -0,0 +1,113 @@
+import pytest
+
+from imoocdb.errors import PageError
+from imoocdb.storage.slotted_page import Page, PAGE_SIZE, PageHeader, Slot, RecordState
+
+
+def test_insert_select_delete():
+    page = Page()
+    assert page.free_space_size == PAGE_SIZE - PageHeader.size()
+    sids = [page.insert(b'record %d' % i) for i in range(10)]
+    assert sids == list(range(10))
+    assert page.slot_count == 10
+    assert page.select(3) == b'record 3'
+    assert page.total_record_size == sum(len(b'record %d' % i) for i in range(10))
+
+    page.delete(3)
+    assert page.select(3) == b''
+    assert not page.is_live(3)
+    assert page.slot_state(3) == RecordState.DEAD
+    # 标记删除之后，其他元组的 sid 不变
+    assert page.select(4) == b'record 4'
+    with pytest.raises(PageError):
+        page.select(10)
+
+
+def test_page_is_its_own_image():
+    page = Page()
+    page.insert(b'hello')
+    page.set_header(lsn=42)
+    image = page.serialize()
+    # 序列化不发生拷贝，就是页的缓冲区本身
+    assert isinstance(image, memoryview)
+    assert len(image) == PAGE_SIZE
+    assert image.obj is page.buff
+
+    copied = Page.deserialize(bytes(image))
+    assert copied.page_header.lsn == 42
+    assert copied.slot_count == 1
+    assert copied.select(0) == b'hello'
+    # 反序列化得到的是一份独立的缓冲区
+    copied.insert(b'world')
+    assert page.slot_count == 1
+
+
+def test_slot_is_a_view_on_the_page():
+    page = Page()
+    sid = page.insert(b'abcdef')
+    slot = page.get_slot(sid)
+    assert isinstance(slot, Slot)
+    assert slot.length == 6
+    slot.length = 3
+    assert page.select(sid) == b'abc'
+
+
+def test_select_view_does_not_copy():
+    page = Page()
+    sid = page.insert(b'abc')
+    view = page.select_view(sid)
+    assert isinstance(view, memoryview)
+    assert view.obj is page.buff
+    assert bytes(view) == b'abc'
+
+
+def test_copy_on_write_for_read_only_buffers():
+    source = Page()
+    source.insert(b'on disk')
+    image = bytes(source.serialize())
+    read_only = memoryview(image)
+
+    page = Page(read_only)
+    # 只读时直接使用调用者的缓冲区
+    assert page.select(0) == b'on disk'
+    assert page.buff is read_only
+    page.insert(b'in memory')
+    # 第一次修改之前拷贝出一份可写的缓冲区，原来的缓冲区保持不变
+    assert isinstance(page.buff, bytearray)
+    assert page.select(1) == b'in memory'
+    assert Page(memoryview(image)).slot_count == 1
+
+
+def test_insert_until_full():
+    page = Page()
+    record = b'x' * 100
+    count = 0
+    while page.can_insert(len(record)):
+        page.insert(record)
+        count += 1
+    assert count == (PAGE_SIZE - PageHeader.size()) // (Slot.size() + len(record))
+    with pytest.raises(PageError):
+        page.insert(record)
+    # 页满之后，已有的内容不受影响
+    assert page.slot_count == count
+    assert page.select(count - 1) == record
+
+
+def test_heap_only_slot_is_reused_only_after_compact():
+    page = Page()
+    sid = page.insert(b'short')
+    other = page.insert(b'other')
+    page.update(sid, b'a much longer record')
+    assert page.slot_state(sid) == RecordState.REDIRECT
+    heap_only = page.get_slot(sid).offset
+    page.delete(sid)
+    # 被删除的 HOT 链在整理之前不能被复用
+    assert page.slot_state(heap_only) == RecordState.DEAD
+    page.update(other, b'another longer record')
+    assert page.get_slot(other).offset != heap_only
+
+    page.compact(keep={sid})
+    assert page.slot_state(sid) == RecordState.DEAD
+    assert page.slot_state(heap_only) == RecordState.UNUSED
+    page.update(other, b'yet another, even longer record')
+    assert page.get_slot(other).offset == heap_only
@@ -0,0 +1,31 @@
+import pytest
+
+from imoocdb.storage.common import get_table_filename, table_tuple_get_page
+from imoocdb.storage.slotted_page import Page, PAGE_SIZE
+from imoocdb.storage.smgr import smgr, StorageManager, IO_METHOD_MMAP, IO_METHOD_PREAD
+
+
+def test_io_method_is_per_database(data_directory):
+    assert smgr.io_method == IO_METHOD_PREAD
+    smgr.set_io_method(IO_METHOD_MMAP)
+    # 重新打开数据库之后仍然生效
+    assert StorageManager().io_method == IO_METHOD_MMAP
+    with pytest.raises(ValueError):
+        smgr.set_io_method('direct')
+    assert StorageManager().io_method == IO_METHOD_MMAP
+
+
+def test_truncate_detaches_mapped_pages(data_directory):
+    smgr.set_io_method(IO_METHOD_MMAP)
+    filename = get_table_filename('t')
+    for pageno in range(2):
+        page = Page()
+        page.insert(b'page %d' % pageno)
+        smgr.write(filename, pageno * PAGE_SIZE, page.serialize())
+
+    pages = [table_tuple_get_page('t', pageno) for pageno in range(2)]
+    assert all(isinstance(page.buff, memoryview) for page in pages)
+    smgr.truncate(filename, 0)
+    # 映射区被丢弃之前，缓存中的页已经被拷贝出来，之后仍然可以访问
+    assert all(isinstance(page.buff, bytearray) for page in pages)
+    assert [page.select(0) for page in pages] == [b'page 0', b'page 1']
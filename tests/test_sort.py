@@ -0,0 +1,70 @@
+import os
+import random
+
+import pytest
+
+from imoocdb.storage.bplus_tree import BPlusTree, bulk_load, encode_key
+from imoocdb.storage.sort import external_sort, get_sort_directory
+
+
+def random_entries(count, seed=0):
+    rng = random.Random(seed)
+    return [(encode_key((rng.randint(0, count // 4), 'v' * rng.randint(0, 20))), (i // 50, i % 50))
+            for i in range(count)]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_external_sort_spills_runs(data_directory, workers):
+    entries = random_entries(5000)
+    # run 很小，排序溢出到多个临时文件中
+    result = external_sort(iter(entries), run_size=300, workers=workers)
+    assert next(result) == min(entries)
+    assert os.listdir(get_sort_directory())
+    assert [min(entries)] + list(result) == sorted(entries)
+    # 归并结束之后，临时文件都被删除
+    assert not os.listdir(get_sort_directory())
+
+
+def test_external_sort_in_memory(data_directory):
+    entries = random_entries(100)
+    assert list(external_sort(iter(entries))) == sorted(entries)
+    assert not os.path.exists(get_sort_directory())
+    assert list(external_sort(iter([]))) == []
+
+
+def test_abandoned_sort_removes_runs(data_directory):
+    result = external_sort(iter(random_entries(1000)), run_size=100)
+    next(result)
+    result.close()
+    assert not os.listdir(get_sort_directory())
+
+
+@pytest.mark.parametrize('fill_factor', [1.0, 0.5])
+def test_bulk_load_matches_inserts(data_directory, fill_factor):
+    entries = sorted(random_entries(5000))
+    tree = bulk_load('test_sort_bulk', iter(entries), fill_factor)
+    inserted = BPlusTree('test_sort_insert')
+    for key, value in entries:
+        inserted.insert(key, value)
+
+    assert tree.find_range(return_keys=True) == [key for key, _ in entries]
+    assert tree.find_range() == inserted.find_range()
+    assert list(tree.cursor(reverse=True)) == list(reversed(entries))
+    for key, _ in entries[::97]:
+        assert tree.find(key) == inserted.find(key)
+    assert tree.node_count < len(entries) // 10
+
+    # 批量构建的索引可以继续修改，也可以重新打开
+    tree.insert(encode_key((-1,)), (9, 9))
+    tree.delete(entries[0][0], entries[0][1])
+    tree.serialize()
+    tree.flush()
+    reopened = BPlusTree.deserialize('test_sort_bulk')
+    assert reopened.find_range() == [(9, 9)] + [value for _, value in entries[1:]]
+
+
+def test_bulk_load_empty(data_directory):
+    tree = bulk_load('test_sort_empty', iter([]))
+    assert tree.find_range() == []
+    tree.insert(encode_key((1,)), (0, 0))
+    assert tree.find_range() == [(0, 0)]